@@ -0,0 +1,736 @@
+#!/usr/bin/python3
+
+import sys, os
+import getopt
+import time
+import io
+import json
+import shutil
+import tempfile
+import sqlite3
+import multiprocessing
+import urllib.request
+
+import xml.etree.ElementTree as ET
+
+from collections import OrderedDict
+
+import dl_gb
+import fake_gb_server
+
+# Benchmarks for dl_gb.py, run against a local fake_gb_server instead of
+# Giantbomb. Run from the same directory as dl_gb.py. Every benchmark works in
+# a temporary directory, so existing progress files are left alone.
+
+################################################################################
+# Globals
+################################################################################
+g_benchmarks = ["parse", "query", "download", "engine", "shared", "progress", "done", "filter", "crawl", "library"]
+g_repeats = 3
+g_sizes = [100, 1000, 10000, 100000]    # Catalog sizes for parse/query/progress/done
+g_dl_count = 20                         # Videos fetched by the download benchmark
+g_video_size = 8*1024*1024              # Bytes per video in the download benchmark
+g_chunk_sizes = [64*1024, 1024*1024, 4*1024*1024]  # dl_gb.g_read_size values in the engine benchmark
+g_processes = 3                         # Processes sharing the queue in the shared benchmark
+g_kill_after = 0.5                      # Seconds before the shared benchmark kills one extra process
+g_new_videos = 30                       # Videos added between crawls in the crawl benchmark
+g_guid_max_videos = 10000               # Largest catalog crawled one guid request at a time
+g_lookups = 10000                       # Lookups per catalog size in the done benchmark
+g_library_dirs = 100                    # Show/year directories the library benchmark spreads videos over
+g_latency = 0.0                         # Seconds the fake server waits before responding
+g_bandwidth = 0                         # Fake server bytes/second per response, 0 for no cap
+g_fail_rate = 0.0                       # Chance the fake server answers with a 503
+g_drop_rate = 0.0                       # Chance the fake server cuts a video off halfway
+
+################################################################################
+# Main
+################################################################################
+def main(argv):
+    global g_repeats
+    global g_sizes
+    global g_dl_count
+    global g_video_size
+    global g_chunk_sizes
+    global g_processes
+    global g_latency
+    global g_bandwidth
+    global g_fail_rate
+    global g_drop_rate
+    benchmarks = g_benchmarks
+
+    try:
+        opts, args = getopt.getopt(argv, "hb:r:n:w:s:", ["bench=", "repeats=", "sizes=", "workers=", "segments=",
+                                                         "dl-count=", "video-size=", "chunk-sizes=", "processes=", "latency=", "bandwidth=",
+                                                         "fail-rate=", "drop-rate="])
+    except getopt.GetoptError:
+        print_usage()
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt == '-h':
+            print_usage()
+            sys.exit(0)
+        elif opt in ('-b', '--bench'):
+            benchmarks = arg.split(",")
+        elif opt in ('-r', '--repeats'):
+            g_repeats = int(arg)
+        elif opt in ('-n', '--sizes'):
+            g_sizes = [int(size) for size in arg.split(",")]
+        elif opt in ('-w', '--workers'):
+            dl_gb.g_num_workers = int(arg)
+        elif opt in ('-s', '--segments'):
+            dl_gb.g_dl_segments = int(arg)
+        elif opt == '--dl-count':
+            g_dl_count = int(arg)
+        elif opt == '--video-size':
+            g_video_size = int(arg)
+        elif opt == '--processes':
+            g_processes = int(arg)
+        elif opt == '--chunk-sizes':
+            g_chunk_sizes = [int(size) for size in arg.split(",")]
+        elif opt == '--latency':
+            g_latency = float(arg)
+        elif opt == '--bandwidth':
+            g_bandwidth = int(arg)
+        elif opt == '--fail-rate':
+            g_fail_rate = float(arg)
+        elif opt == '--drop-rate':
+            g_drop_rate = float(arg)
+
+    for name in benchmarks:
+        if name not in g_benchmarks:
+            print("ERROR: Unknown benchmark {}".format(name))
+            sys.exit(2)
+
+    # dl_gb.main would compile the filters, so do it here
+    dl_gb.apply_filters()
+    for name in benchmarks:
+        globals()["bench_{}".format(name)]()
+        print()
+
+################################################################################
+# Desc
+#   Compares parsing an API result page as an in-memory tree (how it used to be
+#   done), as a stream of XML events, and as JSON
+# Params
+#   None
+# Returns
+#   None
+################################################################################
+def bench_parse():
+    print("Parse benchmark (best of {} runs)".format(g_repeats))
+    print("{:>8} {:>12} {:>12} {:>12} {:>12}".format("videos", "xml kB", "tree ms", "stream ms", "json ms"))
+    for size in g_sizes:
+        xml_page, json_page = make_api_pages(size)
+
+        def parse_tree():
+            root = ET.fromstring(xml_page.decode("utf-8"))
+            return [dl_gb.get_video_from_element(video) for video in root.findall('./results/video')]
+
+        def parse_stream():
+            return list(dl_gb.parse_videos_xml(io.BytesIO(xml_page)))
+
+        def parse_json():
+            return list(dl_gb.parse_videos_json(io.BytesIO(json_page)))
+
+        tree_time = time_best(parse_tree)
+        stream_time = time_best(parse_stream)
+        json_time = time_best(parse_json)
+        print("{:>8} {:>12.1f} {:>12.2f} {:>12.2f} {:>12.2f}".format(
+            size, len(xml_page)/1024, tree_time*1000, stream_time*1000, json_time*1000))
+
+################################################################################
+# Desc
+#   Times paging through the whole catalog with get_dl_urls_from_api
+# Params
+#   None
+# Returns
+#   None
+################################################################################
+def bench_query():
+    print("Query benchmark (latency {}s)".format(g_latency))
+    print("{:>8} {:>10} {:>10} {:>10} {:>12}".format("videos", "requests", "queued", "seconds", "videos/s"))
+    for size in g_sizes:
+        fake = fake_gb_server.FakeGiantbomb(num_videos=size, latency=g_latency, fail_rate=g_fail_rate)
+        with BenchEnv(fake):
+            done_dict = dl_gb.DoneIndex(dl_gb.g_done_index_file)
+            queued = 0
+            offset = 0
+            start = time.perf_counter()
+            while True:
+                query_dict, page_ids = dl_gb.get_dl_urls_from_api(offset, done_dict)
+                if query_dict is None or len(page_ids) == 0:
+                    break
+                queued += len(query_dict)
+                offset += len(page_ids)
+            elapsed = time.perf_counter() - start
+            requests = sum(fake.counts.values())
+            done_dict.close()
+        print("{:>8} {:>10} {:>10} {:>10.2f} {:>12.0f}".format(size, requests, queued, elapsed, size/elapsed))
+
+################################################################################
+# Desc
+#   Times downloading g_dl_count videos with the download workers, using the
+#   worker and segment counts given on the command line
+# Params
+#   None
+# Returns
+#   None
+################################################################################
+def bench_download():
+    print("Download benchmark ({} videos of {:.1f} MB, {} workers, {} segments, bandwidth cap {})".format(
+        g_dl_count, g_video_size/1e6, dl_gb.g_num_workers, dl_gb.g_dl_segments,
+        "{:.1f} MB/s".format(g_bandwidth/1e6) if g_bandwidth else "none"))
+    fake = fake_gb_server.FakeGiantbomb(num_videos=g_dl_count, video_size=g_video_size, latency=g_latency,
+                                        bandwidth=g_bandwidth, fail_rate=g_fail_rate, drop_rate=g_drop_rate)
+    with BenchEnv(fake):
+        with Quiet():
+            dl_dict, done_dict = dl_gb.load_progress()
+        for video_id in range(1, g_dl_count + 1):
+            dl_name, dl_url = dl_gb.get_dl_pair(dl_gb_video(fake.video(video_id)))
+            dl_dict[dl_name] = dl_url
+
+        dl_queue = dl_gb.DownloadQueue()
+        for dl_name, dl_url in dl_dict.items():
+            dl_queue.put(dl_name, dl_url)
+        dl_queue.close()
+
+        start = time.perf_counter()
+        with Quiet():
+            workers = dl_gb.start_download_workers(dl_queue, dl_dict, done_dict)
+            dl_gb.wait_for_workers(workers, dl_queue)
+        elapsed = time.perf_counter() - start
+        dl_gb.g_journal.close()
+
+        done = len(done_dict)
+        downloaded = sum(os.path.getsize(dl_name) for dl_name in done_dict)
+        requests = sum(fake.counts.values())
+        done_dict.close()
+    print("{:>10} {:>10} {:>10} {:>12} {:>12}".format("done", "requests", "seconds", "MB/s", "videos/hour"))
+    print("{:>10} {:>10} {:>10.2f} {:>12.1f} {:>12.0f}".format(
+        "{}/{}".format(done, g_dl_count), requests, elapsed, downloaded/elapsed/1e6, done/elapsed*3600))
+
+################################################################################
+# Desc
+#   Compares fetching videos with urlretrieve (how download_video used to work)
+#   against fetch_to_part, for each read size in g_chunk_sizes. fetch_to_part
+#   hashes as it writes, so urlretrieve is also timed followed by a hashing
+#   pass over the file. CPU time is for
+#   the whole process, so it includes the in-process fake server's share,
+#   which is the same for every engine.
+# Params
+#   None
+# Returns
+#   None
+################################################################################
+def bench_engine():
+    print("Download engine benchmark ({} videos of {:.1f} MB, best of {})".format(
+        g_dl_count, g_video_size/1e6, g_repeats))
+    fake = fake_gb_server.FakeGiantbomb(num_videos=g_dl_count, video_size=g_video_size, bandwidth=g_bandwidth)
+    print("{:>24} {:>10} {:>12}".format("engine", "MB/s", "cpu s/GB"))
+    with BenchEnv(fake):
+        urls = [fake.video(video_id)["hd_url"] for video_id in range(1, g_dl_count + 1)]
+        total_bytes = g_dl_count * fake.video_body_size("hd")
+
+        def run(label, fetch):
+            best_wall, best_cpu = None, None
+            for k in range(g_repeats):
+                start, start_cpu = time.perf_counter(), time.process_time()
+                with Quiet():
+                    for index, url in enumerate(urls):
+                        fetch("{}.mp4".format(index), url)
+                wall, cpu = time.perf_counter() - start, time.process_time() - start_cpu
+                for index in range(len(urls)):
+                    os.remove("{}.mp4".format(index))
+                best_wall = wall if best_wall is None else min(best_wall, wall)
+                best_cpu = cpu if best_cpu is None else min(best_cpu, cpu)
+            print("{:>24} {:>10.1f} {:>12.2f}".format(label, total_bytes/best_wall/1e6, best_cpu/(total_bytes/1e9)))
+
+        def fetch_legacy(dl_name, url):
+            urllib.request.urlretrieve("{}?api_key=bench".format(url), dl_name)
+
+        def fetch_legacy_hashed(dl_name, url):
+            fetch_legacy(dl_name, url)
+            dl_gb.hash_file(dl_name)
+
+        def fetch_engine(dl_name, url):
+            part_name = "{}.part".format(dl_name)
+            dl_gb.fetch_to_part(part_name, url, "{}?api_key=bench".format(url))
+            dl_gb.fsync_file(part_name)
+            os.replace(part_name, dl_name)
+            dl_gb.remove_if_exists(dl_gb.get_sidecar_name(part_name))
+
+        run("urlretrieve", fetch_legacy)
+        run("urlretrieve + hash pass", fetch_legacy_hashed)
+        old_read_size = dl_gb.g_read_size
+        for read_size in g_chunk_sizes:
+            dl_gb.g_read_size = read_size
+            run("readinto {} KiB".format(read_size // 1024), fetch_engine)
+        dl_gb.g_read_size = old_read_size
+
+################################################################################
+# Desc
+#   Drains one dl_gb.SharedQueue with g_processes processes, each in its own
+#   directory like separate hosts, plus one more that is killed after
+#   g_kill_after seconds while holding leases. Leases are shortened so the
+#   killed process' videos are taken over quickly. Every video should end up
+#   done, with only the killed process' transfers fetched twice.
+# Params
+#   None
+# Returns
+#   None
+################################################################################
+def bench_shared():
+    print("Shared queue benchmark ({} videos of {:.1f} MB, {} processes of {} workers, 1 killed after {}s)".format(
+        g_dl_count, g_video_size/1e6, g_processes, dl_gb.g_num_workers, g_kill_after))
+    fake = fake_gb_server.FakeGiantbomb(num_videos=g_dl_count, video_size=g_video_size, bandwidth=g_bandwidth)
+    with BenchEnv(fake) as env:
+        old_lease_time, old_lease_poll = dl_gb.g_lease_time, dl_gb.g_lease_poll
+        dl_gb.g_lease_time, dl_gb.g_lease_poll = 3, 0.2
+        queue_file = os.path.join(env.tmp_dir, "queue.db")
+        dl_queue = dl_gb.SharedQueue(queue_file)
+        for video_id in range(1, g_dl_count + 1):
+            dl_queue.put(*dl_gb.get_dl_pair(dl_gb_video(fake.video(video_id))))
+        dl_queue.shutdown()
+
+        context = multiprocessing.get_context("fork")
+        processes = [context.Process(target=run_shared_process, args=(queue_file, "host{}".format(k)))
+                     for k in range(g_processes + 1)]
+        start = time.perf_counter()
+        for process in processes:
+            process.start()
+        time.sleep(g_kill_after)
+        processes[-1].kill()
+        for process in processes:
+            process.join()
+        elapsed = time.perf_counter() - start
+        dl_gb.g_lease_time, dl_gb.g_lease_poll = old_lease_time, old_lease_poll
+
+        with sqlite3.connect(queue_file) as db:
+            states = dict(db.execute("SELECT state, COUNT(*) FROM videos GROUP BY state").fetchall())
+        fetched = fake.counts.get("video", 0)
+    print("{:>10} {:>10} {:>12} {:>10} {:>12}".format("done", "other", "video GETs", "seconds", "videos/hour"))
+    print("{:>10} {:>10} {:>12} {:>10.2f} {:>12.0f}".format(
+        "{}/{}".format(states.get("done", 0), g_dl_count), sum(states.values()) - states.get("done", 0),
+        fetched, elapsed, states.get("done", 0)/elapsed*3600))
+
+################################################################################
+# Desc
+#   One process of the shared benchmark: downloads from the shared queue with
+#   dl_gb's workers until it is drained
+# Params
+#   queue_file      str shared queue file
+#   host_dir        str directory to download into, made under the current one
+# Returns
+#   None
+################################################################################
+def run_shared_process(queue_file, host_dir):
+    os.mkdir(host_dir)
+    os.chdir(host_dir)
+    dl_gb.g_http = dl_gb.HttpClient()
+    with Quiet():
+        dl_dict, done_dict = dl_gb.load_progress()
+        dl_queue = dl_gb.SharedQueue(queue_file)
+        dl_queue.close()
+        workers = dl_gb.start_download_workers(dl_queue, dl_dict, done_dict)
+        dl_gb.wait_for_workers(workers, dl_queue)
+        dl_queue.shutdown()
+        dl_gb.g_journal.close()
+        done_dict.close()
+
+################################################################################
+# Desc
+#   Times load_progress, journaling a finished download for every entry, and
+#   save_progress. Compares with rewriting both progress files after every
+#   download, as was done before the journal (estimated from one rewrite).
+# Params
+#   None
+# Returns
+#   None
+################################################################################
+def bench_progress():
+    print("Progress benchmark")
+    print("{:>8} {:>10} {:>12} {:>10} {:>16}".format("videos", "load ms", "journal ms", "save ms", "rewrite-all s"))
+    for size in g_sizes:
+        with BenchEnv(None):
+            dl_dict = OrderedDict()
+            for video_id in range(size):
+                dl_dict["[2015-06-01]_[Quick Look Episode {0}]_[{0}_hd].mp4".format(video_id)] = \
+                    "https://example.com/video/{}_hd.mp4".format(video_id)
+            dl_gb.write_progress_file(dl_gb.g_dl_file, dl_dict)
+
+            start = time.perf_counter()
+            with Quiet():
+                dl_dict, done_dict = dl_gb.load_progress()
+            load_time = time.perf_counter() - start
+
+            # Finish every download, as the workers would
+            start = time.perf_counter()
+            for dl_name, dl_url in list(dl_dict.items()):
+                dl_gb.g_journal.record("done", dl_name, dl_url)
+                done_dict[dl_name] = dl_url
+                del dl_dict[dl_name]
+            journal_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            dl_gb.save_progress(dl_dict, done_dict)
+            save_time = time.perf_counter() - start
+            dl_gb.g_journal.close()
+            done_dict.close()
+
+            # One full rewrite per finished download, as before the journal
+            rewrite_time = save_time * size
+        print("{:>8} {:>10.1f} {:>12.1f} {:>10.1f} {:>16.1f}".format(
+            size, load_time*1000, journal_time*1000, save_time*1000, rewrite_time))
+
+################################################################################
+# Desc
+#   Pages through the whole catalog with an include rule for one show, with the
+#   rule sent to the API as a filter and with it only checked on each video
+# Params
+#   None
+# Returns
+#   None
+################################################################################
+def bench_filter():
+    print("Filter benchmark (include show {}, latency {}s)".format(fake_gb_server.g_shows[0], g_latency))
+    print("{:>8} {:>10} {:>10} {:>10} {:>10}".format("videos", "pushdown", "requests", "queued", "seconds"))
+    dl_gb.g_filters = {"include": [{"show_id": 1}], "exclude": []}
+    dl_gb.apply_filters()
+    api_filter = dl_gb.g_api_filter
+    for size in g_sizes:
+        for pushdown in (False, True):
+            dl_gb.g_api_filter = api_filter if pushdown else "premium:true"
+            fake = fake_gb_server.FakeGiantbomb(num_videos=size, latency=g_latency)
+            with BenchEnv(fake):
+                done_dict = dl_gb.DoneIndex(dl_gb.g_done_index_file)
+                queued = 0
+                offset = 0
+                start = time.perf_counter()
+                while True:
+                    query_dict, page_ids = dl_gb.get_dl_urls_from_api(offset, done_dict)
+                    if query_dict is None or len(page_ids) == 0:
+                        break
+                    queued += len(query_dict)
+                    offset += len(page_ids)
+                elapsed = time.perf_counter() - start
+                requests = sum(fake.counts.values())
+                done_dict.close()
+            print("{:>8} {:>10} {:>10} {:>10} {:>10.2f}".format(size, "yes" if pushdown else "no", requests, queued, elapsed))
+    dl_gb.g_filters = {"include": [], "exclude": []}
+    dl_gb.apply_filters()
+
+################################################################################
+# Desc
+#   Counts requests to find every video by crawling premium pages, resolving
+#   guids one request each (as before) and in batches with crawl_videos, then
+#   to find g_new_videos added since with crawl_videos. The one at a time crawl
+#   is skipped for catalogs over g_guid_max_videos.
+# Params
+#   None
+# Returns
+#   None
+################################################################################
+def bench_crawl():
+    print("Crawl benchmark ({} pages at once, {} new videos, latency {}s)".format(
+        dl_gb.g_crawl_pages, g_new_videos, g_latency))
+    print("{:>8} {:>14} {:>14} {:>14} {:>10} {:>14}".format(
+        "videos", "per-guid rqs", "batched rqs", "batched s", "queued", "new rqs"))
+    for size in g_sizes:
+        fake = fake_gb_server.FakeGiantbomb(num_videos=size, latency=g_latency)
+        with BenchEnv(fake):
+            guid_requests = "-"
+            if size <= g_guid_max_videos:
+                with Quiet():
+                    page_no = 1
+                    while True:
+                        url_list, guid_list = dl_gb.get_url_list_from_page(page_no)
+                        if not guid_list:
+                            break
+                        for guid in guid_list:
+                            dl_gb.get_dl_url_from_guid(guid)
+                        page_no += 1
+                guid_requests = sum(fake.counts.values())
+                fake.reset_stats()
+
+            with Quiet():
+                dl_dict, done_dict = dl_gb.load_progress()
+            start = time.perf_counter()
+            with Quiet():
+                dl_gb.crawl_videos(dl_dict, done_dict, None)
+            elapsed = time.perf_counter() - start
+            requests = sum(fake.counts.values())
+            queued = len(dl_dict)
+
+            fake.reset_stats()
+            fake.num_videos += g_new_videos
+            with Quiet():
+                dl_gb.crawl_videos(dl_dict, done_dict, None)
+            new_requests = sum(fake.counts.values())
+            dl_gb.g_journal.close()
+            done_dict.close()
+        print("{:>8} {:>14} {:>14} {:>14.2f} {:>10} {:>14}".format(
+            size, guid_requests, requests, elapsed, queued, new_requests))
+
+################################################################################
+# Desc
+#   Times the done index against the done.csv dict it replaced: converting
+#   done.csv once, opening the index at startup, and looking up videos that are
+#   done and that are not (as a query does for every video on a page)
+# Params
+#   None
+# Returns
+#   None
+################################################################################
+def bench_done():
+    print("Done index benchmark ({} lookups)".format(g_lookups))
+    print("{:>8} {:>12} {:>10} {:>10} {:>12} {:>12} {:>12}".format(
+        "videos", "convert ms", "csv ms", "open ms", "dict us", "hit us", "miss us"))
+    for size in g_sizes:
+        with BenchEnv(None):
+            done_dict = OrderedDict()
+            for video_id in range(size):
+                done_dict["[2015-06-01]_[Quick Look Episode {0}]_[{0}_hd].mp4".format(video_id)] = \
+                    "https://example.com/video/{}_hd.mp4".format(video_id)
+            dl_gb.write_progress_file(dl_gb.g_done_file, done_dict)
+
+            # Loading done.csv into a dict, as every startup used to
+            start = time.perf_counter()
+            with open(dl_gb.g_done_file, "r", encoding="utf-8") as done_file:
+                csv_dict = {row[0]: row[1] for row in dl_gb.csv.reader(done_file)}
+            csv_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            with Quiet():
+                done_index = dl_gb.DoneIndex(dl_gb.g_done_index_file)
+                dl_gb.migrate_done_file(done_index)
+            convert_time = time.perf_counter() - start
+            done_index.close()
+
+            start = time.perf_counter()
+            done_index = dl_gb.DoneIndex(dl_gb.g_done_index_file)
+            open_time = time.perf_counter() - start
+
+            names = list(csv_dict)
+            hits = [names[i % size] for i in range(g_lookups)]
+            misses = ["[2015-06-01]_[Quick Look Episode {0}]_[{0}_hd].mp4".format(size + i) for i in range(g_lookups)]
+            start = time.perf_counter()
+            for dl_name in misses:
+                dl_name in csv_dict
+            dict_time = time.perf_counter() - start
+            start = time.perf_counter()
+            for i, dl_name in enumerate(hits):
+                done_index.has(i, dl_name)
+            hit_time = time.perf_counter() - start
+            start = time.perf_counter()
+            for i, dl_name in enumerate(misses):
+                done_index.has(size + i, dl_name)
+            miss_time = time.perf_counter() - start
+            done_index.close()
+        print("{:>8} {:>12.1f} {:>10.1f} {:>10.1f} {:>12.2f} {:>12.2f} {:>12.2f}".format(
+            size, convert_time*1000, csv_time*1000, open_time*1000, dict_time/g_lookups*1e6,
+            hit_time/g_lookups*1e6, miss_time/g_lookups*1e6))
+
+################################################################################
+# Desc
+#   Compares indexing a library of videos spread over g_library_dirs
+#   directories by walking and stating all of it, as a full rescan would,
+#   against dl_gb.LibraryIndex scans: the first one, one with nothing changed,
+#   and one after a video is added to one directory
+# Params
+#   None
+# Returns
+#   None
+################################################################################
+def bench_library():
+    print("Library scan benchmark ({} directories)".format(g_library_dirs))
+    print("{:>8} {:>10} {:>12} {:>14} {:>14}".format("videos", "walk ms", "first ms", "unchanged ms", "one dir ms"))
+    for size in g_sizes:
+        with BenchEnv(None):
+            for k in range(g_library_dirs):
+                os.makedirs(os.path.join("lib", "Show {}".format(k // 10), str(2008 + k % 10)))
+            for video_id in range(size):
+                path = os.path.join("lib", "Show {}".format(video_id % g_library_dirs // 10),
+                                    str(2008 + video_id % 10), "[2015-06-01]_[Quick Look Episode {0}]_[{0}_hd].mp4".format(video_id))
+                with open(path, "wb") as out_file:
+                    out_file.write(b"\0" * 1000)
+
+            def walk():
+                for dir_path, dir_names, file_names in os.walk("lib"):
+                    for file_name in file_names:
+                        os.stat(os.path.join(dir_path, file_name))
+            walk_time = time_best(walk)
+
+            # The library fills in video ids from the done index
+            done_index = dl_gb.DoneIndex(dl_gb.g_done_index_file)
+            library = dl_gb.LibraryIndex(dl_gb.g_done_index_file)
+            roots = [("lib", True)]
+            with Quiet():
+                start = time.perf_counter()
+                library.scan(roots)
+                first_time = time.perf_counter() - start
+                unchanged_time = time_best(lambda: library.scan(roots))
+
+                def scan_one_dir():
+                    with open(os.path.join("lib", "Show 0", "2008", "new_{}.mp4".format(time.perf_counter_ns())), "wb") as out_file:
+                        out_file.write(b"\0" * 1000)
+                    library.scan(roots)
+                one_dir_time = time_best(scan_one_dir)
+            library.close()
+            done_index.close()
+        print("{:>8} {:>10.1f} {:>12.1f} {:>14.1f} {:>14.1f}".format(
+            size, walk_time*1000, first_time*1000, unchanged_time*1000, one_dir_time*1000))
+
+################################################################################
+# Desc
+#   Runs a benchmark in a temporary directory, with dl_gb pointed at a started
+#   fake server and its rate limits replaced by counters
+################################################################################
+class BenchEnv:
+    def __init__(self, fake):
+        self.fake = fake
+        self.server = None
+        self.old_dir = None
+        self.tmp_dir = None
+
+    def __enter__(self):
+        self.old_dir = os.getcwd()
+        self.tmp_dir = tempfile.mkdtemp(prefix="bench_dl_gb_")
+        os.chdir(self.tmp_dir)
+
+        if self.fake is not None:
+            self.server = fake_gb_server.start_server(self.fake)
+            dl_gb.g_gb_url = self.fake.base_url
+            dl_gb.g_api_url = self.fake.base_url + "/api"
+        dl_gb.g_api_key = "bench"
+        dl_gb.g_http = dl_gb.HttpClient()
+        dl_gb.g_api_cache = None
+        dl_gb.g_rq_limiter = CountingLimiter()
+        dl_gb.g_dl_limiter = CountingLimiter()
+        return self
+
+    def __exit__(self, *args):
+        dl_gb.g_http.close()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+        os.chdir(self.old_dir)
+        shutil.rmtree(self.tmp_dir, ignore_errors=True)
+
+################################################################################
+# Desc
+#   Stand-in for dl_gb.RateLimiter that only counts, so benchmarks never sleep
+################################################################################
+class CountingLimiter:
+    def __init__(self):
+        self.count = 0
+
+    def acquire(self):
+        self.count += 1
+
+################################################################################
+# Desc
+#   Silences stdout, for dl_gb's per-download messages
+################################################################################
+class Quiet:
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, "w")
+
+    def __exit__(self, *args):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+################################################################################
+# Desc
+#   Converts a fake server video into the dict form dl_gb parses API results to
+# Params
+#   video           dict video from FakeGiantbomb.video
+# Returns
+#   dict            video as returned by dl_gb.parse_videos
+################################################################################
+def dl_gb_video(video):
+    return {
+        "id": video["id"],
+        "name": video["name"],
+        "publish_date": video["publish_date"],
+        "show": video["video_show"]["title"],
+        "show_id": video["video_show"]["id"],
+        "hd_url": video["hd_url"],
+        "high_url": video["high_url"],
+        "low_url": video["low_url"],
+    }
+
+################################################################################
+# Desc
+#   Builds XML and JSON videos API pages with the fields dl_gb.py asks for
+# Params
+#   num_videos      int number of videos on the page
+# Returns
+#   xml_page        bytes XML response
+#   json_page       bytes JSON response
+################################################################################
+def make_api_pages(num_videos):
+    fake = fake_gb_server.FakeGiantbomb(num_videos=num_videos)
+    fields = ["id", "name", "publish_date", "video_show", "hd_url", "high_url", "low_url"]
+    videos = [{k: v for k, v in fake.video(video_id).items() if k in fields}
+              for video_id in range(1, num_videos + 1)]
+
+    xml_page = fake_gb_server.results_to_xml(videos, num_videos, 0, num_videos, True)
+    json_page = json.dumps({"error": "OK", "number_of_page_results": num_videos,
+                            "status_code": 1, "results": videos})
+    return xml_page.encode("utf-8"), json_page.encode("utf-8")
+
+################################################################################
+# Desc
+#   Times a function, returning its fastest run out of g_repeats
+# Params
+#   func            function to time, called with no arguments
+# Returns
+#   float           seconds taken by the fastest run
+################################################################################
+def time_best(func):
+    best = None
+    for k in range(g_repeats):
+        start = time.perf_counter()
+        func()
+        elapsed = time.perf_counter() - start
+        if best is None or elapsed < best:
+            best = elapsed
+    return best
+
+################################################################################
+# Desc
+#   Prints usage
+# Params
+#   None
+# Returns
+#   None
+################################################################################
+def print_usage():
+    print("Usage: bench_dl_gb.py [OPTION]...                                ")
+    print("  -b NAMES, --bench=NAMES                                        ")
+    print("      Comma separated benchmarks to run                          ")
+    print("      (default: parse,query,download,engine,shared,progress,     ")
+    print("      done,filter,crawl,library)                                 ")
+    print("  -r N, --repeats=N                                              ")
+    print("      Runs per parse measurement, the fastest is reported        ")
+    print("  -n SIZES, --sizes=SIZES                                        ")
+    print("      Comma separated catalog sizes (default: 100,...,100000)    ")
+    print("  -w N, --workers=N                                              ")
+    print("      Download workers in the download benchmark                 ")
+    print("  -s N, --segments=N                                             ")
+    print("      Segments per video in the download benchmark               ")
+    print("  --dl-count=N, --video-size=BYTES                               ")
+    print("      Videos, and bytes per video, in the download benchmarks    ")
+    print("  --processes=N                                                  ")
+    print("      Processes sharing the queue in the shared benchmark        ")
+    print("  --chunk-sizes=SIZES                                            ")
+    print("      Comma separated read sizes in the engine benchmark         ")
+    print("  --latency=SECONDS, --bandwidth=BYTES                           ")
+    print("      Fake server delay per response, and bytes/second cap       ")
+    print("  --fail-rate=P, --drop-rate=P                                   ")
+    print("      Chance of a fake 503, or of a video cut off halfway        ")
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
@@ -4,11 +4,32 @@ import re, sys, os
 import getopt
 import time
 import csv
+import errno
+import json
+import hashlib
+import heapq
+import random
+import shutil
+import signal
+import socket
+import sqlite3
+import atexit
+import cProfile
+import pstats
+import threading
 
-import urllib.request
+try:
+    import fcntl    # Locks the rate limit files across processes (POSIX only)
+except ImportError:
+    fcntl = None
+
+import ssl
+import zlib
+import http.client
+import urllib.parse
 import xml.etree.ElementTree as ET
 
-from collections import OrderedDict
+from collections import OrderedDict, deque
 
 # Downloads premium videos from Giantbomb.
 
@@ -17,32 +38,141 @@ from collections import OrderedDict
 # downloaded per day (not abiding, still testing), and a documented max request
 # rate of 200 requests per hour (abiding by this).
 
-# Edit g_skip_titles to filter out shows from download list
+# Edit g_skip_titles to filter out shows from download list, or set "filters"
+# in dl_gb.json for finer rules (see compile_filters)
 
 ################################################################################
 # Globals 
 ################################################################################
 g_gb_url = "https://www.giantbomb.com"
+g_api_url = g_gb_url + "/api"
 g_api_key = "" # To be initialized in main
 g_dl_file = "dl.csv"
-g_done_file = "done.csv"
-g_error_file = "err.csv"
-g_pbar = None
-g_start_time = time.time()
-
-g_dl_count = 0                          # Download count
-g_rq_count = 0                          # Request count
-g_query_limit = 100                     # Max amount of videos to query
+g_done_file = "done.csv"                # Old done list, converted into g_done_index_file once
+g_done_index_file = "done.db"           # Index of downloaded videos, by video id and name
+g_done_bloom = True                     # Check a Bloom filter in memory before the done index
+g_bloom_bits = 8*1024*1024              # Bloom filter size, 1 MiB for ~1% false positives at 700k videos
+g_bloom_hashes = 7                      # Bit positions set per key in the Bloom filter
+g_error_file = "err.csv"                # Failed downloads: name, url, attempts, retry time (0 if given up), error
+g_retries = {}                          # dl_name -> [attempts, retry time] of failed downloads being retried
+g_retry_max_attempts = 5                # Attempts per video before it is given up on
+g_retry_base_delay = 60                 # Seconds before the first retry, doubled for every later one
+g_retry_max_delay = 60*60               # Most seconds between retries
+g_retry_statuses = [408, 425, 429, 500, 502, 503, 504]  # HTTP statuses worth retrying
+g_sync_file = "sync.json"               # Cursor for incremental catalog syncs
+g_config_file = "dl_gb.json"            # Optional overrides of the settings in g_config_keys
+g_config_keys = ["skip_titles", "filters", "max_rq_rate", "max_dl_rate", "poll_interval", "read_size", "dl_segments",
+                 "library_dir", "library_layout", "library_link", "library_roots", "quality_deadline", "upgrade_limit", "est_throughput", "plan_workers", "plan_bandwidth", "show_priority", "min_free_space", "retry_max_attempts", "retry_base_delay", "retry_max_delay",
+                 "metrics_interval"]
+g_shared_queue_file = None              # SQLite download queue shared by processes/hosts, or None for dl.csv
+g_shared_queue_wal = True               # Use WAL in the shared queue (only for processes on one host)
+g_lease_time = 120                      # Seconds a taken video stays leased without a heartbeat
+g_lease_poll = 5                        # Seconds between checks of the shared queue when it is empty
+g_daemon = False                        # Keep running, polling for new videos every g_poll_interval
+g_poll_interval = 15*60                 # Seconds between polls for new videos in daemon mode
+g_stop = threading.Event()              # Set on SIGTERM: stop taking videos and checkpoint transfers
+g_reload = threading.Event()            # Set on SIGHUP: reload g_config_file before the next poll
+g_wake = threading.Event()              # Set on either signal, to end the wait for the next poll
+g_cache_dir = "cache"                   # On-disk cache of API responses
+g_cache_enabled = True                  # Whether API responses are cached
+g_cache_ttl = 6*60*60                   # Seconds a cached API response is used without revalidating
+g_cache_max_bytes = 64*1024*1024        # Oldest cached responses are evicted past this size
+g_api_cache = None                      # To be initialized in main
+g_journal_file = "journal.csv"          # Append-only log of queued/done/error transitions
+g_journal = None                        # To be initialized in load_progress
+g_journal_sync_every = 20               # Journal records written between fsyncs
+g_journal_compact_every = 5000          # Journal records before compacting into dl.csv/done.csv
+g_rq_times_file = "rq_times.csv"        # Timestamps of recent requests, shared by runs/workers
+g_dl_times_file = "dl_times.csv"        # Timestamps of recent downloads, shared by runs/workers
+g_progress = None                       # Shared ProgressDisplay, to be initialized in main
+g_progress_refresh = 0.5                # Seconds between progress redraws on a terminal
+g_progress_log_interval = 30            # Seconds between progress log lines when not on a terminal
+g_progress_max_lines = 10               # Most transfers shown at once on a terminal
+g_http = None                           # Shared HttpClient, to be initialized in main
+g_http_timeout = 60                     # Seconds before a stalled connect or read fails
+g_http_max_idle = 8                     # Idle keep-alive connections kept per host
+g_user_agent = "Mozilla/5.0"
+
+g_query_limit = 100                     # Videos per API page (hard limit by API)
+g_crawl = False                         # Find new videos by crawling premium pages instead of the videos API
+g_crawl_pages = 3                       # Premium pages fetched at once by the crawler
+g_api_format = "xml"                    # API response format, "xml" or "json"
+g_parse_chunk_size = 16*1024            # Bytes fed to the XML parser at a time
 g_max_dl_rate = 1000000000/(24*60*60)   # Max 100 videos per day (in videos/second)
 g_max_rq_rate = 200/(60*60)             # Max 200 requests per hour (in requests/second)
+g_dl_window = 24*60*60                  # Window over which g_max_dl_rate is enforced (in seconds)
+g_rq_window = 60*60                     # Window over which g_max_rq_rate is enforced (in seconds)
+g_dl_limiter = None                     # To be initialized in main
+g_rq_limiter = None                     # To be initialized in main
+g_num_workers = 1                       # Number of concurrent download workers
+g_dl_segments = 1                       # Number of byte ranges fetched at once per video
+g_segment_min_size = 16*1024*1024       # Files smaller than this are always fetched in one stream
+g_read_size = 4*1024*1024               # Bytes read per chunk in downloads, into a buffer reused for the whole segment
+g_preallocate = True                    # Reserve the whole file on disk before downloading, when its size is known
+g_fsync = True                          # fsync a finished download once, before it is renamed into place
+g_sidecar_save_interval = 5             # Seconds between .part sidecar checkpoints
+g_hash_block_size = 4*1024*1024         # Downloads are hashed in blocks of this size as they are written
+g_post_workers = 2                      # Workers verifying, hashing and filing finished downloads
+g_checksum_file = "checksums.csv"       # Finished downloads: path, size, checksum (see get_checksum)
+g_library_dir = None                    # Library to file finished downloads into, or None to leave them here
+g_library_layout = "{show}/{year}/{name}"  # Path of a video in the library
+g_library_link = False                  # Hardlink into the library and keep the file here, instead of moving it
+g_library_roots = []                    # More directories of videos to index, besides g_library_dir and the working directory
+g_library = None                        # LibraryIndex of videos on disk, to be initialized in main
+g_scan_workers = 8                      # Threads scanning library directories
+g_partial_hash_size = 64*1024           # Bytes hashed from each end of a video to tell it apart
+g_post_queue = None                     # PostQueue of finished downloads, see start_download_workers
+g_post_threads = []                     # Post-processing worker threads
+g_size_file = "sizes.csv"               # Cached video sizes (from HEAD/Content-Length), by url
+g_sizes = None                          # Shared SizeCache, to be initialized in main
+g_size_probe_limit = 50                 # Most HEAD requests spent per run finding unknown sizes
+g_size_estimate = 1024*1024*1024        # Bytes assumed for a video of unknown size, until some are known
+g_scheduler = None                      # Shared Scheduler, or None to download in catalog order
+g_schedule_policies = ["fifo"]          # Download order: fifo, shortest, newest, oldest and/or show
+g_show_priority = []                    # Shows to download first, in order, matched against video names
+g_dl_windows = []                       # (start, end) minute of day local time downloads may start in, empty for any time
+g_est_throughput = 2*1024*1024          # Bytes/second assumed per download, until one has been measured
+g_disk_budget = None                    # Max bytes downloaded per run, or None for no limit
+g_qualities = ["hd", "high", "low"]     # Video qualities, best first
+g_quality_deadline = None               # Days the download queue should be cleared in, lowering quality to fit, or None to always take the best
+g_quality_ratios = {"hd": 1.0, "high": 0.5, "low": 0.25}  # Rough size of each quality relative to hd, for estimates
+g_quality_urls = {}                     # Url of each quality of queued videos that have a choice, by dl_name
+g_fetch_qualities = {}                  # Quality being downloaded of videos taken below their best, by dl_name
+g_upgrade_limit = 20                    # Most videos downloaded below their best quality queued again at it, per run or poll
+g_upgrade_count = 0                     # Upgrades queued this run or poll
+g_upgrades = set()                      # Names of done videos queued to be upgraded to their best quality
+g_min_free_space = 1024*1024*1024       # Bytes always left free on the download disk
+g_plan = False                          # Simulate downloading the queue instead of downloading it (see plan_downloads)
+g_plan_workers = [1, 2, 4, 8]           # Worker counts compared by plans, besides g_num_workers
+g_plan_bandwidth = None                 # Bytes/second of the whole link in plans, or None for g_est_throughput per download however many run
+g_metrics = None                        # Shared Metrics, to be initialized in main
+g_metrics_export = False                # Whether metrics are written to the files below during the run
+g_metrics_prom_file = "metrics.prom"    # Prometheus textfile collector output
+g_metrics_json_file = "stats.json"      # JSON stats output
+g_metrics_interval = 15                 # Seconds between metrics file updates
+g_profile_file = None                   # cProfile stats output, or None to not profile
+g_profiles = []                         # cProfile.Profile of every profiled thread
+
+# Locks shared by download workers
+g_progress_lock = threading.Lock()      # Guards dl_dict, done_dict and the progress files
+g_size_lock = threading.Lock()          # Guards g_sizes and the scheduler's throughput
+g_checksum_lock = threading.Lock()      # Guards g_checksum_file
 
 # Skip queuing these titles for download
 g_skip_titles = ["Giant Bombcast", "The Giant Beastcast"]
 
+# Include/exclude rules for queried videos, usually set in g_config_file (see compile_filters)
+g_filters = {"include": [], "exclude": []}
+g_api_filter = "premium:true"           # API filter parameter, including the rules the API can apply
+g_video_filter = None                   # Compiled predicate for every rule, applied while parsing
+g_filter_key = None                     # Identifies the rules in the sync cursor, to notice changes
+
 # Regex patterns
 g_premium_page_pattern = re.compile("\s+<a href=\"(?P<url>/(?:shows|videos)/[/\-\w\d]+/(?P<guid>\d{2,6}\-\d{2,6})).*")
 g_dl_url_pattern = None
 g_publish_date_pattern = re.compile("([\d-]+) [\d:]+")
+g_dl_name_date_pattern = re.compile(r"\[(\d{4}-\d{2}-\d{2})\]")
+g_date_pattern = re.compile(r"\d{4}-\d{2}-\d{2}")
 g_video_dl_name_pattern = re.compile(".*/(.*)\.mp4\s*")
 
 ################################################################################
@@ -52,15 +182,16 @@ def main(argv):
     # Init variables
     query_mode = True           # Queries for video download links
     download_mode = True        # Downloads videos
+    full_sync = False           # Pages through the whole catalog, not just new videos
     dl_dict = OrderedDict()     # Dictionary of all the videos to download
     query_dict = OrderedDict()  # Temp dictionary to query videos to download
-    done_dict = {}              # Dictionary of all videos already downloaded
+    done_dict = None            # Index of all videos already downloaded
 
     # Init api key
     try:
         global g_api_key
         with open("api_key.txt", "r") as api_file:
-            g_api_key = api_file.read()
+            g_api_key = api_file.read().strip()
         if g_api_key == "":
             print("ERROR: Invalid API key from api_key.txt! Please paste your valid API key in there. Exiting...")
             return 1
@@ -68,14 +199,49 @@ def main(argv):
         print("ERROR: Missing api_key.txt! Please create this file with only you API key in it. Exiting...")
         return 1
 
+    # Init shared HTTP client
+    global g_http
+    g_http = HttpClient()
+
+    # Load settings from the config file, before the command line overrides them
+    load_config()
+    if not apply_filters():
+        print("ERROR: Invalid filters in {}. Exiting...".format(g_config_file))
+        return 1
+
+    # Init rate limiters
+    global g_rq_limiter
+    global g_dl_limiter
+    g_rq_limiter = RateLimiter("Requests", round(g_max_rq_rate*g_rq_window), g_rq_window, g_rq_times_file)
+    g_dl_limiter = RateLimiter("Videos downloaded", round(g_max_dl_rate*g_dl_window), g_dl_window, g_dl_times_file)
+
     # Init regex pattern
     global g_dl_url_pattern
     g_dl_url_pattern = re.compile("\s+<a href=\"(.*mp4\?api_key={})\"".format(g_api_key))
 
     # Parse arguments
+    global g_num_workers
+    global g_dl_segments
+    global g_api_format
+    global g_cache_enabled
+    global g_metrics_export
+    global g_profile_file
+    global g_read_size
+    global g_schedule_policies
+    global g_disk_budget
+    global g_quality_deadline
+    global g_plan
+    global g_daemon
+    global g_shared_queue_file
+    global g_crawl
+    global g_library_dir
+    global g_library_link
     if len(sys.argv) != 0:
         try:
-            opts, args = getopt.getopt(argv, "hqd", ["query", "download"])
+            opts, args = getopt.getopt(argv, "hqdfw:s:", ["query", "download", "full", "workers=", "segments=", "json", "no-cache",
+                                                       "metrics", "profile=", "chunk-size=", "order=", "window=",
+                                                       "disk-budget=", "deadline=", "plan", "daemon", "shared-queue=", "crawl",
+                                                       "library=", "link"])
         except getopt.GetoptError:
             print_usage()
             sys.exit(2)
@@ -92,504 +258,4137 @@ def main(argv):
                 print("Download mode enabled; query mode disabled")
                 download_mode = True
                 query_mode = False
+            elif opt in ('-f', '--full'):
+                print("Full sync enabled, ignoring {}".format(g_sync_file))
+                full_sync = True
+            elif opt == '--library':
+                print("Filing finished videos into {}".format(arg))
+                g_library_dir = arg
+            elif opt == '--link':
+                print("Hardlinking finished videos into the library")
+                g_library_link = True
+            elif opt == '--crawl':
+                print("Crawling premium pages for new videos")
+                g_crawl = True
+            elif opt == '--plan':
+                print("Plan mode enabled, simulating the download of {} instead".format(g_dl_file))
+                g_plan = True
+            elif opt == '--daemon':
+                print("Daemon mode enabled, polling for new videos every {}s".format(g_poll_interval))
+                g_daemon = True
+            elif opt == '--shared-queue':
+                print("Sharing the download queue in {}".format(arg))
+                g_shared_queue_file = arg
+            elif opt == '--metrics':
+                print("Writing metrics to {} and {} every {}s".format(g_metrics_prom_file, g_metrics_json_file, g_metrics_interval))
+                g_metrics_export = True
+            elif opt == '--profile':
+                print("Profiling to {}".format(arg))
+                g_profile_file = arg
+            elif opt == '--no-cache':
+                print("API response cache disabled")
+                g_cache_enabled = False
+            elif opt == '--json':
+                print("Using JSON API responses")
+                g_api_format = "json"
+            elif opt in ('-w', '--workers'):
+                try:
+                    g_num_workers = int(arg)
+                    if g_num_workers < 1:
+                        raise ValueError
+                except ValueError:
+                    print("ERROR: Invalid worker count {}! Must be a positive integer.".format(arg))
+                    print_usage()
+                    sys.exit(2)
+                print("Using {} download workers".format(g_num_workers))
+            elif opt in ('-s', '--segments'):
+                try:
+                    g_dl_segments = int(arg)
+                    if g_dl_segments < 1:
+                        raise ValueError
+                except ValueError:
+                    print("ERROR: Invalid segment count {}! Must be a positive integer.".format(arg))
+                    print_usage()
+                    sys.exit(2)
+                print("Downloading each video in up to {} segments".format(g_dl_segments))
+            elif opt == '--chunk-size':
+                try:
+                    g_read_size = int(arg)
+                    if g_read_size < 1:
+                        raise ValueError
+                except ValueError:
+                    print("ERROR: Invalid chunk size {}! Must be a positive integer.".format(arg))
+                    print_usage()
+                    sys.exit(2)
+                print("Reading downloads in chunks of {} bytes".format(g_read_size))
+            elif opt == '--order':
+                g_schedule_policies = arg.split(",")
+                for policy in g_schedule_policies:
+                    if policy not in Scheduler.all_policies:
+                        print("ERROR: Invalid order {}! Must be one of {}.".format(policy, ", ".join(Scheduler.all_policies)))
+                        print_usage()
+                        sys.exit(2)
+                print("Downloading in {} order".format(arg))
+            elif opt == '--window':
+                window = parse_window(arg)
+                if window is None:
+                    print("ERROR: Invalid window {}! Must be like 01:00-07:30.".format(arg))
+                    print_usage()
+                    sys.exit(2)
+                g_dl_windows.append(window)
+                print("Starting downloads between {}".format(arg))
+            elif opt == '--disk-budget':
+                try:
+                    g_disk_budget = int(float(arg) * 1024**3)
+                    if g_disk_budget < 0:
+                        raise ValueError
+                except ValueError:
+                    print("ERROR: Invalid disk budget {}! Must be a positive number of GiB.".format(arg))
+                    print_usage()
+                    sys.exit(2)
+                print("Downloading at most {} GiB this run".format(arg))
+            elif opt == '--deadline':
+                try:
+                    g_quality_deadline = float(arg)
+                    if g_quality_deadline <= 0:
+                        raise ValueError
+                except ValueError:
+                    print("ERROR: Invalid deadline {}! Must be a positive number of days.".format(arg))
+                    print_usage()
+                    sys.exit(2)
+                print("Lowering video quality as needed to clear the queue within {} days".format(arg))
 
-    # Helper function to get first item in an ordered dictionary
-    def get_first_pair(d):
-        return next(iter(d.items()))
+    # Plan mode only simulates, so nothing else is needed
+    if g_plan:
+        return plan_downloads()
 
-    # Load any previous progress
-    dl_dict, done_dict = load_progress()
+    # Init progress display
+    global g_progress
+    g_progress = ProgressDisplay(sys.stdout)
+    g_progress.start()
+    atexit.register(g_progress.stop)
+
+    # Init metrics and profiling
+    global g_metrics
+    g_metrics = Metrics()
+    if g_metrics_export:
+        g_metrics.start_exporter()
+    profile = start_profile()
+
+    # Init API response cache
+    global g_api_cache
+    if g_cache_enabled:
+        g_api_cache = ApiCache(g_cache_dir)
+
+    # Load any previous progress, and failed downloads still worth retrying
+    with timed("load_progress"):
+        dl_dict, done_dict = load_progress()
+        load_retries(dl_dict, done_dict)
+
+    # Index videos already on disk, rescanning only directories that changed
+    global g_library
+    g_library = LibraryIndex(g_done_index_file)
+    with timed("scan_library"):
+        g_library.scan(get_library_roots())
+
+    # Init download scheduling, finding sizes of queued videos if it needs them
+    global g_sizes
+    global g_scheduler
+    g_sizes = SizeCache(g_size_file)
+    g_scheduler = make_scheduler()
+    if g_scheduler is not None and download_mode and g_scheduler.needs_sizes():
+        probe_sizes(dl_dict)
+
+    # Start the download workers first, so they can consume videos while the
+    # query is still paging through the API
+    if g_shared_queue_file is not None:
+        # The shared queue takes the place of dl.csv, so move its videos over
+        if g_scheduler is not None:
+            print("WARN: The shared queue is taken in catalog order, ignoring --order, --window and --disk-budget")
+        dl_queue = SharedQueue(g_shared_queue_file)
+
+        # Keep the rate limit state next to the queue, so every process shares it
+        queue_dir = os.path.dirname(os.path.abspath(g_shared_queue_file))
+        g_rq_limiter.state_file = os.path.join(queue_dir, g_rq_times_file)
+        g_dl_limiter.state_file = os.path.join(queue_dir, g_dl_times_file)
+        with g_progress_lock:
+            dl_queue.add_done(done_dict.items())
+            for dl_name, dl_url in dl_dict.items():
+                dl_queue.put(dl_name, dl_url, get_retry_wait(dl_name))
+            dl_dict.clear()
+            save_progress(dl_dict, done_dict)
+    else:
+        dl_queue = DownloadQueue(g_scheduler)
+    workers = []
+    if download_mode:
+        for dl_name, dl_url in dl_dict.items():
+            dl_queue.put(dl_name, dl_url, get_retry_wait(dl_name))
+        workers = start_download_workers(dl_queue, dl_dict, done_dict)
+
+    # Query results feed the queue if there are workers, or it is shared
+    feed_queue = dl_queue if download_mode or g_shared_queue_file is not None else None
+
+    # Stop cleanly on SIGTERM, and reload the config on SIGHUP
+    signal.signal(signal.SIGTERM, handle_signal)
+    if hasattr(signal, "SIGHUP"):
+        signal.signal(signal.SIGHUP, handle_signal)
 
     # Query mode
-    if query_mode:
+    if g_daemon:
+        run_daemon(dl_dict, done_dict, feed_queue, query_mode, full_sync)
+    elif query_mode:
         # Query from API all premium videos
         print("Querying premium videos from API...")
-        offset = 0
-        
-        while True:
-            query_dict = get_dl_urls_from_api(offset, done_dict)
-            if len(query_dict) == 0:
-                break
-            dl_dict.update(query_dict)
-
-            # Write to progress files
-            save_progress(dl_dict, done_dict)
-            offset += g_query_limit
+        query_videos(dl_dict, done_dict, feed_queue, full_sync)
 
-    # Download mode
+    # Download mode, upgrading videos taken below their best quality if there
+    # is time to spare
     if download_mode:
-        # For each video to download...
-        while len(dl_dict) > 0:
-
-            # Download video (FIFO) and cut it from list
-            dl_name, dl_url = get_first_pair(dl_dict)
-            if download_video(dl_name, dl_url):
-                done_dict[dl_name] = dl_url
-                del dl_dict[dl_name]
-            else:
-                # If download fails, put it in error progress file
-                with open(g_error_file, "a", encoding="utf-8") as err_file:
-                    err_file.write("\"{}\",\"{}\"\n".format(dl_name, dl_url))
-                del dl_dict[dl_name]
+        queue_upgrades(done_dict, dl_queue)
+    dl_queue.close()
+    if download_mode:
+        wait_for_workers(workers, dl_queue)
+    if g_shared_queue_file is not None:
+        dl_queue.shutdown()
 
-            # Once video is done downloading, update the progress files
-            save_progress(dl_dict, done_dict)
+    # Fold the journal into the progress files
+    with g_progress_lock:
+        save_progress(dl_dict, done_dict)
+        g_journal.close()
+        done_dict.close()
+        g_library.close()
 
+    # Write final metrics and profile
+    g_progress.stop()
+    g_metrics.stop_exporter()
+    if g_metrics_export:
+        g_metrics.write()
+    finish_profile(profile)
+
+    if download_mode:
         # Delete empty dl progress file
-        print("Done downloading all videos! Deleting {}...".format(g_dl_file))
-        os.remove(g_dl_file)
+        if len(dl_dict) == 0:
+            print("Done downloading all videos! Deleting {}...".format(g_dl_file))
+            os.remove(g_dl_file)
 
     sys.exit(0)
 
 ################################################################################
 # Desc
-#   Gets video urls and guids from premium page. Currently unused.
+#   Daemon mode loop. Polls the API for new videos every g_poll_interval
+#   seconds, while the download workers take them from dl_queue as they are
+#   found. Progress is saved after every poll. Returns once SIGTERM is
+#   received; SIGHUP reloads g_config_file before the next poll.
 # Params
-#   page_no     int page number to grab urls/guids from
+#   dl_dict         dict of videos to download
+#   done_dict       dict of videos already downloaded
+#   dl_queue        DownloadQueue to feed, or None in query mode only
+#   query_mode      bool whether to poll for new videos
+#   full_sync       bool page through the whole catalog on the first poll
 # Returns
-#   url_list    str list of video urls
-#   guid_list   str list of video guids
+#   None
 ################################################################################
-def get_url_list_from_page(page_no):
-    print("Searching for premium URLs on page {}...".format(page_no))
+def run_daemon(dl_dict, done_dict, dl_queue, query_mode, full_sync):
+    global g_upgrade_count
+    while not g_stop.is_set():
+        if g_reload.is_set():
+            g_reload.clear()
+            print("Reloading {}...".format(g_config_file))
+            load_config()
+            if not apply_filters():
+                print("WARN: Invalid filters in {}, keeping the old ones".format(g_config_file))
+            g_rq_limiter.max_count = max(1, round(g_max_rq_rate*g_rq_window))
+            g_dl_limiter.max_count = max(1, round(g_max_dl_rate*g_dl_window))
+            if g_scheduler is not None:
+                g_scheduler.deadline = g_quality_deadline
 
-    premium_url = g_gb_url + "/videos/premium/?page={0}".format(page_no)
-    opener = urllib.request.build_opener()
-    opener.addheaders = [('User-Agent', 'Mozilla/5.0')]
-    try:
-        response = opener.open(premium_url)
-        page_html = response.read().decode('utf-8')
-        inc_and_check_rq_rate()
-    except Exception as e:
-        print(e)
-        print("ERROR: Exception occurred during premium page {0} url fetch!".format(page_no))
-        return None, None
+        if query_mode:
+            g_library.scan(get_library_roots())
+            print("Querying premium videos from API...")
+            query_videos(dl_dict, done_dict, dl_queue, full_sync)
+            full_sync = False
+            with g_progress_lock:
+                save_progress(dl_dict, done_dict)
+        if dl_queue is not None:
+            g_upgrade_count = 0
+            queue_upgrades(done_dict, dl_queue)
 
-    url_list = []
-    guid_list = []
-    page_html_lines = page_html.split('\n')
-    for line in page_html_lines:
-        match = g_premium_page_pattern.search(line)
-        if match:
-            premium_url = g_gb_url + match.group("url")
-            guid = match.group("guid")
-            url_list.append(premium_url)
-            guid_list.append(guid)
-            print("    {}\t{}".format(premium_url, guid))
+        # Sleep until the next poll, or until a signal arrives
+        print("Next poll in {}s".format(g_poll_interval))
+        g_wake.wait(g_poll_interval)
+        g_wake.clear()
 
-    print("Found {} matches on page {}!".format(len(url_list), page_no))
+################################################################################
+# Desc
+#   Signal handler. SIGTERM stops the run: no more videos are started, and
+#   transfers stop at their next chunk with their progress saved, so they are
+#   resumed next run. SIGHUP asks daemon mode to reload g_config_file.
+# Params
+#   signum          int signal received
+#   frame           current stack frame
+# Returns
+#   None
+################################################################################
+def handle_signal(signum, frame):
+    if signum == signal.SIGTERM:
+        g_stop.set()
+    else:
+        g_reload.set()
+    g_wake.set()
 
-    return url_list, guid_list
+################################################################################
+# Desc
+#   Loads settings from g_config_file, a JSON object of g_config_keys names
+#   (without the g_ prefix) and values. A missing file is fine.
+# Params
+#   None
+# Returns
+#   None
+################################################################################
+def load_config():
+    try:
+        with open(g_config_file, "r", encoding="utf-8") as config_file:
+            config = json.load(config_file)
+    except FileNotFoundError:
+        return
+    except ValueError as e:
+        print(e)
+        print("ERROR: Invalid JSON in {}, ignoring it".format(g_config_file))
+        return
+
+    for key, value in config.items():
+        if key not in g_config_keys:
+            print("WARN: Unknown setting {} in {}, ignoring it".format(key, g_config_file))
+            continue
+        globals()["g_{}".format(key)] = value
 
 ################################################################################
 # Desc
-#   Gets download urls and forms download name from videos API call.
-#   All-in-one step vs calling get_url_list_from_page and get_dl_url_from_guid.
+#   Compiles g_filters and g_skip_titles into g_api_filter and g_video_filter.
+#   On invalid rules the old filters are kept.
 # Params
-#   offset          int changes which set of videos are queried by API
-#   done_dict       dict of completed downloads (dl_name, dl_url)
+#   None
 # Returns
-#   query_dict      dict of videos gathered from query (dl_name, dl_url)
+#   bool            True if the rules were valid
 ################################################################################
-def get_dl_urls_from_api(offset, done_dict):
-    global g_api_key
-    filter = "premium:true"
-    limit = 100 # Hard limit by API
-    sort = "id:asc"
-    field_list = ["name", "publish_date", "video_show", "hd_url", "high_url", "low_url"]
-    
-    # Query list of premium videos from API
-    xml_url = "https://www.giantbomb.com/api/videos/?api_key={}&offset={}&filter={}&limit={}&sort={}&field_list={}".format(g_api_key, offset, filter, limit, sort, ','.join(field_list))
-    opener = urllib.request.build_opener()
-    opener.addheaders = [('User-Agent', 'Mozilla/5.0')]
+def apply_filters():
+    global g_api_filter
+    global g_video_filter
+    global g_filter_key
     try:
-        response = opener.open(xml_url)
-        xml = response.read().decode('utf-8')
-        inc_and_check_rq_rate()
-    except Exception as e:
+        api_filter, video_filter = compile_filters(g_filters, g_skip_titles)
+    except (ValueError, TypeError, AttributeError, re.error) as e:
         print(e)
-        print("ERROR: Exception occurred during videos (offset {}) fetch!".format(offset))
-        return None, None
+        return False
+    g_api_filter = api_filter
+    g_video_filter = video_filter
+    g_filter_key = json.dumps([g_filters, g_skip_titles], sort_keys=True)
+    return True
 
-    # Parse xml to find...
-    #   <name>
-    #   <publish_date>
-    #   <video_show> --> <title>
-    #   <hd_url>
-    #   <high_url>
-    #   <low_url>
-    dl_url = ""
-    dl_name = ""
-    date = None
-    raw_name = None
+################################################################################
+# Desc
+#   Compiles include/exclude rules for queried videos. A video is queued if it
+#   matches any include rule (or there are none), and no exclude rule. A rule
+#   is a dict of conditions that must all hold:
+#     show      str or list of show titles
+#     show_id   int or list of show ids (the API's video_show ids)
+#     after     str "YYYY-MM-DD", published on or after this day
+#     before    str "YYYY-MM-DD", published on or before this day
+#     name      str regex searched for in the video name
+#     quality   str or list of "hd", "high" and "low", any of them available
+#   e.g. {"include": [{"show_id": 3, "after": "2014-01-01"}],
+#         "exclude": [{"name": "(?i)trailer"}]}
+#
+#   With a single include rule, its show_id (if only one) and dates are also
+#   sent as API filters, so the pages only hold videos that can match. Every
+#   rule is still checked on each parsed video.
+# Params
+#   filters         dict with lists "include" and "exclude" of rules
+#   skip_titles     list of show titles to exclude
+# Returns
+#   api_filter      str API filter parameter
+#   video_filter    function(video) -> bool whether to queue the video
+################################################################################
+def compile_filters(filters, skip_titles):
+    unknown = set(filters) - {"include", "exclude"}
+    if unknown:
+        raise ValueError("Unknown filter lists {}".format(", ".join(sorted(unknown))))
+    includes = [compile_rule(rule) for rule in filters.get("include", [])]
+    excludes = [compile_rule(rule) for rule in filters.get("exclude", [])]
+    if skip_titles:
+        excludes.append(compile_rule({"show": skip_titles}))
 
-    root = ET.fromstring(xml)
-    videos = root.findall('./results/video')
-    
-    # Gather data for each video
-    query_dict = OrderedDict()
-    for video in videos:
-        pretty_name = video.find('./name')
-        date_time = video.find('./publish_date')
-        title = video.find('./video_show/title')
-        hd_url = video.find('./hd_url')
-        high_url = video.find('./high_url')
-        low_url = video.find('./low_url')
-
-        # Check for skip title
-        if title is not None:
-            if title.text in g_skip_titles:
-                continue
+    def video_filter(video):
+        if includes and not any(rule(video) for rule in includes):
+            return False
+        return not any(rule(video) for rule in excludes)
 
-        # Find highest quality download link
-        if hd_url is not None and hd_url.text:
-            dl_url = hd_url.text
-        elif high_url is not None and high_url.text:
-            dl_url = high_url.text
-        elif low_url is not None and low_url.text:
-            dl_url = low_url.text
-        else:
-            print("ERROR: Could not find valid download link from video!")
-            return None, None
+    # Push down what the API can express. It ANDs its filters, so only a single
+    # include rule can be sent.
+    api_filters = ["premium:true"]
+    if len(filters.get("include", [])) == 1:
+        rule = filters["include"][0]
+        show_ids = get_rule_list(rule, "show_id")
+        if show_ids is not None and len(show_ids) == 1:
+            api_filters.append("video_show:{}".format(int(show_ids[0])))
+        if "after" in rule or "before" in rule:
+            api_filters.append("publish_date:{} 00:00:00|{} 23:59:59".format(rule.get("after", "1970-01-01"),
+                                                                            rule.get("before", "9999-12-31")))
+    return ",".join(api_filters), video_filter
 
-        # Strip down date_time to just date
-        if date_time is not None:
-            match = g_publish_date_pattern.search(date_time.text)
-            if match:
-                date = match.group(1)
-            else:
-                print("WARN: Could not get date from <publish_date> field!")
-        else:
-            print("WARN: No <publish_date> field found!")
+################################################################################
+# Desc
+#   Compiles one filter rule (see compile_filters) into a predicate
+# Params
+#   rule            dict of conditions
+# Returns
+#   function(video) -> bool whether the video meets every condition
+################################################################################
+def compile_rule(rule):
+    checks = []
+    unknown = set(rule) - {"show", "show_id", "after", "before", "name", "quality"}
+    if unknown:
+        raise ValueError("Unknown filter conditions {}".format(", ".join(sorted(unknown))))
 
-        # Get raw name from hd/high/low_url
-        match = g_video_dl_name_pattern.search(dl_url)
-        if match:
-            raw_name = match.group(1)
-        else:
-            print("WARN: Could not get raw name from <hd_url>/<high_url>/<low_url> field!")
-
-        # Assemble the name of the download: {date}_{pretty_name}_{raw_name}.mp4
-        if date:
-            dl_name = "[{}]".format(date)
-        if pretty_name is not None:
-            # Remove any invalid characters
-            invalid_chars = "<>:\"/\\|?*"
-            clean_pretty_name = "".join(x for x in pretty_name.text if x not in invalid_chars)
-            dl_name = "{}_[{}]".format(dl_name, clean_pretty_name)
-        if raw_name:
-            dl_name = "{}_[{}].mp4".format(dl_name, raw_name)
-        else:
-            dl_name = "{}.mp4".format(dl_name)
+    shows = get_rule_list(rule, "show")
+    if shows is not None:
+        shows = frozenset(shows)
+        checks.append(lambda video: video["show"] in shows)
+    show_ids = get_rule_list(rule, "show_id")
+    if show_ids is not None:
+        show_ids = frozenset(int(show_id) for show_id in show_ids)
+        checks.append(lambda video: video["show_id"] in show_ids)
+    for key in ("after", "before"):
+        if key in rule:
+            if not g_date_pattern.fullmatch(rule[key]):
+                raise ValueError("Filter date {} is not YYYY-MM-DD".format(rule[key]))
+    after = rule.get("after")
+    if after is not None:
+        checks.append(lambda video: video["publish_date"] is not None and video["publish_date"][:10] >= after)
+    before = rule.get("before")
+    if before is not None:
+        checks.append(lambda video: video["publish_date"] is not None and video["publish_date"][:10] <= before)
+    if "name" in rule:
+        name_pattern = re.compile(rule["name"])
+        checks.append(lambda video: video["name"] is not None and name_pattern.search(video["name"]) is not None)
+    qualities = get_rule_list(rule, "quality")
+    if qualities is not None:
+        for quality in qualities:
+            if quality not in ("hd", "high", "low"):
+                raise ValueError("Unknown filter quality {}".format(quality))
+        url_keys = ["{}_url".format(quality) for quality in qualities]
+        checks.append(lambda video: any(video[url_key] for url_key in url_keys))
 
-        if dl_name not in done_dict:
-            query_dict[dl_name] = dl_url
+    if len(checks) == 1:
+        return checks[0]
+    return lambda video: all(check(video) for check in checks)
 
-    return query_dict
+# Gets a rule condition that may be a single value or a list, as a list
+def get_rule_list(rule, key):
+    if key not in rule:
+        return None
+    value = rule[key]
+    return value if isinstance(value, list) else [value]
 
 ################################################################################
 # Desc
-#   Gets download url from guid, and what to name it
+#   Queries the API for premium videos, page by page, and logs new ones to
+#   dl_dict. If dl_queue is given, new videos are also queued for the download
+#   workers as soon as their page is parsed.
+#
+#   The first sync pages through the whole catalog in ascending id order, saving
+#   its offset after every page so a crash resumes where it left off. Once that
+#   is complete, later syncs page in descending id order and stop at the first
+#   page that reaches the highest id seen before, so only new videos cost
+#   requests.
 # Params
-#   guid        str guid for video to get
+#   dl_dict         dict of videos to download
+#   done_dict       dict of videos already downloaded
+#   dl_queue        DownloadQueue to feed, or None in query mode only
+#   full            bool ignore the sync cursor and page through everything
 # Returns
-#   dl_name     str download name
-#   dl_url      str download url
+#   None
 ################################################################################
-def get_dl_url_from_guid(guid):
-    global g_api_key
-    field_list = ["name", "publish_date", "hd_url", "high_url", "low_url"]
-
-    # Query xml from website
-    xml_url = "https://www.giantbomb.com/api/video/{}/?api_key={}&field_list={}".format(guid, g_api_key, ','.join(field_list))    
-    opener = urllib.request.build_opener()
-    opener.addheaders = [('User-Agent', 'Mozilla/5.0')]
-    try:
-        response = opener.open(xml_url)
-        xml = response.read().decode('utf-8')
-        inc_and_check_rq_rate()
-    except Exception as e:
-        print(e)
-        print("ERROR: Exception occurred during XML guid {} fetch!".format(guid))
-        return None, None
-
-    # Parse xml to find...
-    #   <name>
-    #   <publish_date>
-    #   <hd_url>
-    #   <high_url>
-    #   <low_url>
-    dl_url = ""
-    dl_name = ""
-    date = None
-    raw_name = None
+def query_videos(dl_dict, done_dict, dl_queue, full=False):
+    if g_crawl:
+        crawl_videos(dl_dict, done_dict, dl_queue, full)
+        return
 
-    root = ET.fromstring(xml)
-    pretty_name = root.find('./results/name')
-    date_time = root.find('./results/publish_date')
-    hd_url = root.find('./results/hd_url')
-    high_url = root.find('./results/high_url')
-    low_url = root.find('./results/low_url')
-    
-    # Find highest quality download link
-    if hd_url is not None and hd_url.text:
-        dl_url = hd_url.text
-    elif high_url is not None and high_url.text:
-        dl_url = high_url.text
-    elif low_url is not None and low_url.text:
-        dl_url = low_url.text
-    else:
-        print("ERROR: Could not find valid download link from guid {}".format(guid))
-        return None, None
+    cursor = load_sync_cursor()
+    if full:
+        cursor.update(offset=0, complete=False)
+    elif cursor.get("filter", g_filter_key) != g_filter_key:
+        # Offsets depend on the API filter, and videos skipped before may match now
+        print("Filters changed since the last sync, running a full sync...")
+        cursor.update(offset=0, complete=False)
+    cursor["filter"] = g_filter_key
 
-    # Strip down date_time to just date
-    if date_time is not None:
-        match = g_publish_date_pattern.search(date_time.text)
-        if match:
-            date = match.group(1)
-        else:
-            print("WARN: Could not get date from <publish_date> field!")
-    else:
-        print("WARN: No <publish_date> field found!")
+    if not cursor["complete"]:
+        # Full sync, oldest first
+        offset = cursor["offset"]
+        if offset > 0:
+            print("Resuming full sync at offset {}...".format(offset))
+        while True:
+            with timed("get_dl_urls_from_api"):
+                query_dict, page_ids = get_dl_urls_from_api(offset, done_dict, "id:asc")
+            if query_dict is None:
+                print("WARN: Full sync stopped at offset {}, will resume from there next run".format(offset))
+                return
+            if len(page_ids) == 0:
+                break
+            queue_videos(query_dict, dl_dict, done_dict, dl_queue)
 
-    # Get raw name from hd/high/low_url
-    match = g_video_dl_name_pattern.search(dl_url)
-    if match:
-        raw_name = match.group(1)
-    else:
-        print("WARN: Could not get raw name from <hd_url>/<high_url>/<low_url> field!")
+            offset += len(page_ids)
+            cursor["offset"] = offset
+            cursor["max_id"] = max([cursor["max_id"]] + page_ids)
+            save_sync_cursor(cursor)
+            if g_stop.is_set():
+                print("Full sync stopped at offset {}, will resume from there next run".format(offset))
+                return
 
-    # Assemble the name of the download: {date}_{pretty_name}_{raw_name}.mp4
-    if date:
-        dl_name = "[{}]".format(date)
-    if pretty_name is not None:
-        dl_name = "{}_[{}]".format(dl_name, pretty_name.text)
-    if raw_name:
-        dl_name = "{}_[{}].mp4".format(dl_name, raw_name)
+        cursor["complete"] = True
+        save_sync_cursor(cursor)
     else:
-        dl_name = "{}.mp4".format(dl_name)
+        # Incremental sync, newest first, until reaching known videos
+        print("Syncing videos newer than id {}...".format(cursor["max_id"]))
+        offset = 0
+        max_id = cursor["max_id"]
+        while True:
+            with timed("get_dl_urls_from_api"):
+                query_dict, page_ids = get_dl_urls_from_api(offset, done_dict, "id:desc", cursor["max_id"])
+            if query_dict is None:
+                # Keep the old cursor, so the next sync covers this one's gap
+                print("WARN: Incremental sync stopped at offset {}".format(offset))
+                return
+            queue_videos(query_dict, dl_dict, done_dict, dl_queue)
+            max_id = max([max_id] + page_ids)
+            if len(page_ids) == 0 or min(page_ids) <= cursor["max_id"]:
+                break
+            if g_stop.is_set():
+                print("Incremental sync stopped at offset {}".format(offset))
+                return
+            offset += len(page_ids)
 
-    return dl_name, dl_url
+        cursor["max_id"] = max_id
+        save_sync_cursor(cursor)
 
 ################################################################################
 # Desc
-#   Downloads a video from given dl_url, and names it dl_name
+#   Finds new videos by crawling premium pages, newest first. g_crawl_pages
+#   pages are fetched at once (the rate limiter still spaces the requests), and
+#   the crawl stops at the first page holding only videos seen before, unless
+#   full is set. Videos not seen before are resolved with one videos API
+#   request per g_query_limit of them, instead of one request each.
 # Params
-#   dl_name     str to name the downloaded video
-#   dl_url      str url to download from
+#   dl_dict         dict of videos to download
+#   done_dict       DoneIndex of videos already downloaded, and of the ids of
+#                   every video queried before
+#   dl_queue        DownloadQueue to feed, or None in query mode only
+#   full            bool crawl every page
 # Returns
-#   bool        True on success, otherwise False
+#   None
 ################################################################################
-def download_video(dl_name, dl_url):
-    global g_api_key
+def crawl_videos(dl_dict, done_dict, dl_queue, full=False):
+    # Videos skipped by other filters count as seen, and an interrupted crawl
+    # may have left a gap behind seen pages, so crawl everything in both cases
+    cursor = load_sync_cursor()
+    if cursor.get("crawl_filter", g_filter_key) != g_filter_key or not cursor.get("crawl_complete", True):
+        print("Last crawl was interrupted or used other filters, crawling every page...")
+        full = True
+    cursor["crawl_complete"] = False
+    save_sync_cursor(cursor)
 
-    # Check if file already exists
-    if os.path.exists("./{}".format(dl_name)):
-        print("ERROR: File {} already exists in directory, skipping...".format(dl_name))
-        return False
+    page_no = 1
+    done = False
+    while not done:
+        if g_stop.is_set():
+            print("Crawl stopped at premium page {}".format(page_no))
+            return
 
-    print("Downloading {}...".format(dl_name))
-    dl_url_with_api = "{}?api_key={}".format(dl_url, g_api_key)
-    try:
-        urllib.request.urlretrieve(dl_url_with_api, dl_name, show_progress)
-        
-        # Add downloaded video to done file
-        with open(g_done_file, "a", encoding="utf-8") as done_file:
-            done_file.write("\"{}\",\"{}\"\n".format(dl_name, dl_url))
+        # Fetch the next pages concurrently
+        pages = [None] * g_crawl_pages
+        def fetch_page(k):
+            pages[k] = get_url_list_from_page(page_no + k)
+        threads = [threading.Thread(target=fetch_page, args=(k,), name="crawl-{}".format(k))
+                   for k in range(g_crawl_pages)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
 
-        inc_and_check_rq_rate()
-        inc_and_check_dl_rate()
-    except Exception as e:
-        print(e)
-        print("ERROR: Exception during video {} download!\nURL: {}".format(dl_name, dl_url_with_api))
-        return False
+        # Take pages in order, up to the first one that is empty or only has
+        # videos seen before
+        new_ids = []
+        for url_list, guid_list in pages:
+            if guid_list is None:
+                print("WARN: Crawl stopped at premium page {}, will crawl every page next time".format(page_no))
+                break
+            page_no += 1
+            page_ids = [get_id_from_guid(guid) for guid in guid_list]
+            known_ids = done_dict.known_ids(page_ids)
+            new_ids += [video_id for video_id in page_ids if video_id not in known_ids and video_id not in new_ids]
+            if len(page_ids) == 0 or (not full and len(known_ids) == len(set(page_ids))):
+                done = True
+                break
 
-    return True
+        # Resolve the new videos in batches
+        for k in range(0, len(new_ids), g_query_limit):
+            with timed("get_dl_urls_from_api"):
+                query_dict, page_ids = get_dl_urls_from_api(0, done_dict, ids=new_ids[k:k + g_query_limit])
+            if query_dict is None:
+                print("WARN: Could not resolve {} crawled videos, will crawl every page next time".format(len(new_ids) - k))
+                return
+            queue_videos(query_dict, dl_dict, done_dict, dl_queue)
+        if guid_list is None:
+            return
+
+    cursor["crawl_filter"] = g_filter_key
+    cursor["crawl_complete"] = True
+    save_sync_cursor(cursor)
+
+################################################################################
+# Desc
+#   Gets the API video id from a guid, e.g. 2300-1234 -> 1234
+# Params
+#   guid        str video guid
+# Returns
+#   int         video id
+################################################################################
+def get_id_from_guid(guid):
+    return int(guid.split("-")[-1])
 
 ################################################################################
 # Desc
-#   Saves dl_dict and done_dict to progress files
+#   Logs newly found videos to dl_dict and the journal, and queues them for the
+#   download workers. A shared queue keeps track of them itself instead.
 # Params
+#   query_dict      dict of videos gathered from query (dl_name, dl_url)
 #   dl_dict         dict of videos to download
 #   done_dict       dict of videos already downloaded
+#   dl_queue        DownloadQueue to feed, or None in query mode only
 # Returns
 #   None
 ################################################################################
-def save_progress(dl_dict, done_dict):
-    # Log videos that need to be downloaded
-    try:
-        with open(g_dl_file, "w", encoding="utf-8") as dl_file:
-            for dl_name, dl_url in dl_dict.items():
-                dl_file.write("\"{}\",\"{}\"\n".format(dl_name, dl_url))
-    except Exception as e:
-        print(e)
-        print("WARN: Exception when writing [{}, {}] to {}! Skipping...".format(dl_name, dl_url, g_dl_file))
-
-    # Log videos that have already been downloaded
-    try:
-        with open(g_done_file, "w", encoding="utf-8") as done_file:
-            for done_name, done_url in done_dict.items():
-                done_file.write("\"{}\",\"{}\"\n".format(done_name, done_url)) 
-    except Exception as e:
-        print(e)
-        print("WARN: Exception when writing [{}, {}] to {}! Skipping...".format(done_name, done_url, g_done_file))
+def queue_videos(query_dict, dl_dict, done_dict, dl_queue):
+    with g_progress_lock:
+        for dl_name, dl_url in query_dict.items():
+            if isinstance(dl_queue, SharedQueue):
+                dl_queue.put(dl_name, dl_url)
+            elif dl_name not in dl_dict:
+                g_journal.record("queued", dl_name, dl_url, g_quality_urls.get(dl_name))
+                dl_dict[dl_name] = dl_url
+                if dl_queue is not None:
+                    dl_queue.put(dl_name, dl_url)
+        if g_journal.needs_compaction():
+            save_progress(dl_dict, done_dict)
 
 ################################################################################
 # Desc
-#   Loads dl_dict and done_dict from progress files
+#   Loads the sync cursor: the highest video id seen, the offset the full sync
+#   reached, whether the full sync has completed, and the filters it ran with.
+#   The premium page crawler keeps its own state in it too.
 # Params
 #   None
 # Returns
-#   dl_dict         dict of videos to download
-#   done_dict       dict of videos already downloaded
+#   cursor          dict with keys max_id, offset, complete and, once saved,
+#                   filter, crawl_filter and crawl_complete
 ################################################################################
-def load_progress():
-    dl_dict = OrderedDict()
-    done_dict = {}
-
-    # Load files to download
-    try:
-        with open(g_dl_file, "r", encoding="utf-8") as dl_file:
-            print("Loading files to download from {}...".format(g_dl_file))
-            dl_reader = csv.reader(dl_file)
-            for row in dl_reader:
-                dl_dict[row[0]] = row[1]     
-    except FileNotFoundError:
-        print("Progress file {} not found. Creating...".format(g_dl_file))
-        with open(g_dl_file, "w", encoding="utf-8") as dl_file:
-            pass
-    except Exception as e:
-        print(e)
-        print("ERROR: Exception when loading from {}".format(g_dl_file))
-        return None, None
-
-    # Load files that are finished
+def load_sync_cursor():
+    cursor = {"max_id": 0, "offset": 0, "complete": False}
     try:
-        with open(g_done_file, "r", encoding="utf-8") as done_file:
-            print("Loading completed files from {}...".format(g_done_file))
-            done_reader = csv.reader(done_file)
-            for row in done_reader:
-                done_dict[row[0]] = row[1] 
+        with open(g_sync_file, "r", encoding="utf-8") as sync_file:
+            cursor.update(json.load(sync_file))
     except FileNotFoundError:
-        print("Progress file {} not found. Creating...".format(g_done_file))
-        with open(g_done_file, "w", encoding="utf-8") as done_file:
-            pass
+        pass
     except Exception as e:
         print(e)
-        print("ERROR: Exception when loading from {}".format(g_done_file))
-        return None, None
-
-    return dl_dict, done_dict
+        print("WARN: Could not read {}, running a full sync...".format(g_sync_file))
+    return cursor
 
 ################################################################################
 # Desc
-#   Increments and checks download rate, returns when rate limit is not exceeded
+#   Saves the sync cursor, replacing the old one atomically
 # Params
-#   None
+#   cursor          dict with keys max_id, offset, complete and filter
 # Returns
 #   None
 ################################################################################
-def inc_and_check_dl_rate():
-    global g_start_time
-    global g_dl_count
-    global g_max_dl_rate
-    g_dl_count += 1
-    curr_time = time.time()
-    curr_rate = g_dl_count / (curr_time - g_start_time)
-    print("Videos downloaded {}".format(g_dl_count))
-
-    # Sleep while curr rate is over the max rate
-    while curr_rate > g_max_dl_rate:
-        print("Videos downloaded {}, Current dl rate {}, Max dl rate {}".format(g_dl_count, curr_rate, g_max_dl_rate))
-        # Sleep 1 minute
-        sleep_bar(60)
-        # Calculate new rate
-        curr_time = time.time()
-        curr_rate = g_dl_count / (curr_time - g_start_time)
+def save_sync_cursor(cursor):
+    tmp_name = "{}.tmp".format(g_sync_file)
+    with open(tmp_name, "w", encoding="utf-8") as sync_file:
+        json.dump(cursor, sync_file)
+    os.replace(tmp_name, g_sync_file)
 
 ################################################################################
 # Desc
-#   Increments and checks request rate, returns when rate limit is not exceeded
+#   Starts g_num_workers download workers to drain dl_queue, and
+#   g_post_workers post-processing workers behind them
 # Params
-#   None
+#   dl_queue        DownloadQueue of videos to download
+#   dl_dict         dict of videos to download, shared with the workers
+#   done_dict       dict of videos already downloaded, shared with the workers
 # Returns
-#   None
+#   workers         list of started worker threads
 ################################################################################
-def inc_and_check_rq_rate():
-    global g_start_time
-    global g_rq_count
-    global g_max_rq_rate
-    g_rq_count += 1
-    curr_time = time.time()
-    curr_rate = g_rq_count / (curr_time - g_start_time)
-    #print("Requests made {}".format(g_rq_count))
+def start_download_workers(dl_queue, dl_dict, done_dict):
+    global g_post_queue
+    global g_post_threads
+    workers = []
+    for k in range(g_num_workers):
+        worker = threading.Thread(target=download_worker, args=(dl_queue, dl_dict, done_dict),
+                                  name="dl-worker-{}".format(k), daemon=True)
+        worker.start()
+        workers.append(worker)
 
-    # Sleep while curr rate is over the max rate
-    while curr_rate > g_max_rq_rate:
-        print("Requests made {}, Current rq rate {}, Max rq rate {}".format(g_rq_count, curr_rate, g_max_rq_rate))
-        # Sleep 10 seconds
-        sleep_bar(10)
-        # Calculate new rate
-        curr_time = time.time()
-        curr_rate = g_rq_count / (curr_time - g_start_time)      
+    # Post-processing workers finish every download, so they run as long as
+    # the download workers do
+    if g_library_dir is not None:
+        os.makedirs(g_library_dir, exist_ok=True)
+        if os.stat(g_library_dir).st_dev != os.stat(".").st_dev:
+            print("WARN: {} is on another filesystem, so videos will be copied into it instead of renamed".format(g_library_dir))
+    g_post_queue = PostQueue()
+    g_post_threads = []
+    for k in range(g_post_workers):
+        thread = threading.Thread(target=post_worker, name="post-worker-{}".format(k), daemon=True)
+        thread.start()
+        g_post_threads.append(thread)
+    return workers
 
 ################################################################################
 # Desc
-#   Shows progress during download, compatible with urllib.request.urlretrieve
+#   Waits for download workers to finish, once their queue has been closed,
+#   then for the post-processing workers to finish what they were handed.
+#   Stops the queue early if SIGTERM is received.
 # Params
-#   block_num       int current block number of download
-#   block_size      int current block size of download
-#   total_size      int total size of download
+#   workers         list of worker threads
+#   dl_queue        DownloadQueue the workers take from
 # Returns
 #   None
 ################################################################################
-def show_progress(block_num, block_size, total_size):
-    global g_pbar
-    if g_pbar is None:
-        g_pbar = ProgressBar(total_size)
-        g_pbar.start()
+def wait_for_workers(workers, dl_queue):
+    # Join with a timeout so Ctrl-C still reaches the main thread
+    for worker in workers:
+        while worker.is_alive():
+            if g_stop.is_set() and not dl_queue.stopped:
+                print("Stopping, unfinished downloads will resume next run...")
+                dl_queue.stop()
+            worker.join(0.5)
 
-    downloaded = block_num * block_size
-    if downloaded < total_size:
-        g_pbar.update(downloaded)
-    else:
-        g_pbar.finish()
-        g_pbar = None
+    g_post_queue.close()
+    for thread in g_post_threads:
+        while thread.is_alive():
+            thread.join(0.5)
 
 ################################################################################
 # Desc
-#   Simple progress bar class, to be used with show_progress function
+#   Finds the size of queued videos not in g_sizes with HEAD requests, spending
+#   at most g_size_probe_limit requests of the request rate budget
+# Params
+#   dl_dict         dict of videos to download
+# Returns
+#   None
 ################################################################################
-class ProgressBar:
-    def __init__(self, dl_size):
-        self.maxval = 50
-        self.currval = 0
-        self.dl_size = dl_size
+def probe_sizes(dl_dict):
+    unknown = [dl_url for dl_url in dl_dict.values() if g_sizes.get(dl_url) is None]
+    if not unknown:
+        return
+    print("Finding sizes of {} of {} videos of unknown size...".format(min(len(unknown), g_size_probe_limit), len(unknown)))
+    for dl_url in unknown[:g_size_probe_limit]:
+        if get_remote_size(dl_url) is None:
+            print("WARN: Could not find size of {}, estimating it...".format(dl_url))
 
-        print("|0%", end="")
-        for k in range(round(self.maxval/2.0)-7):
-            print(" ", end="")
-        print("Progress", end="")
-        for k in range(round(self.maxval/2.0)-7):
-            print(" ", end="")
-        print("100%|")
-
-    def start(self):
-        print("|", end="")
+################################################################################
+# Desc
+#   Queues done videos that were taken below their best quality again at their
+#   best, newest first, as far as the capacity left before the deadline once
+#   the backlog is downloaded at its best quality allows, and at most
+#   g_upgrade_limit per run or poll. Checked after each query, and whenever a
+#   download leaves the queue empty. Only for the local queue, as the shared
+#   one keeps done videos done.
+# Params
+#   done_dict       DoneIndex of videos already downloaded
+#   dl_queue        DownloadQueue to queue the upgrades in
+# Returns
+#   None
+################################################################################
+def queue_upgrades(done_dict, dl_queue):
+    global g_upgrade_count
+    if g_scheduler is None or g_scheduler.deadline is None or not isinstance(dl_queue, DownloadQueue):
+        return
+    limit = min(g_upgrade_limit - g_upgrade_count, g_scheduler.get_video_budget() - len(dl_queue))
+    if limit <= 0:
+        return
+    backlog = dl_queue.backlog()
+    spare_bytes = g_scheduler.get_byte_budget() - sum(get_quality_size(dl_name, dl_url, g_qualities[0]) for dl_name, dl_url in backlog)
+    upgrades = []
+    for dl_name, dl_url in done_dict.get_below_best(limit + len(g_upgrades)):
+        if dl_name in g_upgrades:
+            continue
+        size = g_sizes.get(dl_url) or g_sizes.get_estimate()
+        if size > spare_bytes or len(upgrades) >= limit:
+            break
+        spare_bytes -= size
+        upgrades.append((dl_name, dl_url))
+    if upgrades:
+        print("Upgrading {} videos to their best quality with spare capacity".format(len(upgrades)))
+    g_upgrade_count += len(upgrades)
+    for dl_name, dl_url in upgrades:
+        g_upgrades.add(dl_name)
+        dl_queue.put(dl_name, dl_url)
 
-    def update(self, updateval):
-        while self.currval < round(self.maxval*(updateval/float(self.dl_size))):
-            print(".", end="", flush=True)
-            self.currval += 1
+################################################################################
+# Desc
+#   Finds the size of a video with a HEAD request, and notes it in g_sizes
+# Params
+#   dl_url          str url of the video
+# Returns
+#   int             size in bytes, or None if the server did not say
+################################################################################
+def get_remote_size(dl_url):
+    try:
+        inc_and_check_rq_rate()
+        with timed_request("{}?api_key={}".format(dl_url, g_api_key), "head", method="HEAD") as response:
+            if response.headers.get("Content-Length") is None:
+                return None
+            size = int(response.headers.get("Content-Length"))
+    except Exception as e:
+        print(e)
+        metric_inc("dl_gb_errors_total", type=type(e).__name__, stage="size")
+        return None
+    if g_sizes is not None:
+        g_sizes.set(dl_url, size)
+    return size
 
+################################################################################
+# Desc
+#   Download worker loop. Takes videos from dl_queue until it is drained, and
+#   records each result in the shared progress dicts and files.
+# Params
+#   dl_queue        DownloadQueue of videos to download
+#   dl_dict         dict of videos to download
+#   done_dict       dict of videos already downloaded
+# Returns
+#   None
+################################################################################
+def download_worker(dl_queue, dl_dict, done_dict):
+    profile = start_profile()
+    while True:
+        item = dl_queue.get()
+        if item is None:
+            stop_profile(profile)
+            return
+        dl_name, dl_url = item
+
+        # Pick the quality to fetch. The video keeps dl_url, its best quality
+        # url, in the progress files.
+        fetch_url = dl_url
+        if g_scheduler is not None and g_scheduler.deadline is not None:
+            quality, fetch_url = g_scheduler.choose_quality(dl_name, dl_url, dl_queue.backlog())
+            if fetch_url != dl_url:
+                g_fetch_qualities[dl_name] = quality
+                print("Taking {} in {} quality to clear the queue in {} days".format(dl_name, quality, g_scheduler.deadline))
+            metric_inc("dl_gb_qualities_total", quality=quality or g_qualities[0])
+
+        metric_set("dl_gb_workers_busy", 1, worker=threading.current_thread().name)
+        with timed("download_video"):
+            error, result = download_video(dl_name, fetch_url, dl_name in g_upgrades)
+        metric_set("dl_gb_workers_busy", 0, worker=threading.current_thread().name)
+        if error is None and result is not None:
+            # Verified and filed by a post-processing worker, which finishes it
+            g_post_queue.put((dl_queue, dl_dict, done_dict, dl_name, dl_url, result))
+            continue
+        finish_download(dl_queue, dl_dict, done_dict, dl_name, dl_url, error)
+
+################################################################################
+# Desc
+#   Records the outcome of a download in the progress files, retries it later
+#   if it failed for a transient reason, and marks it finished in its queue
+# Params
+#   dl_queue        DownloadQueue the video was taken from
+#   dl_dict         dict of videos to download
+#   done_dict       DoneIndex of videos already downloaded
+#   dl_name         str name of the video
+#   dl_url          str url of the video
+#   error           Exception the download or post-processing failed with, or
+#                   None on success
+# Returns
+#   None
+################################################################################
+def finish_download(dl_queue, dl_dict, done_dict, dl_name, dl_url, error):
+    with g_progress_lock:
+        if error is not None:
+            # Picked again if it is retried
+            g_fetch_qualities.pop(dl_name, None)
+        if isinstance(error, DownloadInterrupted):
+            # Left in dl_dict, to resume next run
+            state = "stopped"
+        elif error is None:
+            state = "done"
+            metric_inc("dl_gb_downloads_total", result="done")
+            g_journal.record("done", dl_name, dl_url)
+            done_dict[dl_name] = dl_url
+            done_dict.set_quality(dl_name, g_fetch_qualities.pop(dl_name, None))
+            g_quality_urls.pop(dl_name, None)
+            g_upgrades.discard(dl_name)
+            g_retries.pop(dl_name, None)
+            dl_dict.pop(dl_name, None)
+        else:
+            # Retry transient failures later, and log every failure in the
+            # error progress file
+            attempts = g_retries.get(dl_name, [0, 0])[0] + 1
+            retry_time = 0
+            if is_retryable(error) and attempts < g_retry_max_attempts:
+                state = "retry"
+                delay = get_retry_delay(attempts)
+                retry_time = time.time() + delay
+                g_retries[dl_name] = [attempts, retry_time]
+                print("WARN: Retrying {} in {:.0f}s (attempt {} of {})".format(dl_name, delay, attempts + 1, g_retry_max_attempts))
+                metric_inc("dl_gb_downloads_total", result="retry")
+                dl_queue.put(dl_name, dl_url, delay)
+            else:
+                state = "error"
+                g_quality_urls.pop(dl_name, None)
+                g_upgrades.discard(dl_name)
+                g_retries.pop(dl_name, None)
+                metric_inc("dl_gb_downloads_total", result="error")
+                g_journal.record("error", dl_name, dl_url)
+                dl_dict.pop(dl_name, None)
+            with open(g_error_file, "a", encoding="utf-8", newline="") as err_file:
+                csv.writer(err_file, quoting=csv.QUOTE_ALL, lineterminator="\n").writerow(
+                    [dl_name, dl_url, attempts, int(retry_time), str(error)])
+
+        # Compact the journal into the progress files once it grows large
+        if g_journal.needs_compaction():
+            with timed("save_progress"):
+                save_progress(dl_dict, done_dict)
+
+    # Spare capacity once the queue is empty goes to upgrades. The queue
+    # cannot finish before task_done, so they are still taken.
+    if state == "done" and len(dl_queue) == 0:
+        queue_upgrades(done_dict, dl_queue)
+    dl_queue.task_done(dl_name, state)
+
+################################################################################
+# Desc
+#   Post-processing worker: verifies, hashes and files finished downloads from
+#   g_post_queue, off the download workers' path, then finishes them (see
+#   finish_download). Returns once the queue is closed and empty.
+# Params
+#   None
+# Returns
+#   None
+################################################################################
+def post_worker():
+    profile = start_profile()
+    while True:
+        job = g_post_queue.get()
+        if job is None:
+            stop_profile(profile)
+            return
+        dl_queue, dl_dict, done_dict, dl_name, dl_url, result = job
+        with timed("post_process"):
+            error = post_process(dl_name, result, done_dict)
+        finish_download(dl_queue, dl_dict, done_dict, dl_name, dl_url, error)
+
+################################################################################
+# Desc
+#   Checks a finished download against the size the server announced, logs
+#   its checksum (hashing it now only if that could not be done while it was
+#   written), and files it into the library
+# Params
+#   dl_name         str name of the downloaded video
+#   result          dict size and checksum from fetch_to_part
+#   done_dict       DoneIndex, to look up the video's show
+# Returns
+#   Exception       the check or filing failed with, or None on success. A
+#                   video of the wrong size is deleted, and VerifyError raised.
+################################################################################
+def post_process(dl_name, result, done_dict):
+    try:
+        size = os.path.getsize(dl_name)
+        if result["size"] is not None and size != result["size"]:
+            os.remove(dl_name)
+            raise VerifyError("{} is {} bytes, expected {}".format(dl_name, size, result["size"]))
+        checksum = result["checksum"]
+        if checksum is None:
+            checksum = hash_file(dl_name)
+
+        path = file_into_library(dl_name, done_dict.get_show(dl_name))
+        if g_library is not None:
+            g_library.record(path, dl_name)
+        with g_checksum_lock:
+            with open(g_checksum_file, "a", encoding="utf-8", newline="") as checksum_file:
+                csv.writer(checksum_file, quoting=csv.QUOTE_ALL, lineterminator="\n").writerow([path, size, checksum])
+    except Exception as e:
+        print(e)
+        print("ERROR: Exception while post-processing {}!".format(dl_name))
+        metric_inc("dl_gb_errors_total", type=type(e).__name__, stage="post")
+        return e
+    return None
+
+################################################################################
+# Desc
+#   Moves a finished download into g_library_dir, at g_library_layout, or
+#   hardlinks it there if g_library_link is set. On the same filesystem this
+#   is only a rename. Across filesystems it falls back to a copy.
+# Params
+#   dl_name         str name of the downloaded video
+#   show            str title of the video's show, or None if unknown
+# Returns
+#   str             path of the video
+################################################################################
+def file_into_library(dl_name, show):
+    if g_library_dir is None:
+        return dl_name
+
+    match = g_dl_name_date_pattern.search(dl_name)
+    show = "".join(x for x in show if x not in "<>:\"/\\|?*") if show else "Unknown Show"
+    path = os.path.join(g_library_dir, g_library_layout.format(
+        show=show, year=match.group(1)[:4] if match else "Unknown Year", name=dl_name))
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    tmp_path = "{}.tmp".format(path)
+    try:
+        if g_library_link:
+            os.link(dl_name, tmp_path)
+            os.replace(tmp_path, path)
+        else:
+            os.replace(dl_name, path)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.copy2(dl_name, tmp_path)
+        os.replace(tmp_path, path)
+        if not g_library_link:
+            os.remove(dl_name)
+    print("Filed {} into {}".format(dl_name, path))
+    return path
+
+################################################################################
+# Desc
+#   Queue of finished downloads waiting for the post-processing workers
+################################################################################
+class PostQueue:
+    def __init__(self):
+        self.jobs = deque()
+        self.closed = False
+        self.cond = threading.Condition()
+
+    def put(self, job):
+        with self.cond:
+            self.jobs.append(job)
+            self.cond.notify()
+
+    # Returns the next job, or None once closed and empty
+    def get(self):
+        with self.cond:
+            while not self.jobs:
+                if self.closed:
+                    return None
+                self.cond.wait()
+            return self.jobs.popleft()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+################################################################################
+# Desc
+#   Loads failed downloads from the error progress file into g_retries, and
+#   queues again the ones that can still be retried. The last row of each
+#   video wins. Rows from before retries were tracked only hold the name and
+#   url, and count as one retryable attempt.
+# Params
+#   dl_dict         dict of videos to download
+#   done_dict       dict of videos already downloaded
+# Returns
+#   None
+################################################################################
+def load_retries(dl_dict, done_dict):
+    errors = OrderedDict()
+    try:
+        with open(g_error_file, "r", encoding="utf-8", newline="") as err_file:
+            for row in csv.reader(err_file):
+                if len(row) == 2:
+                    errors[row[0]] = (row[1], 1, 0, True)
+                elif len(row) == 5:
+                    try:
+                        errors[row[0]] = (row[1], int(row[2]), int(row[3]), int(row[3]) > 0)
+                    except ValueError:
+                        pass    # Torn last row from a crash
+    except FileNotFoundError:
+        return
+
+    requeued = 0
+    for dl_name, (dl_url, attempts, retry_time, retryable) in errors.items():
+        if dl_name in done_dict or not retryable or attempts >= g_retry_max_attempts:
+            continue
+        g_retries[dl_name] = [attempts, retry_time]
+        if dl_name not in dl_dict:
+            g_journal.record("queued", dl_name, dl_url)
+            dl_dict[dl_name] = dl_url
+            requeued += 1
+    if g_retries:
+        print("Retrying {} failed downloads from {} ({} queued again)".format(len(g_retries), g_error_file, requeued))
+
+################################################################################
+# Desc
+#   Sorts download failures into ones worth retrying (network errors,
+#   timeouts, cut off transfers and the statuses in g_retry_statuses) and ones
+#   that would fail again (other HTTP errors, bad responses, local problems)
+# Params
+#   error           Exception the download failed with
+# Returns
+#   bool            True if the download should be retried
+################################################################################
+def is_retryable(error):
+    if isinstance(error, HttpError):
+        return error.status in g_retry_statuses
+    return isinstance(error, (ConnectionError, TimeoutError, socket.gaierror, ssl.SSLError, http.client.HTTPException,
+                              VerifyError))
+
+################################################################################
+# Desc
+#   Gets the delay before retrying a download: g_retry_base_delay doubled for
+#   every earlier attempt, up to g_retry_max_delay, with random jitter over its
+#   upper half so workers and processes don't retry in lockstep
+# Params
+#   attempts        int attempts made so far
+# Returns
+#   float           seconds to wait
+################################################################################
+def get_retry_delay(attempts):
+    delay = min(g_retry_max_delay, g_retry_base_delay * 2**(attempts - 1))
+    return delay/2 + random.uniform(0, delay/2)
+
+################################################################################
+# Desc
+#   Gets how long a queued video still has to wait for its retry
+# Params
+#   dl_name         str video to check
+# Returns
+#   float           seconds to wait, 0 if it is not waiting on a retry
+################################################################################
+def get_retry_wait(dl_name):
+    retry = g_retries.get(dl_name)
+    return max(0, retry[1] - time.time()) if retry is not None else 0
+
+################################################################################
+# Desc
+#   Gets video urls and guids from premium page (see crawl_videos)
+# Params
+#   page_no     int page number to grab urls/guids from
+# Returns
+#   url_list    str list of video urls
+#   guid_list   str list of video guids
+################################################################################
+def get_url_list_from_page(page_no):
+    print("Searching for premium URLs on page {}...".format(page_no))
+
+    premium_url = g_gb_url + "/videos/premium/?page={0}".format(page_no)
+    try:
+        inc_and_check_rq_rate()
+        with timed_request(premium_url, "page", compressed=True) as response:
+            page_html = response.read().decode('utf-8')
+    except Exception as e:
+        print(e)
+        print("ERROR: Exception occurred during premium page {0} url fetch!".format(page_no))
+        metric_inc("dl_gb_errors_total", type=type(e).__name__, stage="page")
+        return None, None
+
+    url_list = []
+    guid_list = []
+    page_html_lines = page_html.split('\n')
+    for line in page_html_lines:
+        match = g_premium_page_pattern.search(line)
+        if match:
+            premium_url = g_gb_url + match.group("url")
+            guid = match.group("guid")
+            url_list.append(premium_url)
+            guid_list.append(guid)
+            print("    {}\t{}".format(premium_url, guid))
+
+    print("Found {} matches on page {}!".format(len(url_list), page_no))
+
+    return url_list, guid_list
+
+################################################################################
+# Desc
+#   Gets download urls and forms download name from videos API call.
+#   All-in-one step vs calling get_url_list_from_page and get_dl_url_from_guid.
+#   The response is parsed as it streams in (see parse_videos).
+# Params
+#   offset          int changes which set of videos are queried by API
+#   done_dict       DoneIndex of completed downloads
+#   sort            str API sort order, "id:asc" or "id:desc"
+#   min_id          int skip videos with an id at or below this, or None
+#   ids             int list of at most g_query_limit video ids to get, in
+#                   one request, or None for every video
+# Returns
+#   query_dict      dict of videos gathered from query (dl_name, dl_url)
+#   page_ids        int list of the ids of every video on the page, including
+#                   skipped ones. Empty once past the end of the catalog.
+################################################################################
+def get_dl_urls_from_api(offset, done_dict, sort="id:asc", min_id=None, ids=None):
+    global g_api_key
+    api_filter = g_api_filter
+    if ids is not None:
+        api_filter = "{},id:{}".format(api_filter, "|".join(str(video_id) for video_id in ids))
+    filter = urllib.parse.quote(api_filter, safe=":,|")
+    limit = g_query_limit
+    field_list = ["id", "name", "publish_date", "video_show", "hd_url", "high_url", "low_url"]
+
+    # Query list of premium videos from API
+    api_url = g_api_url + "/videos/?api_key={}&format={}&offset={}&filter={}&limit={}&sort={}&field_list={}".format(g_api_key, g_api_format, offset, filter, limit, sort, ','.join(field_list))
+
+    # Gather data for each video
+    query_dict = OrderedDict()
+    page_ids = []
+    video_ids = {}
+    shows = {}
+    found_dict = OrderedDict()
+    try:
+        # The newest videos change between runs, so always revalidate them
+        max_age = 0 if sort.endswith(":desc") else None
+        with api_get(api_url, max_age) as response:
+            for video in parse_videos(response, g_api_format):
+                if video["id"] is not None:
+                    page_ids.append(video["id"])
+
+                    # Check for already synced video
+                    if min_id is not None and video["id"] <= min_id:
+                        continue
+
+                # Check the include/exclude rules. Skipped videos are still
+                # noted as seen by id, so the crawler doesn't resolve them again.
+                if not g_video_filter(video):
+                    if video["id"] is not None:
+                        video_ids["#{}".format(video["id"])] = video["id"]
+                    continue
+
+                dl_name, dl_url = get_dl_pair(video)
+                if dl_name is None:
+                    print("ERROR: Could not find valid download link from video {}!".format(video["id"]))
+                    if video["id"] is not None:
+                        video_ids["#{}".format(video["id"])] = video["id"]
+                    continue
+
+                if not done_dict.has(video["id"], dl_name):
+                    # A complete copy on disk only needs to be recorded done
+                    if g_library is not None and g_sizes is not None and \
+                            g_library.is_complete(video["id"], dl_name, g_sizes.get(dl_url)):
+                        found_dict[dl_name] = dl_url
+                    else:
+                        query_dict[dl_name] = dl_url
+                        note_quality_urls(dl_name, video)
+                video_ids[dl_name] = video["id"]
+                shows[dl_name] = video["show"]
+    except Exception as e:
+        print(e)
+        print("ERROR: Exception occurred during videos (offset {}) fetch!".format(offset))
+        metric_inc("dl_gb_errors_total", type=type(e).__name__, stage="query")
+        return None, None
+
+    if found_dict:
+        print("Found {} videos already in the library, recording them as done".format(len(found_dict)))
+        done_dict.add_many(found_dict.items())
+
+    # Remember the ids, so the videos are recorded done by id too, including
+    # ones converted from done.csv by name, and the shows to file them under
+    done_dict.add_ids(video_ids, shows)
+    if g_library is not None:
+        g_library.fill_ids(video_ids)
+    return query_dict, page_ids
+
+################################################################################
+# Desc
+#   Gets download url from guid, and what to name it
+# Params
+#   guid        str guid for video to get
+# Returns
+#   dl_name     str download name
+#   dl_url      str download url
+################################################################################
+def get_dl_url_from_guid(guid):
+    global g_api_key
+    field_list = ["id", "name", "publish_date", "video_show", "hd_url", "high_url", "low_url"]
+
+    # Query video from API
+    api_url = g_api_url + "/video/{}/?api_key={}&format={}&field_list={}".format(guid, g_api_key, g_api_format, ','.join(field_list))
+    try:
+        with api_get(api_url) as response:
+            videos = list(parse_videos(response, g_api_format))
+    except Exception as e:
+        print(e)
+        print("ERROR: Exception occurred during guid {} fetch!".format(guid))
+        metric_inc("dl_gb_errors_total", type=type(e).__name__, stage="guid")
+        return None, None
+
+    if len(videos) == 0:
+        print("ERROR: No video found for guid {}".format(guid))
+        return None, None
+
+    dl_name, dl_url = get_dl_pair(videos[0])
+    if dl_name is None:
+        print("ERROR: Could not find valid download link from guid {}".format(guid))
+    else:
+        note_quality_urls(dl_name, videos[0])
+    return dl_name, dl_url
+
+################################################################################
+# Desc
+#   Gets an API response, from g_api_cache if possible. A fresh cached response
+#   costs no request. A stale one is revalidated with its ETag/Last-Modified,
+#   and reused if the server answers 304 Not Modified.
+# Params
+#   api_url     str API url, including the api key
+#   max_age     int seconds a cached response may be used without revalidating,
+#               or None for g_cache_ttl
+# Returns
+#   file-like response body, to be used as a context manager
+################################################################################
+def api_get(api_url, max_age=None):
+    if g_api_cache is None:
+        inc_and_check_rq_rate()
+        return timed_request(api_url, "api", compressed=True)
+
+    if max_age is None:
+        max_age = g_cache_ttl
+    key = g_api_cache.get_key(api_url)
+    meta = g_api_cache.load_meta(key)
+    if meta is not None and time.time() - meta["time"] < max_age:
+        body = g_api_cache.open_body(key)
+        if body is not None:
+            metric_inc("dl_gb_api_cache_total", result="hit")
+            return body
+
+    # Ask the server whether our copy is still current
+    headers = {}
+    if meta is not None:
+        if meta.get("etag"):
+            headers['If-None-Match'] = meta["etag"]
+        if meta.get("last_modified"):
+            headers['If-Modified-Since'] = meta["last_modified"]
+
+    inc_and_check_rq_rate()
+    response = timed_request(api_url, "api", headers=headers, compressed=True)
+    if response.status == 304:
+        response.close()
+        body = g_api_cache.open_body(key)
+        if body is not None:
+            metric_inc("dl_gb_api_cache_total", result="revalidated")
+            meta["time"] = time.time()
+            g_api_cache.save_meta(key, meta)
+            return body
+        # Our copy vanished, so fetch it again unconditionally
+        inc_and_check_rq_rate()
+        response = timed_request(api_url, "api", compressed=True)
+
+    metric_inc("dl_gb_api_cache_total", result="miss")
+    return CachingResponse(response, g_api_cache, key)
+
+################################################################################
+# Desc
+#   On-disk cache of API responses, keyed by url with the api key removed. Each
+#   entry is a {key}.body file holding the decompressed response and a
+#   {key}.json file with its fetch time and validators. The oldest entries are
+#   evicted once the cache grows past g_cache_max_bytes.
+################################################################################
+class ApiCache:
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        self.lock = threading.Lock()
+        os.makedirs(cache_dir, exist_ok=True)
+
+    def get_key(self, api_url):
+        parts = urllib.parse.urlsplit(api_url)
+        query = [(k, v) for k, v in urllib.parse.parse_qsl(parts.query) if k != "api_key"]
+        url = urllib.parse.urlunsplit((parts.scheme, parts.netloc, parts.path, urllib.parse.urlencode(query), ""))
+        return hashlib.sha1(url.encode("utf-8")).hexdigest()
+
+    def get_path(self, key, ext):
+        return os.path.join(self.cache_dir, "{}.{}".format(key, ext))
+
+    def load_meta(self, key):
+        try:
+            with open(self.get_path(key, "json"), "r", encoding="utf-8") as meta_file:
+                return json.load(meta_file)
+        except (OSError, ValueError):
+            return None
+
+    def save_meta(self, key, meta):
+        tmp_name = "{}.{}.tmp".format(self.get_path(key, "json"), threading.get_ident())
+        with open(tmp_name, "w", encoding="utf-8") as meta_file:
+            json.dump(meta, meta_file)
+        os.replace(tmp_name, self.get_path(key, "json"))
+
+    def open_body(self, key):
+        try:
+            return open(self.get_path(key, "body"), "rb")
+        except OSError:
+            return None
+
+    # Moves a fully read response body into the cache
+    def store(self, key, tmp_name, response):
+        os.replace(tmp_name, self.get_path(key, "body"))
+        self.save_meta(key, {"time": time.time(),
+                             "etag": response.headers.get("ETag"),
+                             "last_modified": response.headers.get("Last-Modified")})
+        self.evict()
+
+    def evict(self):
+        with self.lock:
+            entries = []
+            total_size = 0
+            for entry in os.scandir(self.cache_dir):
+                if entry.name.endswith(".body"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime, stat.st_size, entry.name[:-len(".body")]))
+                    total_size += stat.st_size
+            entries.sort()
+            for mtime, size, key in entries:
+                if total_size <= g_cache_max_bytes:
+                    break
+                remove_if_exists(self.get_path(key, "json"))
+                remove_if_exists(self.get_path(key, "body"))
+                total_size -= size
+
+################################################################################
+# Desc
+#   Wraps an API response, copying the body into a temp file as it is read. If
+#   the body is read to the end, the copy is stored in the cache on close.
+################################################################################
+class CachingResponse:
+    def __init__(self, response, cache, key):
+        self.response = response
+        self.cache = cache
+        self.key = key
+        self.tmp_name = "{}.{}.tmp".format(cache.get_path(key, "body"), threading.get_ident())
+        self.tmp_file = open(self.tmp_name, "wb")
+        self.complete = False
+
+    def read(self, size=-1):
+        data = self.response.read(size)
+        self.tmp_file.write(data)
+        if not data or size is None or size < 0:
+            self.complete = True
+        return data
+
+    def close(self):
+        if self.tmp_file is None:
+            return
+        self.response.close()
+        self.tmp_file.close()
+        self.tmp_file = None
+        if self.complete:
+            self.cache.store(self.key, self.tmp_name, self.response)
+        else:
+            remove_if_exists(self.tmp_name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+################################################################################
+# Desc
+#   Parses videos from an API response as it is read, in either format
+# Params
+#   stream      file-like API response
+#   api_format  str "xml" or "json"
+# Returns
+#   generator of video dicts (see get_video_from_element)
+################################################################################
+def parse_videos(stream, api_format):
+    if api_format == "json":
+        return parse_videos_json(stream)
+    return parse_videos_xml(stream)
+
+################################################################################
+# Desc
+#   Parses videos from an XML API response incrementally. Each <video> element
+#   is converted as soon as it closes, then dropped from the tree, so memory
+#   stays flat and parsing overlaps with the network read. A single-video
+#   response (from /video/{guid}/) has its fields directly under <results>.
+# Params
+#   stream      file-like XML API response
+# Returns
+#   generator of video dicts (see get_video_from_element)
+################################################################################
+def parse_videos_xml(stream):
+    parser = ET.XMLPullParser(events=("start", "end"))
+    depth = 0
+    results = None
+    found_video = False
+    while True:
+        chunk = stream.read(g_parse_chunk_size)
+        if chunk:
+            parser.feed(chunk)
+        else:
+            parser.close()
+        for event, elem in parser.read_events():
+            if event == "start":
+                depth += 1
+                if depth == 2 and elem.tag == "results":
+                    results = elem
+                continue
+            depth -= 1
+            if depth == 2 and elem.tag == "video" and results is not None:
+                found_video = True
+                yield get_video_from_element(elem)
+                results.remove(elem)
+            elif depth == 1 and elem is results and not found_video and len(elem) > 0:
+                yield get_video_from_element(elem)
+        if not chunk:
+            return
+
+################################################################################
+# Desc
+#   Converts a <video> element (or single-video <results>) to a video dict
+# Params
+#   elem        Element holding the video's fields
+# Returns
+#   dict        video with keys id, name, publish_date, show, show_id, hd_url,
+#               high_url and low_url. Missing fields are None.
+################################################################################
+def get_video_from_element(elem):
+    def text(path):
+        field = elem.find(path)
+        if field is None or not field.text:
+            return None
+        return field.text
+
+    video_id = text('id')
+    show_id = text('video_show/id')
+    return {
+        "id": int(video_id) if video_id else None,
+        "name": text('name'),
+        "publish_date": text('publish_date'),
+        "show": text('video_show/title'),
+        "show_id": int(show_id) if show_id else None,
+        "hd_url": text('hd_url'),
+        "high_url": text('high_url'),
+        "low_url": text('low_url'),
+    }
+
+################################################################################
+# Desc
+#   Parses videos from a JSON API response. The json module can't parse
+#   incrementally, so the whole response is read first.
+# Params
+#   stream      file-like JSON API response
+# Returns
+#   generator of video dicts (see get_video_from_element)
+################################################################################
+def parse_videos_json(stream):
+    results = json.load(stream).get("results")
+    if isinstance(results, dict):
+        results = [results]
+    for result in results or []:
+        show = result.get("video_show")
+        yield {
+            "id": result.get("id"),
+            "name": result.get("name"),
+            "publish_date": result.get("publish_date"),
+            "show": show.get("title") if isinstance(show, dict) else None,
+            "show_id": show.get("id") if isinstance(show, dict) else None,
+            "hd_url": result.get("hd_url") or None,
+            "high_url": result.get("high_url") or None,
+            "low_url": result.get("low_url") or None,
+        }
+
+################################################################################
+# Desc
+#   Picks the highest quality download link of a video, and forms its download
+#   name: [{date}]_[{pretty_name}]_[{raw_name}].mp4
+# Params
+#   video       dict video (see get_video_from_element)
+# Returns
+#   dl_name     str download name, or None if the video has no download link
+#   dl_url      str download url, or None if the video has no download link
+################################################################################
+def get_dl_pair(video):
+    # Find highest quality download link
+    dl_url = video["hd_url"] or video["high_url"] or video["low_url"]
+    if not dl_url:
+        return None, None
+
+    # Strip down date_time to just date
+    date = None
+    if video["publish_date"]:
+        match = g_publish_date_pattern.search(video["publish_date"])
+        if match:
+            date = match.group(1)
+        else:
+            print("WARN: Could not get date from <publish_date> field!")
+    else:
+        print("WARN: No <publish_date> field found!")
+
+    # Get raw name from hd/high/low_url
+    raw_name = None
+    match = g_video_dl_name_pattern.search(dl_url)
+    if match:
+        raw_name = match.group(1)
+    else:
+        print("WARN: Could not get raw name from <hd_url>/<high_url>/<low_url> field!")
+
+    # Assemble the name of the download: {date}_{pretty_name}_{raw_name}.mp4
+    dl_name = ""
+    if date:
+        dl_name = "[{}]".format(date)
+    if video["name"]:
+        # Remove any invalid characters
+        invalid_chars = "<>:\"/\\|?*"
+        clean_pretty_name = "".join(x for x in video["name"] if x not in invalid_chars)
+        dl_name = "{}_[{}]".format(dl_name, clean_pretty_name)
+    if raw_name:
+        dl_name = "{}_[{}].mp4".format(dl_name, raw_name)
+    else:
+        dl_name = "{}.mp4".format(dl_name)
+
+    return dl_name, dl_url
+
+################################################################################
+# Desc
+#   Notes the url of every quality of a video in g_quality_urls, if it has
+#   more than one, so the quality can be picked when it is downloaded. The
+#   video keeps its best quality url (see get_dl_pair) as dl_url, and its name.
+# Params
+#   dl_name     str download name
+#   video       dict video (see get_video_from_element)
+# Returns
+#   None
+################################################################################
+def note_quality_urls(dl_name, video):
+    urls = {quality: video["{}_url".format(quality)] for quality in g_qualities if video["{}_url".format(quality)]}
+    if len(urls) > 1:
+        g_quality_urls[dl_name] = urls
+
+################################################################################
+# Desc
+#   Downloads a video from given dl_url, and names it dl_name. The video is
+#   written to a .part file first (see fetch_to_part), which is only renamed to
+#   dl_name once it is complete, so interrupted downloads can be resumed.
+# Params
+#   dl_name     str to name the downloaded video
+#   dl_url      str url to download from
+#   replace     bool whether to replace a copy on disk, to upgrade its quality
+# Returns
+#   Exception   the download failed with (see is_retryable), or None on success
+#   dict        on success, the expected size and checksum (see fetch_to_part),
+#               or None if the video was already complete in the library
+################################################################################
+def download_video(dl_name, dl_url, replace=False):
+    global g_api_key
+
+    if g_stop.is_set():
+        return DownloadInterrupted("Stopped before starting"), None
+
+    # Skip videos already complete in the library, in any quality, and
+    # download truncated ones again. A truncated copy in the library is
+    # replaced once filed.
+    entry = g_library.find(None, dl_name) if g_library is not None and not replace else None
+    if entry is not None:
+        path, size = entry
+        expected_size = g_sizes.get(dl_url) if g_sizes is not None else None
+        if expected_size is None:
+            expected_size = get_remote_size(dl_url)
+        urls = g_quality_urls.get(dl_name, {})
+        other_sizes = {g_sizes.get(url): quality for quality, url in urls.items()} if g_sizes is not None else {}
+        if size != expected_size and size in other_sizes:
+            # Recorded at the quality found, so it can be upgraded later
+            quality = other_sizes[size]
+            g_fetch_qualities[dl_name] = None if quality == get_quality_url(dl_name, None, g_qualities[0])[0] else quality
+            expected_size = size
+        if expected_size is None or size == expected_size:
+            print("{} is already in the library at {}, skipping...".format(dl_name, path))
+            return None, None
+        print("WARN: {} is {} bytes, expected {}. Downloading it again...".format(path, size, expected_size))
+        if os.path.dirname(path) == "":
+            os.remove(path)
+            g_library.remove(path)
+
+    # Check if file already exists. An upgrade replaces it once complete.
+    if not replace and os.path.exists("./{}".format(dl_name)):
+        print("ERROR: File {} already exists in directory, skipping...".format(dl_name))
+        return FileExistsError("File {} already exists".format(dl_name)), None
+
+    print("Downloading {}...".format(dl_name))
+    dl_url_with_api = "{}?api_key={}".format(dl_url, g_api_key)
+    part_name = "{}.part".format(dl_name)
+    try:
+        # Wait for room under both limits before starting the transfer
+        inc_and_check_rq_rate()
+        inc_and_check_dl_rate()
+
+        result = fetch_to_part(part_name, dl_url, dl_url_with_api)
+
+        # Make sure the data is on disk, then move the complete file into place
+        # and drop its sidecar
+        if g_fsync:
+            fsync_file(part_name)
+        os.replace(part_name, dl_name)
+        remove_if_exists(get_sidecar_name(part_name))
+        print("Finished {}".format(dl_name))
+    except DownloadInterrupted as e:
+        print("Stopped {}, saved its progress".format(dl_name))
+        return e, None
+    except Exception as e:
+        print(e)
+        print("ERROR: Exception during video {} download!\nURL: {}".format(dl_name, dl_url_with_api))
+        metric_inc("dl_gb_errors_total", type=type(e).__name__, stage="download")
+        return e, None
+
+    return None, result
+
+################################################################################
+# Desc
+#   Downloads dl_url_with_api into part_name, resuming from a previous attempt
+#   if its sidecar (see load_sidecar) still matches the file on the server.
+#   The file is split into byte ranges ("segments"). If the server supports
+#   ranges, and the file is at least g_segment_min_size, up to g_dl_segments
+#   ranges are fetched at once into the preallocated .part file. Otherwise a
+#   single stream is used, which is still resumed with "Range: bytes=N-".
+#   Each segment reads straight into one reusable g_read_size buffer with
+#   readinto, and writes that buffer to an unbuffered file, so data is never
+#   copied through intermediate bytes objects. The buffer is hashed in
+#   g_hash_block_size blocks on the way (see BlockHasher), and finished block
+#   hashes are checkpointed in the sidecar with the segments.
+# Params
+#   part_name       str name of the .part file to download into
+#   dl_url          str url to download from, recorded in the sidecar
+#   dl_url_with_api str url to download from, including the api key
+# Returns
+#   dict            once part_name holds the complete file: "size" expected
+#                   from the server (or None), and "checksum" (see
+#                   get_checksum) hashed as the file was written, or None for a
+#                   download resumed from before hashing. Otherwise the first
+#                   segment's exception is raised.
+################################################################################
+def fetch_to_part(part_name, dl_url, dl_url_with_api):
+    sidecar_name = get_sidecar_name(part_name)
+
+    # Ask the server for size, range support and validators
+    total_size = None
+    accept_ranges = False
+    etag = None
+    last_modified = None
+    try:
+        with g_http.request(dl_url_with_api, "HEAD") as response:
+            accept_ranges = response.headers.get("Accept-Ranges", "").strip().lower() == "bytes"
+            if response.headers.get("Content-Length") is not None:
+                total_size = int(response.headers.get("Content-Length"))
+                if g_sizes is not None:
+                    g_sizes.set(dl_url, total_size)
+            etag = response.headers.get("ETag")
+            last_modified = response.headers.get("Last-Modified")
+    except Exception as e:
+        print(e)
+        print("WARN: HEAD request for {} failed, downloading without resume...".format(part_name))
+
+    # Resume if the previous attempt was for the same version of the file
+    sidecar = load_sidecar(sidecar_name)
+    if (sidecar is not None and os.path.exists(part_name) and accept_ranges and
+            (etag is not None or last_modified is not None) and
+            sidecar.get("url") == dl_url and sidecar.get("size") == total_size and
+            sidecar.get("etag") == etag and sidecar.get("last_modified") == last_modified):
+        segments = sidecar["segments"]
+        # Sidecars from before hashing have segments not aligned to blocks
+        blocks = sidecar.get("blocks")
+        print("Resuming {} from {} bytes...".format(part_name, sum(seg[2] for seg in segments)))
+    else:
+        blocks = {}
+        # Split into contiguous [start, end, done] segments, end inclusive
+        if total_size is not None and accept_ranges and g_dl_segments > 1 and total_size >= g_segment_min_size:
+            # Segments start on hash block boundaries, so each block is written
+            # in order by one segment and can be hashed as it arrives
+            seg_size = -(-total_size // g_dl_segments)
+            seg_size = -(-seg_size // g_hash_block_size) * g_hash_block_size
+            segments = [[start, min(start + seg_size, total_size) - 1, 0] for start in range(0, total_size, seg_size)]
+        elif total_size is not None:
+            segments = [[0, total_size - 1, 0]]
+        else:
+            segments = [[0, None, 0]]
+
+        # Preallocate the file so every segment can write at its own offset
+        with open(part_name, "wb") as out_file:
+            if total_size is not None:
+                preallocate(out_file, total_size)
+
+    sidecar = {"url": dl_url, "size": total_size, "etag": etag,
+               "last_modified": last_modified, "segments": segments, "blocks": blocks}
+    save_sidecar(sidecar_name, sidecar)
+
+    # Only send If-Range when there is a strong validator to send
+    validator = etag if etag is not None and not etag.startswith("W/") else last_modified
+
+    lock = threading.Lock()
+    state = {"downloaded": sum(seg[2] for seg in segments), "error": None, "last_save": time.time()}
+    resumed_bytes = state["downloaded"]
+    start_time = time.time()
+    transfer = progress_start(part_name[:-len(".part")], total_size, resumed_bytes)
+
+    def fetch_segment(segment):
+        start, end, done = segment
+        hasher = None
+        headers = {}
+        if done > 0 or len(segments) > 1:
+            headers['Range'] = "bytes={}-{}".format(start + done, end if end is not None else "")
+            if done > 0 and validator is not None:
+                headers['If-Range'] = validator
+        try:
+            with g_http.request(dl_url_with_api, headers=headers) as response, \
+                    open(part_name, "r+b", buffering=0) as out_file:
+                if 'Range' in headers and response.status != 206:
+                    if len(segments) > 1:
+                        raise Exception("Expected 206 Partial Content, got {}".format(response.status))
+                    # Server sent the whole file, so start over
+                    with lock:
+                        state["downloaded"] -= done
+                        if blocks is not None:
+                            blocks.clear()
+                    segment[2] = done = 0
+                out_file.seek(start + done)
+
+                # Hash blocks as they are written. Resuming mid-block, the start
+                # of that block is read back to catch up.
+                if blocks is not None:
+                    hasher = BlockHasher(start + done)
+                    if hasher.pos > hasher.block*g_hash_block_size:
+                        with open(part_name, "rb") as in_file:
+                            in_file.seek(hasher.block*g_hash_block_size)
+                            hasher.hash.update(in_file.read(hasher.pos - hasher.block*g_hash_block_size))
+
+                remaining = end - start + 1 - done if end is not None else None
+                buffer = memoryview(bytearray(g_read_size))
+                while remaining is None or remaining > 0:
+                    if g_stop.is_set():
+                        raise DownloadInterrupted("Stopped at {} bytes into range {}-{}".format(segment[2], start, end))
+                    read_size = g_read_size if remaining is None else min(g_read_size, remaining)
+                    count = response.readinto(buffer[:read_size])
+                    if not count:
+                        if remaining is None:
+                            break
+                        raise ConnectionError("Connection closed with {} bytes left in range {}-{}".format(remaining, start, end))
+                    written = 0
+                    while written < count:
+                        written += out_file.write(buffer[written:count])
+                    if remaining is not None:
+                        remaining -= count
+                    metric_inc("dl_gb_download_bytes_total", count)
+                    finished = hasher.update(buffer[:count]) if hasher is not None else None
+                    with lock:
+                        if finished:
+                            blocks.update(finished)
+                        segment[2] += count
+                        state["downloaded"] += count
+                        transfer.done = state["downloaded"]
+                        # Checkpoint progress every few seconds
+                        if time.time() - state["last_save"] > g_sidecar_save_interval:
+                            save_sidecar(sidecar_name, sidecar)
+                            state["last_save"] = time.time()
+
+                # The last block of the file may be short
+                if hasher is not None:
+                    finished = hasher.finish()
+                    with lock:
+                        blocks.update(finished)
+        except DownloadInterrupted as e:
+            with lock:
+                if state["error"] is None:
+                    state["error"] = e
+        except Exception as e:
+            print(e)
+            print("ERROR: Exception during range {}-{} of {}!".format(start + done, end, part_name))
+            metric_inc("dl_gb_errors_total", type=type(e).__name__, stage="segment")
+            with lock:
+                if state["error"] is None:
+                    state["error"] = e
+
+    threads = []
+    for segment in segments:
+        if segment[1] is None or segment[0] + segment[2] <= segment[1]:
+            thread = threading.Thread(target=fetch_segment, args=(segment,), daemon=True)
+            thread.start()
+            threads.append(thread)
+    for thread in threads:
+        thread.join()
+    progress_finish(transfer)
+
+    # Record how far we got, so a failed download can resume next time
+    save_sidecar(sidecar_name, sidecar)
+    elapsed = time.time() - start_time
+    if state["error"] is not None:
+        raise state["error"]
+    if elapsed > 0:
+        metric_observe("dl_gb_download_throughput_bytes_per_second", (state["downloaded"] - resumed_bytes) / elapsed)
+        if g_scheduler is not None:
+            g_scheduler.observe_throughput((state["downloaded"] - resumed_bytes) / elapsed)
+    return {"size": total_size, "checksum": get_checksum(blocks, state["downloaded"]) if blocks is not None else None}
+
+################################################################################
+# Desc
+#   Reserves size bytes on disk for a file, so it is laid out in one piece
+#   instead of growing (and fragmenting) as it is written. Falls back to just
+#   setting the size where posix_fallocate is missing or unsupported.
+# Params
+#   out_file        file object opened for writing
+#   size            int size of the file in bytes
+# Returns
+#   None
+################################################################################
+def preallocate(out_file, size):
+    if g_preallocate and size > 0 and hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(out_file.fileno(), 0, size)
+            return
+        except OSError as e:
+            print("WARN: Could not preallocate {} ({}), writing a sparse file instead...".format(out_file.name, e))
+    out_file.truncate(size)
+
+################################################################################
+# Desc
+#   Flushes a file's data to disk
+# Params
+#   file_name       str name of the file
+# Returns
+#   None
+################################################################################
+def fsync_file(file_name):
+    fd = os.open(file_name, os.O_RDONLY)
+    try:
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+
+################################################################################
+# Desc
+#   Hashes one segment of a download as it is written, in g_hash_block_size
+#   blocks. Segments start on block boundaries, so every block is hashed in
+#   order by a single segment.
+################################################################################
+class BlockHasher:
+    def __init__(self, pos):
+        self.pos = pos
+        self.block = pos // g_hash_block_size
+        self.hash = hashlib.sha256()
+
+    # Hashes the next bytes, and returns {block index: hex digest} of the
+    # blocks they complete
+    def update(self, data):
+        finished = {}
+        offset = 0
+        while offset < len(data):
+            take = min(len(data) - offset, (self.block + 1)*g_hash_block_size - self.pos)
+            self.hash.update(data[offset:offset + take])
+            offset += take
+            self.pos += take
+            if self.pos == (self.block + 1)*g_hash_block_size:
+                finished[str(self.block)] = self.hash.hexdigest()
+                self.block += 1
+                self.hash = hashlib.sha256()
+        return finished
+
+    # Returns the digest of a short last block, once the segment is complete
     def finish(self):
-        print('|')
+        if self.pos > self.block*g_hash_block_size:
+            return {str(self.block): self.hash.hexdigest()}
+        return {}
+
+################################################################################
+# Desc
+#   Combines block hashes into the checksum of a file: the SHA-256 of the
+#   SHA-256 digests of its g_hash_block_size blocks, in order
+# Params
+#   blocks          dict of block index (str) to hex digest
+#   size            int size of the file in bytes
+# Returns
+#   str             hex checksum, or None if a block hash is missing
+################################################################################
+def get_checksum(blocks, size):
+    digests = []
+    for k in range(-(-size // g_hash_block_size)):
+        if str(k) not in blocks:
+            return None
+        digests.append(bytes.fromhex(blocks[str(k)]))
+    return hashlib.sha256(b"".join(digests)).hexdigest()
+
+################################################################################
+# Desc
+#   Computes the checksum of a file on disk (see get_checksum), for downloads
+#   that could not be hashed as they were written
+# Params
+#   file_name       str name of the file
+# Returns
+#   str             hex checksum
+################################################################################
+def hash_file(file_name):
+    blocks = {}
+    hasher = BlockHasher(0)
+    buffer = memoryview(bytearray(g_read_size))
+    with open(file_name, "rb", buffering=0) as in_file:
+        while True:
+            count = in_file.readinto(buffer)
+            if not count:
+                break
+            blocks.update(hasher.update(buffer[:count]))
+    blocks.update(hasher.finish())
+    return get_checksum(blocks, hasher.pos)
+
+################################################################################
+# Desc
+#   Gets the name of the sidecar file that tracks a .part file's progress
+# Params
+#   part_name       str name of the .part file
+# Returns
+#   str             name of the sidecar file
+################################################################################
+def get_sidecar_name(part_name):
+    return "{}.json".format(part_name)
+
+################################################################################
+# Desc
+#   Loads a .part sidecar: the expected size and validators (ETag and
+#   Last-Modified) of the file, and the [start, end, done] byte ranges
+# Params
+#   sidecar_name    str name of the sidecar file
+# Returns
+#   dict            sidecar contents, or None if missing or unreadable
+################################################################################
+def load_sidecar(sidecar_name):
+    try:
+        with open(sidecar_name, "r", encoding="utf-8") as sidecar_file:
+            return json.load(sidecar_file)
+    except FileNotFoundError:
+        return None
+    except Exception as e:
+        print(e)
+        print("WARN: Could not read {}, restarting download...".format(sidecar_name))
+        return None
+
+################################################################################
+# Desc
+#   Saves a .part sidecar, replacing the old one atomically
+# Params
+#   sidecar_name    str name of the sidecar file
+#   sidecar         dict sidecar contents
+# Returns
+#   None
+################################################################################
+def save_sidecar(sidecar_name, sidecar):
+    tmp_name = "{}.tmp".format(sidecar_name)
+    with open(tmp_name, "w", encoding="utf-8") as sidecar_file:
+        json.dump(sidecar, sidecar_file)
+    os.replace(tmp_name, sidecar_name)
+
+################################################################################
+# Desc
+#   Removes a file, ignoring it if it does not exist
+# Params
+#   file_name       str name of the file to remove
+# Returns
+#   None
+################################################################################
+def remove_if_exists(file_name):
+    try:
+        os.remove(file_name)
+    except FileNotFoundError:
+        pass
+
+################################################################################
+# Desc
+#   Compacts progress: atomically rewrites dl_dict and done_dict to the progress
+#   files, then empties the journal they now include. Caller must hold
+#   g_progress_lock.
+# Params
+#   dl_dict         dict of videos to download
+#   done_dict       dict of videos already downloaded
+# Returns
+#   None
+################################################################################
+def save_progress(dl_dict, done_dict):
+    try:
+        # Log videos that need to be downloaded, and make sure the ones that
+        # have been downloaded are on disk
+        write_progress_file(g_dl_file, dl_dict, g_quality_urls)
+        done_dict.save()
+    except Exception as e:
+        print(e)
+        print("WARN: Exception when compacting {} into {} and {}! Skipping...".format(g_journal_file, g_dl_file, g_done_index_file))
+        return
+
+    # Both files are in place, so the journal is no longer needed
+    if g_journal is not None:
+        g_journal.truncate()
+
+################################################################################
+# Desc
+#   Writes a progress dict to file_name, replacing the old file atomically
+# Params
+#   file_name       str name of the progress file
+#   progress_dict   dict of (dl_name, dl_url) to write
+#   quality_urls    dict of quality urls by dl_name (see note_quality_urls),
+#                   written after the url of the videos in it, or None
+# Returns
+#   None
+################################################################################
+def write_progress_file(file_name, progress_dict, quality_urls=None):
+    tmp_name = "{}.tmp".format(file_name)
+    with open(tmp_name, "w", encoding="utf-8") as progress_file:
+        for dl_name, dl_url in progress_dict.items():
+            urls = quality_urls.get(dl_name) if quality_urls is not None else None
+            if urls:
+                progress_file.write("\"{}\",\"{}\",{}\n".format(dl_name, dl_url, ",".join(
+                    "\"{}\"".format(urls.get(quality, "")) for quality in g_qualities)))
+            else:
+                progress_file.write("\"{}\",\"{}\"\n".format(dl_name, dl_url))
+        progress_file.flush()
+        os.fsync(progress_file.fileno())
+    os.replace(tmp_name, file_name)
+
+################################################################################
+# Desc
+#   Loads dl_dict from its progress file and opens the done index (converting
+#   done.csv into it the first time), replays the journal on top of them, and
+#   opens the journal for this run
+# Params
+#   None
+# Returns
+#   dl_dict         dict of videos to download
+#   done_dict       DoneIndex of videos already downloaded
+################################################################################
+def load_progress():
+    global g_journal
+    dl_dict = OrderedDict()
+
+    # Load files to download
+    try:
+        with open(g_dl_file, "r", encoding="utf-8") as dl_file:
+            print("Loading files to download from {}...".format(g_dl_file))
+            dl_reader = csv.reader(dl_file)
+            for row in dl_reader:
+                dl_dict[row[0]] = row[1]
+                if len(row) >= 2 + len(g_qualities):
+                    g_quality_urls[row[0]] = get_quality_urls_from_row(row[2:])
+    except FileNotFoundError:
+        print("Progress file {} not found. Creating...".format(g_dl_file))
+        with open(g_dl_file, "w", encoding="utf-8") as dl_file:
+            pass
+    except Exception as e:
+        print(e)
+        print("ERROR: Exception when loading from {}".format(g_dl_file))
+        return None, None
+
+    # Open the index of files that are finished
+    try:
+        done_dict = DoneIndex(g_done_index_file)
+        if os.path.exists(g_done_file):
+            migrate_done_file(done_dict)
+    except Exception as e:
+        print(e)
+        print("ERROR: Exception when loading from {}".format(g_done_index_file))
+        return None, None
+
+    # Replay state transitions logged since the last compaction
+    records = 0
+    replayed_done = OrderedDict()
+    try:
+        with open(g_journal_file, "r", encoding="utf-8", newline="") as journal_file:
+            print("Replaying progress journal {}...".format(g_journal_file))
+            for row in csv.reader(journal_file):
+                # Skip a partial last line left by a crash mid-write
+                if len(row) not in (3, 3 + len(g_qualities)):
+                    continue
+                state, dl_name, dl_url = row[:3]
+                if state == "queued":
+                    if dl_name not in replayed_done and dl_name not in done_dict:
+                        dl_dict[dl_name] = dl_url
+                        if len(row) > 3:
+                            g_quality_urls[dl_name] = get_quality_urls_from_row(row[3:])
+                elif state == "done":
+                    dl_dict.pop(dl_name, None)
+                    replayed_done[dl_name] = dl_url
+                elif state == "error":
+                    dl_dict.pop(dl_name, None)
+                records += 1
+    except FileNotFoundError:
+        pass
+    done_dict.add_many(replayed_done.items())
+
+    g_journal = ProgressJournal(g_journal_file, records)
+    return dl_dict, done_dict
+
+################################################################################
+# Desc
+#   Reads the quality urls of a video from a progress file or journal row
+# Params
+#   row             list of str url of each of g_qualities, empty if missing
+# Returns
+#   dict            url by quality
+################################################################################
+def get_quality_urls_from_row(row):
+    return {quality: url for quality, url in zip(g_qualities, row) if url}
+
+################################################################################
+# Desc
+#   Converts done.csv into the done index, then renames it so it is only
+#   converted once
+# Params
+#   done_dict       DoneIndex to add the videos to
+# Returns
+#   None
+################################################################################
+def migrate_done_file(done_dict):
+    print("Converting {} into {}...".format(g_done_file, g_done_index_file))
+    with open(g_done_file, "r", encoding="utf-8") as done_file:
+        done_dict.add_many((row[0], row[1]) for row in csv.reader(done_file) if len(row) >= 2)
+    done_dict.save()
+    os.replace(g_done_file, "{}.migrated".format(g_done_file))
+    print("Converted {} videos, {} was renamed to {}.migrated".format(len(done_dict), g_done_file, g_done_file))
+
+################################################################################
+# Desc
+#   Persistent index of downloaded videos in a SQLite file, by API video id
+#   where known (ids are noted when a video is queued) and by download name.
+#   Opening it costs the same however many videos it holds, and lookups use
+#   its indexes instead of loading the whole history. With g_done_bloom, a
+#   Bloom filter of every done id and name, kept in the index file, answers
+#   most lookups of videos not done without reading the file at all.
+#   Supports "in", [] assignment, len() and iteration over names like the
+#   done_dict it replaces.
+################################################################################
+class DoneIndex:
+    def __init__(self, index_file):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(index_file, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS videos (
+                               dl_name TEXT PRIMARY KEY,
+                               dl_url TEXT,
+                               id INTEGER,
+                               done INTEGER NOT NULL DEFAULT 0)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS videos_id ON videos (id)")
+        columns = [row[1] for row in self.db.execute("PRAGMA table_info(videos)")]
+        if "show" not in columns:
+            self.db.execute("ALTER TABLE videos ADD COLUMN show TEXT")
+        if "quality" not in columns:
+            # Quality a video was downloaded at, if below its best
+            self.db.execute("ALTER TABLE videos ADD COLUMN quality TEXT")
+        self.db.execute("CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value)")
+        self.count = self.get_meta("count")
+        if self.count is None:
+            self.count = self.db.execute("SELECT COUNT(*) FROM videos WHERE done = 1").fetchone()[0]
+
+        self.bloom = None
+        if g_done_bloom:
+            bits = self.get_meta("bloom")
+            if bits is not None and self.get_meta("bloom_count") == self.count and len(bits) == g_bloom_bits // 8:
+                self.bloom = BloomFilter(bits)
+            else:
+                # Missing or stale, so rebuild it once from the index
+                self.bloom = BloomFilter()
+                for dl_name, video_id in self.db.execute("SELECT dl_name, id FROM videos WHERE done = 1"):
+                    self.add_to_bloom(dl_name, video_id)
+
+    def get_meta(self, key):
+        row = self.db.execute("SELECT value FROM meta WHERE key = ?", (key,)).fetchone()
+        return row[0] if row is not None else None
+
+    def add_to_bloom(self, dl_name, video_id):
+        self.bloom.add("name:{}".format(dl_name))
+        if video_id is not None:
+            self.bloom.add("id:{}".format(video_id))
+
+    # Whether a video is done, by its id (if not None) or its name
+    def has(self, video_id, dl_name):
+        if self.bloom is not None:
+            if not self.bloom.might_contain("name:{}".format(dl_name)) and \
+                    (video_id is None or not self.bloom.might_contain("id:{}".format(video_id))):
+                return False
+        with self.lock:
+            if video_id is not None:
+                row = self.db.execute("SELECT 1 FROM videos WHERE done = 1 AND (dl_name = ? OR id = ?) LIMIT 1",
+                                      (dl_name, video_id)).fetchone()
+            else:
+                row = self.db.execute("SELECT 1 FROM videos WHERE done = 1 AND dl_name = ?", (dl_name,)).fetchone()
+        return row is not None
+
+    def __contains__(self, dl_name):
+        return self.has(None, dl_name)
+
+    def __setitem__(self, dl_name, dl_url):
+        self.add_many([(dl_name, dl_url)])
+
+    # Records videos as done, in one transaction
+    def add_many(self, items):
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                for dl_name, dl_url in items:
+                    cursor = self.db.execute("INSERT INTO videos (dl_name, dl_url, done) VALUES (?, ?, 1) "
+                                             "ON CONFLICT (dl_name) DO UPDATE SET dl_url = excluded.dl_url, done = 1 "
+                                             "WHERE done = 0 RETURNING id", (dl_name, dl_url))
+                    row = cursor.fetchone()
+                    if row is not None:
+                        self.count += 1
+                        if self.bloom is not None:
+                            self.add_to_bloom(dl_name, row[0])
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+
+    # Returns which of the given video ids have been queried before, done or not
+    def known_ids(self, video_ids):
+        if not video_ids:
+            return set()
+        with self.lock:
+            rows = self.db.execute("SELECT id FROM videos WHERE id IN ({})".format(",".join("?" * len(video_ids))),
+                                   video_ids).fetchall()
+        return set(row[0] for row in rows)
+
+    # Notes the API ids and show titles of queried videos, by name. Done videos
+    # without an id get it added to the Bloom filter too.
+    def add_ids(self, video_ids, shows):
+        if not video_ids:
+            return
+        with self.lock:
+            self.db.execute("BEGIN")
+            for dl_name, video_id in video_ids.items():
+                row = self.db.execute("INSERT INTO videos (dl_name, id) VALUES (?, ?) "
+                                      "ON CONFLICT (dl_name) DO UPDATE SET id = excluded.id "
+                                      "WHERE done = 0 OR id IS NULL RETURNING done", (dl_name, video_id)).fetchone()
+                if row is not None and row[0] and self.bloom is not None:
+                    self.bloom.add("id:{}".format(video_id))
+            self.db.executemany("UPDATE videos SET show = ? WHERE dl_name = ? AND show IS NOT ?",
+                                ((show, dl_name, show) for dl_name, show in shows.items()))
+            self.db.execute("COMMIT")
+
+    # Notes the quality a video was downloaded at, None for its best
+    def set_quality(self, dl_name, quality):
+        with self.lock:
+            self.db.execute("UPDATE videos SET quality = ? WHERE dl_name = ? AND quality IS NOT ?", (quality, dl_name, quality))
+
+    # Returns (dl_name, dl_url) of up to limit done videos downloaded below
+    # their best quality, newest first
+    def get_below_best(self, limit):
+        with self.lock:
+            return self.db.execute("SELECT dl_name, dl_url FROM videos WHERE done = 1 AND quality IS NOT NULL "
+                                   "ORDER BY dl_name DESC LIMIT ?", (limit,)).fetchall()
+
+    # Gets the show title noted for a video, or None
+    def get_show(self, dl_name):
+        with self.lock:
+            row = self.db.execute("SELECT show FROM videos WHERE dl_name = ?", (dl_name,)).fetchone()
+        return row[0] if row is not None else None
+
+    # Stores the Bloom filter and count, and flushes everything to disk
+    def save(self):
+        with self.lock:
+            self.db.execute("BEGIN")
+            self.db.execute("INSERT OR REPLACE INTO meta VALUES ('count', ?)", (self.count,))
+            if self.bloom is not None:
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES ('bloom', ?)", (bytes(self.bloom.bits),))
+                self.db.execute("INSERT OR REPLACE INTO meta VALUES ('bloom_count', ?)", (self.count,))
+            self.db.execute("COMMIT")
+            self.db.execute("PRAGMA wal_checkpoint(FULL)")
+
+    def close(self):
+        self.save()
+        self.db.close()
+
+    def __len__(self):
+        return self.count
+
+    def __iter__(self):
+        with self.lock:
+            names = [row[0] for row in self.db.execute("SELECT dl_name FROM videos WHERE done = 1")]
+        return iter(names)
+
+    def items(self):
+        with self.lock:
+            items = self.db.execute("SELECT dl_name, dl_url FROM videos WHERE done = 1").fetchall()
+        return iter(items)
+
+################################################################################
+# Desc
+#   Gets the directories scanned into the library index
+# Params
+#   None
+# Returns
+#   list of (str directory, bool whether to scan its subdirectories)
+################################################################################
+def get_library_roots():
+    roots = [(".", False)]
+    for root in g_library_roots + ([g_library_dir] if g_library_dir is not None else []):
+        if os.path.normpath(root) not in [path for path, recursive in roots]:
+            roots.append((os.path.normpath(root), True))
+    return roots
+
+################################################################################
+# Desc
+#   Index of the videos on disk: path, size, mtime and a partial hash (see
+#   get_partial_hash) of every .mp4 under the library roots, by video id and
+#   file name. Kept in the done index file, so ids are filled in from it.
+#
+#   A scan only lists directories whose mtime changed since the last one, and
+#   only stats the files in those, so a directory is changed by files being
+#   added, removed or renamed, but not by a file being rewritten in place.
+#   Directories are scanned by g_scan_workers threads at once. A file's size
+#   is checked again with one stat right before it is relied on (see find).
+################################################################################
+class LibraryIndex:
+    def __init__(self, index_file):
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(index_file, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode=WAL")
+        self.db.execute("PRAGMA synchronous=NORMAL")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS library_files (
+                               path TEXT PRIMARY KEY,
+                               dir TEXT NOT NULL,
+                               dl_name TEXT NOT NULL,
+                               id INTEGER,
+                               size INTEGER NOT NULL,
+                               mtime INTEGER NOT NULL,
+                               partial_hash TEXT)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS library_files_dir ON library_files (dir)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS library_files_name ON library_files (dl_name)")
+        self.db.execute("CREATE INDEX IF NOT EXISTS library_files_id ON library_files (id)")
+        self.db.execute("""CREATE TABLE IF NOT EXISTS library_dirs (
+                               path TEXT PRIMARY KEY,
+                               parent TEXT,
+                               mtime INTEGER NOT NULL)""")
+
+    # Brings the index up to date with the given roots (see get_library_roots)
+    def scan(self, roots):
+        start_time = time.time()
+        with self.lock:
+            known_dirs = {path: mtime for path, mtime in self.db.execute("SELECT path, mtime FROM library_dirs")}
+            children = {}
+            for path, parent in self.db.execute("SELECT path, parent FROM library_dirs WHERE parent IS NOT NULL"):
+                children.setdefault(parent, []).append(path)
+
+        todo = deque((path, None, recursive) for path, recursive in roots)
+        results = []
+        cond = threading.Condition()
+        state = {"busy": 0}
+
+        def scan_worker():
+            while True:
+                with cond:
+                    while not todo and state["busy"] > 0:
+                        cond.wait()
+                    if not todo:
+                        cond.notify_all()
+                        return
+                    path, parent, recursive = todo.popleft()
+                    state["busy"] += 1
+                try:
+                    result = self.scan_dir(path, parent, recursive, known_dirs, children)
+                except Exception as e:
+                    print(e)
+                    print("WARN: Could not scan {}, keeping what was indexed".format(path))
+                    result = None
+                with cond:
+                    if result is not None:
+                        results.append(result)
+                        todo.extend((subdir, path, True) for subdir in result[4])
+                    state["busy"] -= 1
+                    cond.notify_all()
+
+        threads = [threading.Thread(target=scan_worker, name="scan-{}".format(k), daemon=True)
+                   for k in range(g_scan_workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+        # Apply every change in one transaction
+        changed = 0
+        with self.lock:
+            self.db.execute("BEGIN")
+            try:
+                for path, parent, mtime, files, subdirs in results:
+                    if mtime is None:
+                        self.remove_dir(path)
+                        continue
+                    self.db.execute("INSERT OR REPLACE INTO library_dirs VALUES (?, ?, ?)", (path, parent, mtime))
+                    if files is None:
+                        continue
+                    changed += 1
+                    for old_dir in set(children.get(path, [])) - set(subdirs):
+                        self.remove_dir(old_dir)
+                    old_paths = {row[0] for row in self.db.execute("SELECT path FROM library_files WHERE dir = ?", (path,))}
+                    self.db.executemany("DELETE FROM library_files WHERE path = ?",
+                                        [(old_path,) for old_path in old_paths - {row[0] for row in files}])
+                    self.db.executemany("INSERT INTO library_files (path, dir, dl_name, id, size, mtime, partial_hash) "
+                                        "VALUES (?, ?, ?, (SELECT id FROM videos WHERE dl_name = ?), ?, ?, ?) ON CONFLICT (path) DO UPDATE SET "
+                                        "size = excluded.size, mtime = excluded.mtime, partial_hash = excluded.partial_hash",
+                                        [(file_path, path, dl_name, dl_name, size, file_mtime, partial_hash)
+                                         for file_path, dl_name, size, file_mtime, partial_hash in files])
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            count = self.db.execute("SELECT COUNT(*) FROM library_files").fetchone()[0]
+        print("Scanned library: {} of {} directories changed, {} videos indexed in {:.1f}s".format(
+            changed, len(results), count, time.time() - start_time))
+
+    # Scans one directory, listing it only if its mtime changed. Returns
+    # (path, parent, mtime, files, subdirs): mtime is None if it is gone, and
+    # files is None if it is unchanged, else a list of (path, dl_name, size,
+    # mtime, partial hash).
+    def scan_dir(self, path, parent, recursive, known_dirs, children):
+        try:
+            mtime = os.stat(path).st_mtime_ns
+        except FileNotFoundError:
+            return path, parent, None, None, []
+        if known_dirs.get(path) == mtime:
+            return path, parent, mtime, None, children.get(path, []) if recursive else []
+
+        with self.lock:
+            old_files = {row[0]: row[1:] for row in self.db.execute(
+                "SELECT path, size, mtime, partial_hash FROM library_files WHERE dir = ?", (path,))}
+        files = []
+        subdirs = []
+        with os.scandir(path) as entries:
+            for entry in entries:
+                if entry.is_dir(follow_symlinks=False):
+                    if recursive:
+                        subdirs.append(os.path.normpath(entry.path))
+                elif entry.name.endswith(".mp4") and entry.is_file():
+                    file_path = os.path.normpath(entry.path)
+                    stat = entry.stat()
+                    old = old_files.get(file_path)
+                    if old is not None and old[0] == stat.st_size and old[1] == stat.st_mtime_ns:
+                        partial_hash = old[2]
+                    else:
+                        partial_hash = get_partial_hash(file_path, stat.st_size)
+                    files.append((file_path, entry.name, stat.st_size, stat.st_mtime_ns, partial_hash))
+        return path, parent, mtime, files, subdirs
+
+    # Fills in ids of videos indexed before they were queried, given a dict of
+    # video ids by file name
+    def fill_ids(self, video_ids):
+        with self.lock:
+            self.db.executemany("UPDATE library_files SET id = ? WHERE dl_name = ? AND id IS NULL",
+                                [(video_id, dl_name) for dl_name, video_id in video_ids.items()])
+
+    # Drops a directory and everything under it. Called with the lock held.
+    def remove_dir(self, path):
+        prefix = os.path.join(path, "")
+        self.db.execute("DELETE FROM library_dirs WHERE path = ? OR substr(path, 1, ?) = ?", (path, len(prefix), prefix))
+        self.db.execute("DELETE FROM library_files WHERE dir = ? OR substr(dir, 1, ?) = ?", (path, len(prefix), prefix))
+
+    # Finds a video on disk by id (if not None) or file name, checking its size
+    # with one stat. Returns (path, size), or None.
+    def find(self, video_id, dl_name):
+        with self.lock:
+            row = self.db.execute("SELECT path FROM library_files WHERE id = ? OR dl_name = ? ORDER BY id = ? DESC LIMIT 1",
+                                  (video_id, dl_name, video_id)).fetchone()
+        if row is None:
+            return None
+        try:
+            stat = os.stat(row[0])
+        except FileNotFoundError:
+            self.remove(row[0])
+            return None
+        with self.lock:
+            self.db.execute("UPDATE library_files SET size = ?, mtime = ? WHERE path = ?", (stat.st_size, stat.st_mtime_ns, row[0]))
+        return row[0], stat.st_size
+
+    # Whether a complete copy of a video is on disk, given its expected size
+    def is_complete(self, video_id, dl_name, expected_size):
+        if expected_size is None:
+            return False
+        entry = self.find(video_id, dl_name)
+        return entry is not None and entry[1] == expected_size
+
+    # Indexes a video just written to path
+    def record(self, path, dl_name):
+        path = os.path.normpath(path)
+        stat = os.stat(path)
+        partial_hash = get_partial_hash(path, stat.st_size)
+        with self.lock:
+            self.db.execute("INSERT OR REPLACE INTO library_files (path, dir, dl_name, id, size, mtime, partial_hash) "
+                            "VALUES (?, ?, ?, (SELECT id FROM videos WHERE dl_name = ?), ?, ?, ?)",
+                            (path, os.path.dirname(path) or ".", dl_name, dl_name, stat.st_size, stat.st_mtime_ns, partial_hash))
+
+    def remove(self, path):
+        with self.lock:
+            self.db.execute("DELETE FROM library_files WHERE path = ?", (path,))
+
+    def close(self):
+        self.db.close()
+
+################################################################################
+# Desc
+#   Hashes the first and last g_partial_hash_size bytes of a file, with its
+#   size, to tell files apart without reading them whole
+# Params
+#   path            str path of the file
+#   size            int size of the file
+# Returns
+#   str             hex SHA-256
+################################################################################
+def get_partial_hash(path, size):
+    hasher = hashlib.sha256(str(size).encode("ascii"))
+    with open(path, "rb") as in_file:
+        hasher.update(in_file.read(g_partial_hash_size))
+        if size > 2*g_partial_hash_size:
+            in_file.seek(size - g_partial_hash_size)
+        hasher.update(in_file.read(g_partial_hash_size))
+    return hasher.hexdigest()
+
+################################################################################
+# Desc
+#   Bloom filter of g_bloom_bits bits and g_bloom_hashes hashes per key. Never
+#   misses a key that was added, and wrongly reports others with a small
+#   chance that grows as it fills.
+################################################################################
+class BloomFilter:
+    def __init__(self, bits=None):
+        self.size = g_bloom_bits
+        self.bits = bytearray(bits) if bits is not None else bytearray(self.size // 8)
+
+    # Double hashing: positions h1 + k*h2 from one 128 bit digest
+    def get_hashes(self, key):
+        digest = int.from_bytes(hashlib.blake2b(key.encode("utf-8"), digest_size=16).digest(), "little")
+        return digest & 0xffffffffffffffff, (digest >> 64) | 1
+
+    def add(self, key):
+        h1, h2 = self.get_hashes(key)
+        for k in range(g_bloom_hashes):
+            pos = (h1 + k*h2) % self.size
+            self.bits[pos >> 3] |= 1 << (pos & 7)
+
+    def might_contain(self, key):
+        h1, h2 = self.get_hashes(key)
+        for k in range(g_bloom_hashes):
+            pos = (h1 + k*h2) % self.size
+            if not self.bits[pos >> 3] & (1 << (pos & 7)):
+                return False
+        return True
+
+################################################################################
+# Desc
+#   Append-only journal of progress state transitions (queued, done, error).
+#   Records are fsynced every g_journal_sync_every writes, and folded into the
+#   progress files by save_progress once g_journal_compact_every accumulate.
+################################################################################
+class ProgressJournal:
+    def __init__(self, journal_file, records=0):
+        self.journal_file = journal_file
+        self.records = records          # Records since the last compaction
+        self.unsynced = 0               # Records since the last fsync
+        self.file = open(journal_file, "a", encoding="utf-8", newline="")
+        self.writer = csv.writer(self.file, quoting=csv.QUOTE_ALL, lineterminator="\n")
+        self.lock = threading.Lock()
+
+    # Logs a transition. Queued videos may carry their quality urls too.
+    def record(self, state, dl_name, dl_url, quality_urls=None):
+        row = [state, dl_name, dl_url]
+        if quality_urls:
+            row += [quality_urls.get(quality, "") for quality in g_qualities]
+        with self.lock:
+            self.writer.writerow(row)
+            self.records += 1
+            self.unsynced += 1
+            if self.unsynced >= g_journal_sync_every:
+                self.sync()
+
+    def sync(self):
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.unsynced = 0
+
+    def needs_compaction(self):
+        return self.records >= g_journal_compact_every
+
+    def truncate(self):
+        with self.lock:
+            self.file.seek(0)
+            self.file.truncate()
+            self.sync()
+            self.records = 0
+
+    def close(self):
+        with self.lock:
+            self.sync()
+            self.file.close()
+
+################################################################################
+# Desc
+#   Raised by HttpClient for responses with an error status (4xx or 5xx)
+################################################################################
+class HttpError(Exception):
+    def __init__(self, status, reason, url):
+        super().__init__("HTTP Error {}: {} ({})".format(status, reason, url))
+        self.status = status
+        self.reason = reason
+        self.url = url
+
+################################################################################
+# Desc
+#   Raised by a transfer stopped by SIGTERM. Its progress is saved in its
+#   sidecar, and it stays queued to resume next run.
+################################################################################
+class DownloadInterrupted(Exception):
+    pass
+
+################################################################################
+# Desc
+#   Raised when a finished download is not the size the server announced. The
+#   file is deleted, and the download retried.
+################################################################################
+class VerifyError(Exception):
+    pass
+
+################################################################################
+# Desc
+#   Shared HTTP client used by every network call. Keeps up to g_http_max_idle
+#   keep-alive connections per host, so repeated calls skip the DNS lookup and
+#   TCP/TLS handshakes. Follows redirects, applies g_http_timeout and
+#   g_user_agent, and can ask for gzip/deflate compressed responses.
+################################################################################
+class HttpClient:
+    def __init__(self):
+        self.idle = {}              # (scheme, host, port) -> idle connections
+        self.lock = threading.Lock()
+        self.ssl_context = ssl.create_default_context()
+
+    # Sends a request and returns its HttpResponse. Raises HttpError for error
+    # statuses. Set compressed for responses worth compressing, like the API's.
+    def request(self, url, method="GET", headers=None, compressed=False, max_redirects=5):
+        for k in range(max_redirects + 1):
+            response = self.request_once(url, method, headers, compressed)
+            location = response.headers.get("Location")
+            if response.status in (301, 302, 303, 307, 308) and location:
+                response.drain()
+                url = urllib.parse.urljoin(url, location)
+                if response.status == 303:
+                    method = "GET"
+                continue
+            if response.status >= 400:
+                response.drain()
+                raise HttpError(response.status, response.reason, url)
+            return response
+        raise HttpError(response.status, "Too many redirects", url)
+
+    def request_once(self, url, method, headers, compressed):
+        parts = urllib.parse.urlsplit(url)
+        key = (parts.scheme, parts.hostname, parts.port)
+        path = parts.path or "/"
+        if parts.query:
+            path = "{}?{}".format(path, parts.query)
+
+        all_headers = {'User-Agent': g_user_agent}
+        if compressed:
+            all_headers['Accept-Encoding'] = "gzip, deflate"
+        if headers:
+            all_headers.update(headers)
+
+        # A pooled connection may have been closed by the server while idle,
+        # so retry once on a fresh connection if a reused one fails
+        while True:
+            conn, reused = self.get_connection(key)
+            try:
+                conn.request(method, path, headers=all_headers)
+                raw = conn.getresponse()
+                return HttpResponse(self, key, conn, raw, url, method)
+            except (http.client.RemoteDisconnected, ConnectionError, http.client.BadStatusLine):
+                conn.close()
+                if not reused:
+                    raise
+            except Exception:
+                conn.close()
+                raise
+
+    def get_connection(self, key):
+        with self.lock:
+            pool = self.idle.get(key)
+            if pool:
+                return pool.pop(), True
+        scheme, host, port = key
+        if scheme == "https":
+            return http.client.HTTPSConnection(host, port, timeout=g_http_timeout, context=self.ssl_context), False
+        return http.client.HTTPConnection(host, port, timeout=g_http_timeout), False
+
+    def release_connection(self, key, conn):
+        with self.lock:
+            pool = self.idle.setdefault(key, [])
+            if len(pool) < g_http_max_idle:
+                pool.append(conn)
+                return
+        conn.close()
+
+    def close(self):
+        with self.lock:
+            for pool in self.idle.values():
+                for conn in pool:
+                    conn.close()
+            self.idle = {}
+
+################################################################################
+# Desc
+#   Response from HttpClient. Decompresses gzip/deflate bodies, and hands its
+#   connection back to the pool once the body has been read to the end.
+################################################################################
+class HttpResponse:
+    def __init__(self, client, key, conn, raw, url, method):
+        self.client = client
+        self.key = key
+        self.conn = conn
+        self.raw = raw
+        self.url = url
+        self.status = raw.status
+        self.reason = raw.reason
+        self.headers = raw.headers
+        self.buffer = b""               # Decompressed bytes not yet returned
+        self.decoded = False            # Whether the decoder has been flushed
+        encoding = raw.headers.get("Content-Encoding", "").strip().lower()
+        if encoding == "gzip":
+            self.decoder = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        elif encoding == "deflate":
+            self.decoder = zlib.decompressobj()
+        else:
+            self.decoder = None
+
+        # Bodiless responses are already complete
+        if method == "HEAD" or raw.status in (204, 304) or raw.length == 0:
+            raw.read()
+        self.check_done()
+
+    def read(self, size=-1):
+        if self.decoder is None:
+            data = self.raw.read() if size is None or size < 0 else self.raw.read(size)
+        else:
+            # Decompress until there is enough to return, or the body ends
+            while (size is None or size < 0 or len(self.buffer) < size) and not self.decoded:
+                chunk = self.raw.read(64*1024)
+                if chunk:
+                    self.buffer += self.decoder.decompress(chunk)
+                if not chunk or self.raw.isclosed():
+                    self.buffer += self.decoder.flush()
+                    self.decoded = True
+            if size is None or size < 0:
+                data, self.buffer = self.buffer, b""
+            else:
+                data, self.buffer = self.buffer[:size], self.buffer[size:]
+        self.check_done()
+        return data
+
+    def readinto(self, buffer):
+        if self.decoder is not None:
+            data = self.read(len(buffer))
+            buffer[:len(data)] = data
+            return len(data)
+        count = self.raw.readinto(buffer)
+        self.check_done()
+        return count
+
+    # Reads and discards the rest of the body, so the connection can be reused
+    def drain(self):
+        while self.conn is not None and self.raw.read(64*1024):
+            pass
+        self.check_done()
+        self.close()
+
+    def check_done(self):
+        if self.conn is not None and self.raw.isclosed() and not self.buffer:
+            if self.raw.will_close:
+                self.conn.close()
+            else:
+                self.client.release_connection(self.key, self.conn)
+            self.conn = None
+
+    def close(self):
+        # Closing with body left unread means the connection can't be reused
+        if self.conn is not None:
+            self.conn.close()
+            self.conn = None
+        self.raw.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+################################################################################
+# Desc
+#   Takes a download slot from the download rate limiter, returns when rate
+#   limit is not exceeded
+# Params
+#   None
+# Returns
+#   None
+################################################################################
+def inc_and_check_dl_rate():
+    g_dl_limiter.acquire()
+
+################################################################################
+# Desc
+#   Takes a request slot from the request rate limiter, returns when rate limit
+#   is not exceeded
+# Params
+#   None
+# Returns
+#   None
+################################################################################
+def inc_and_check_rq_rate():
+    g_rq_limiter.acquire()
+
+################################################################################
+# Desc
+#   Sliding-window rate limiter allowing max_count events in any window seconds.
+#   Event timestamps are kept in state_file, so the limit holds across restarts
+#   and across every worker and process sharing the file. acquire() sleeps
+#   exactly until the oldest event in the window expires.
+#
+#   Plans (see plan_downloads) keep the timestamps in memory instead, seeded
+#   from state_file, and read the time from a virtual clock.
+################################################################################
+class RateLimiter:
+    def __init__(self, name, max_count, window, state_file, clock=time.time):
+        self.name = name
+        self.max_count = max(1, max_count)
+        self.window = window
+        self.state_file = state_file
+        self.clock = clock              # Returns the current unix time
+        self.times = None               # deque of event times kept in memory instead of state_file, or None
+        self.count = 0                  # Events taken by this process
+        self.lock = threading.Lock()
+
+    def acquire(self):
+        while True:
+            with self.lock:
+                wait_time = self.try_acquire()
+            if wait_time <= 0:
+                return
+            print("{} {} in the last {}s, Max {}. Waiting {:.1f}s...".format(
+                self.name, self.max_count, self.window, self.max_count, wait_time))
+            metric_inc("dl_gb_rate_limit_waits_total", limiter=self.name)
+            with timed_metric("dl_gb_rate_limit_wait_seconds", limiter=self.name):
+                rate_sleep(self.name, wait_time)
+
+    # Records an event if there is room, returns 0, or else the seconds until
+    # the next slot frees up
+    def try_acquire(self):
+        if self.times is not None:
+            return self.take(self.times, self.clock())
+
+        with open(self.state_file, "a+", encoding="utf-8") as state_file:
+            if fcntl:
+                fcntl.flock(state_file, fcntl.LOCK_EX)
+            try:
+                state_file.seek(0)
+                times = self.read_times(state_file)
+                wait_time = self.take(times, self.clock())
+                if wait_time > 0:
+                    return wait_time
+
+                # Rewrite with only the events still inside the window
+                state_file.seek(0)
+                state_file.truncate()
+                state_file.write("".join("{:.3f}\n".format(t) for t in times))
+                state_file.flush()
+                return 0
+            finally:
+                if fcntl:
+                    fcntl.flock(state_file, fcntl.LOCK_UN)
+
+    # Drops events that left the window from times (a deque, oldest first),
+    # and records one now if there is room. Returns 0, or else the seconds
+    # until the next slot frees up.
+    def take(self, times, now):
+        while times and times[0] <= now - self.window:
+            times.popleft()
+        if len(times) >= self.max_count:
+            return times[len(times) - self.max_count] + self.window - now
+        times.append(now)
+        self.count += 1
+        return 0
+
+    # Reads event times from an open state file, as a deque oldest first
+    def read_times(self, state_file):
+        times = []
+        for line in state_file:
+            try:
+                times.append(float(line))
+            except ValueError:
+                continue
+        times.sort()
+        return deque(times)
+
+    # Switches to event times kept in memory, read from state_file once
+    def keep_in_memory(self):
+        try:
+            with open(self.state_file, "r", encoding="utf-8") as state_file:
+                self.times = self.read_times(state_file)
+        except FileNotFoundError:
+            self.times = deque()
+
+################################################################################
+# Desc
+#   Sleeps while a rate limit is exceeded, showing it in g_progress, or with a
+#   sleep bar if there is no progress display
+# Params
+#   name            str name of the rate limiter
+#   sleep_time      float time to sleep in seconds
+# Returns
+#   None
+################################################################################
+def rate_sleep(name, sleep_time):
+    if g_progress is None:
+        sleep_bar(sleep_time)
+        return
+    g_progress.set_sleep(name, time.time() + sleep_time)
+    try:
+        g_stop.wait(sleep_time)
+    finally:
+        g_progress.clear_sleep(name)
+    if g_stop.is_set():
+        raise DownloadInterrupted("Stopped while waiting on the {} limit".format(name))
+
+################################################################################
+# Desc
+#   Registers a transfer with g_progress, if there is one
+# Params
+#   name            str name to show for the transfer
+#   total           int total bytes, or None if unknown
+#   done            int bytes already downloaded (by an earlier attempt)
+# Returns
+#   Transfer        to update as bytes arrive
+################################################################################
+def progress_start(name, total, done):
+    transfer = Transfer(name, total, done)
+    if g_progress is not None:
+        g_progress.add(transfer)
+    return transfer
+
+################################################################################
+# Desc
+#   Removes a transfer from g_progress, if there is one
+# Params
+#   transfer        Transfer from progress_start
+# Returns
+#   None
+################################################################################
+def progress_finish(transfer):
+    if g_progress is not None:
+        g_progress.remove(transfer)
+
+################################################################################
+# Desc
+#   Byte counts of one download. The downloading thread only assigns done,
+#   which is atomic, and the display thread only reads it, so updating
+#   progress costs the transfer loop no locking or printing.
+################################################################################
+class Transfer:
+    def __init__(self, name, total, done):
+        self.name = name
+        self.total = total
+        self.done = done
+        self.start_done = done
+        self.samples = deque([(time.time(), done)])  # (time, done) seen by the display
+
+    # Bytes/second over the display's recent samples
+    def get_speed(self):
+        if len(self.samples) < 2:
+            return 0
+        (t0, d0), (t1, d1) = self.samples[0], self.samples[-1]
+        return (d1 - d0) / (t1 - t0) if t1 > t0 else 0
+
+################################################################################
+# Desc
+#   Combined progress view of every active transfer, redrawn by a background
+#   thread every g_progress_refresh seconds: per file and total speed, ETA, and
+#   which rate limiters are sleeping. On a terminal it replaces sys.stdout, so
+#   other output is printed above the view instead of through it. When output
+#   is not a terminal it logs a summary line every g_progress_log_interval
+#   seconds instead.
+################################################################################
+class ProgressDisplay:
+    speed_window = 5                    # Seconds of samples speeds are measured over
+
+    def __init__(self, stream):
+        self.stream = stream
+        self.is_tty = stream.isatty()
+        self.lock = threading.Lock()
+        self.transfers = []
+        self.finished_bytes = 0         # Bytes of removed transfers, this run
+        self.total_samples = deque()    # (time, total bytes this run)
+        self.sleeping = {}              # Rate limiter name -> wake time
+        self.drawn_lines = 0
+        self.partial = {}               # Thread id -> text not yet ended by a newline
+        self.last_log = time.time()
+        self.stop_event = threading.Event()
+        self.thread = None
+
+    def start(self):
+        if self.is_tty:
+            sys.stdout = self
+        self.thread = threading.Thread(target=self.run, name="progress", daemon=True)
+        self.thread.start()
+
+    def stop(self):
+        if self.thread is None:
+            return
+        self.stop_event.set()
+        self.thread.join()
+        self.thread = None
+        with self.lock:
+            self.clear()
+            for text in self.partial.values():
+                self.stream.write(text + "\n")
+            self.partial.clear()
+            self.stream.flush()
+        if sys.stdout is self:
+            sys.stdout = self.stream
+
+    def add(self, transfer):
+        with self.lock:
+            self.transfers.append(transfer)
+
+    def remove(self, transfer):
+        with self.lock:
+            if transfer in self.transfers:
+                self.transfers.remove(transfer)
+                self.finished_bytes += transfer.done - transfer.start_done
+
+    def set_sleep(self, name, wake_time):
+        with self.lock:
+            self.sleeping[name] = wake_time
+
+    def clear_sleep(self, name):
+        with self.lock:
+            self.sleeping.pop(name, None)
+
+    # Stand-in for sys.stdout: holds each thread's text until its line is
+    # complete, then prints the lines above the view and redraws it
+    def write(self, text):
+        with self.lock:
+            key = threading.get_ident()
+            lines, newline, rest = (self.partial.pop(key, "") + text).rpartition("\n")
+            if rest:
+                self.partial[key] = rest
+            if newline:
+                self.clear()
+                self.stream.write(lines + newline)
+                self.draw()
+        return len(text)
+
+    def flush(self):
+        self.stream.flush()
+
+    def isatty(self):
+        return self.is_tty
+
+    def run(self):
+        while not self.stop_event.wait(g_progress_refresh):
+            with self.lock:
+                self.sample()
+                if self.is_tty:
+                    self.clear()
+                    self.draw()
+                    self.stream.flush()
+                elif time.time() - self.last_log >= g_progress_log_interval:
+                    self.last_log = time.time()
+                    if self.transfers or self.sleeping:
+                        self.stream.write("Progress: {}\n".format(self.get_summary()))
+                        self.stream.flush()
+
+    def sample(self):
+        now = time.time()
+        total = self.finished_bytes
+        for transfer in self.transfers:
+            transfer.samples.append((now, transfer.done))
+            while now - transfer.samples[0][0] > self.speed_window:
+                transfer.samples.popleft()
+            total += transfer.done - transfer.start_done
+        self.total_samples.append((now, total))
+        while now - self.total_samples[0][0] > self.speed_window:
+            self.total_samples.popleft()
+
+    def get_summary(self):
+        speed = 0
+        if len(self.total_samples) > 1:
+            (t0, b0), (t1, b1) = self.total_samples[0], self.total_samples[-1]
+            speed = (b1 - b0) / (t1 - t0) if t1 > t0 else 0
+        total = self.total_samples[-1][1] if self.total_samples else 0
+        remaining = sum(t.total - t.done for t in self.transfers if t.total)
+        summary = "{} active, {:.1f} MB this run, {:.2f} MB/s, ETA {}".format(
+            len(self.transfers), total/1e6, speed/1e6, format_eta(remaining, speed))
+        for name, wake_time in sorted(self.sleeping.items()):
+            summary += " | {} limit, sleeping {:.0f}s".format(name, max(0, wake_time - time.time()))
+        return summary
+
+    def draw(self):
+        if not self.transfers and not self.sleeping:
+            return
+        lines = []
+        for transfer in self.transfers[:g_progress_max_lines]:
+            speed = transfer.get_speed()
+            if transfer.total:
+                lines.append("  {:<48.48} {:>5.1f}% {:>9.1f} MB {:>7.2f} MB/s ETA {}".format(
+                    transfer.name, 100*transfer.done/transfer.total, transfer.total/1e6, speed/1e6,
+                    format_eta(transfer.total - transfer.done, speed)))
+            else:
+                lines.append("  {:<48.48} {:>9.1f} MB so far {:>7.2f} MB/s".format(
+                    transfer.name, transfer.done/1e6, speed/1e6))
+        if len(self.transfers) > g_progress_max_lines:
+            lines.append("  ...and {} more".format(len(self.transfers) - g_progress_max_lines))
+        lines.append("Total: {}".format(self.get_summary()))
+        self.stream.write("\n".join(lines) + "\n")
+        self.drawn_lines = len(lines)
+
+    def clear(self):
+        # Move to the start of the drawn view and erase to the end of screen
+        if self.drawn_lines:
+            self.stream.write("\x1b[{}F\x1b[J".format(self.drawn_lines))
+            self.drawn_lines = 0
+
+################################################################################
+# Desc
+#   Formats the time left for a number of bytes at a speed
+# Params
+#   remaining       int bytes left
+#   speed           float bytes/second
+# Returns
+#   str             h:mm:ss, or "?" if the speed is 0
+################################################################################
+def format_eta(remaining, speed):
+    if speed <= 0:
+        return "?" if remaining > 0 else "0:00:00"
+    seconds = int(remaining / speed)
+    return "{}:{:02d}:{:02d}".format(seconds // 3600, seconds // 60 % 60, seconds % 60)
+
+################################################################################
+# Desc
+#   Thread-safe store of counters, gauges and histograms describing the run.
+#   Metrics are named and labeled Prometheus style, and can be written as a
+#   Prometheus textfile (g_metrics_prom_file) and as JSON (g_metrics_json_file),
+#   periodically by a background exporter thread.
+################################################################################
+class Metrics:
+    # Histogram bucket upper bounds, by metric name suffix
+    buckets = {
+        "_seconds": [0.01, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300, 900, 3600],
+        "_bytes_per_second": [1e5, 5e5, 1e6, 2.5e6, 5e6, 1e7, 2.5e7, 5e7, 1e8, 1e9],
+    }
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}          # name -> {labels: value}
+        self.gauges = {}            # name -> {labels: value}
+        self.histograms = {}        # name -> {labels: [bucket counts..., sum, count]}
+        self.start_time = time.time()
+        self.stop_event = threading.Event()
+        self.exporter = None
+
+    def inc(self, name, value, labels):
+        with self.lock:
+            series = self.counters.setdefault(name, {})
+            series[labels] = series.get(labels, 0) + value
+
+    def set(self, name, value, labels):
+        with self.lock:
+            self.gauges.setdefault(name, {})[labels] = value
+
+    def observe(self, name, value, labels):
+        bounds = self.get_buckets(name)
+        with self.lock:
+            series = self.histograms.setdefault(name, {})
+            hist = series.get(labels)
+            if hist is None:
+                hist = series[labels] = [0] * (len(bounds) + 2)
+            for k, bound in enumerate(bounds):
+                if value <= bound:
+                    hist[k] += 1
+            hist[-2] += value
+            hist[-1] += 1
+
+    def get_buckets(self, name):
+        for suffix, bounds in self.buckets.items():
+            if name.endswith(suffix):
+                return bounds
+        return self.buckets["_seconds"]
+
+    def to_prometheus(self):
+        def format_labels(labels, extra=()):
+            pairs = list(labels) + list(extra)
+            if not pairs:
+                return ""
+            return "{" + ",".join("{}=\"{}\"".format(k, str(v).replace("\\", "\\\\").replace("\"", "\\\"")) for k, v in pairs) + "}"
+
+        lines = []
+        with self.lock:
+            for name, series in sorted(self.counters.items()):
+                lines.append("# TYPE {} counter".format(name))
+                for labels, value in series.items():
+                    lines.append("{}{} {}".format(name, format_labels(labels), value))
+            for name, series in sorted(self.gauges.items()):
+                lines.append("# TYPE {} gauge".format(name))
+                for labels, value in series.items():
+                    lines.append("{}{} {}".format(name, format_labels(labels), value))
+            for name, series in sorted(self.histograms.items()):
+                bounds = self.get_buckets(name)
+                lines.append("# TYPE {} histogram".format(name))
+                for labels, hist in series.items():
+                    for k, bound in enumerate(bounds):
+                        lines.append("{}_bucket{} {}".format(name, format_labels(labels, [("le", bound)]), hist[k]))
+                    lines.append("{}_bucket{} {}".format(name, format_labels(labels, [("le", "+Inf")]), hist[-1]))
+                    lines.append("{}_sum{} {}".format(name, format_labels(labels), hist[-2]))
+                    lines.append("{}_count{} {}".format(name, format_labels(labels), hist[-1]))
+        return "\n".join(lines) + "\n"
+
+    def to_json(self):
+        def series_list(series, convert):
+            return [dict(list(labels) + [("value", convert(value))]) for labels, value in series.items()]
+
+        with self.lock:
+            stats = {"uptime_seconds": time.time() - self.start_time, "counters": {}, "gauges": {}, "histograms": {}}
+            for name, series in self.counters.items():
+                stats["counters"][name] = series_list(series, lambda v: v)
+            for name, series in self.gauges.items():
+                stats["gauges"][name] = series_list(series, lambda v: v)
+            for name, series in self.histograms.items():
+                bounds = self.get_buckets(name)
+                stats["histograms"][name] = series_list(series, lambda h: {
+                    "count": h[-1], "sum": h[-2], "mean": h[-2] / h[-1] if h[-1] else 0,
+                    "buckets": dict(zip([str(b) for b in bounds], h[:len(bounds)]))})
+        return stats
+
+    def write(self):
+        for file_name, text in ((g_metrics_prom_file, self.to_prometheus()),
+                                (g_metrics_json_file, json.dumps(self.to_json(), indent=1))):
+            try:
+                tmp_name = "{}.tmp".format(file_name)
+                with open(tmp_name, "w", encoding="utf-8") as metrics_file:
+                    metrics_file.write(text)
+                os.replace(tmp_name, file_name)
+            except Exception as e:
+                print(e)
+                print("WARN: Exception when writing metrics to {}! Skipping...".format(file_name))
+
+    def start_exporter(self):
+        def export():
+            while not self.stop_event.wait(g_metrics_interval):
+                self.write()
+        self.exporter = threading.Thread(target=export, name="metrics", daemon=True)
+        self.exporter.start()
+
+    def stop_exporter(self):
+        self.stop_event.set()
+
+################################################################################
+# Desc
+#   Record into g_metrics, doing nothing if metrics are not initialized.
+#   Labels are given as keyword arguments.
+# Params
+#   name        str metric name
+#   value       number to add, set or observe
+# Returns
+#   None
+################################################################################
+def metric_inc(name, value=1, **labels):
+    if g_metrics is not None:
+        g_metrics.inc(name, value, tuple(sorted(labels.items())))
+
+def metric_set(name, value, **labels):
+    if g_metrics is not None:
+        g_metrics.set(name, value, tuple(sorted(labels.items())))
+
+def metric_observe(name, value, **labels):
+    if g_metrics is not None:
+        g_metrics.observe(name, value, tuple(sorted(labels.items())))
+
+################################################################################
+# Desc
+#   Context manager observing how long its block takes in a histogram
+# Params
+#   name        str histogram name
+#   labels      keyword arguments of histogram labels
+# Returns
+#   context manager
+################################################################################
+class timed_metric:
+    def __init__(self, name, **labels):
+        self.name = name
+        self.labels = labels
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *args):
+        metric_observe(self.name, time.perf_counter() - self.start, **self.labels)
+
+################################################################################
+# Desc
+#   Times a hot path into the dl_gb_function_seconds histogram
+# Params
+#   function    str name of the timed function
+# Returns
+#   context manager
+################################################################################
+def timed(function):
+    return timed_metric("dl_gb_function_seconds", function=function)
+
+################################################################################
+# Desc
+#   Sends a request with g_http, recording its latency (time to the response
+#   headers) and status by kind
+# Params
+#   url         str url to request
+#   kind        str request kind label, like "api" or "page"
+#   kwargs      passed on to HttpClient.request
+# Returns
+#   HttpResponse
+################################################################################
+def timed_request(url, kind, **kwargs):
+    start = time.perf_counter()
+    try:
+        response = g_http.request(url, **kwargs)
+    except HttpError as e:
+        metric_inc("dl_gb_requests_total", kind=kind, status=e.status)
+        raise
+    metric_observe("dl_gb_request_latency_seconds", time.perf_counter() - start, kind=kind)
+    metric_inc("dl_gb_requests_total", kind=kind, status=response.status)
+    return response
+
+################################################################################
+# Desc
+#   Starts profiling the calling thread with cProfile, if g_profile_file is set
+# Params
+#   None
+# Returns
+#   cProfile.Profile, or None if not profiling
+################################################################################
+def start_profile():
+    if g_profile_file is None:
+        return None
+    profile = cProfile.Profile()
+    profile.enable()
+    return profile
+
+################################################################################
+# Desc
+#   Stops a thread's profile and keeps it to be merged by finish_profile
+# Params
+#   profile     cProfile.Profile from start_profile, or None
+# Returns
+#   None
+################################################################################
+def stop_profile(profile):
+    if profile is not None:
+        profile.disable()
+        with g_progress_lock:
+            g_profiles.append(profile)
+
+################################################################################
+# Desc
+#   Stops the main thread's profile, merges it with the workers' profiles and
+#   writes them to g_profile_file, printing the top functions by cumulative time
+# Params
+#   profile     cProfile.Profile from start_profile, or None
+# Returns
+#   None
+################################################################################
+def finish_profile(profile):
+    if profile is None:
+        return
+    stop_profile(profile)
+    stats = pstats.Stats(*g_profiles)
+    stats.dump_stats(g_profile_file)
+    print("Wrote profile to {}. Top functions by cumulative time:".format(g_profile_file))
+    stats.sort_stats("cumulative").print_stats(15)
+
+################################################################################
+# Desc
+#   Thread-safe queue of (dl_name, dl_url) pairs shared by the download
+#   workers. Items are taken in FIFO order, or in the order a Scheduler picks.
+#   Items put with a delay (retries) are held back until it has passed.
+#   get() blocks until an item can be taken, and returns None once the queue is
+#   closed, no taken item is still in progress, and nothing left can be taken
+#   (left over items stay in dl.csv for the next run).
+################################################################################
+class DownloadQueue:
+    def __init__(self, scheduler=None):
+        self.items = deque()
+        self.delayed = []           # Heap of (ready time, dl_name, dl_url) waiting to be put
+        self.scheduler = scheduler
+        self.pending = 0            # Items taken by a worker but not yet done
+        self.closed = False
+        self.stopped = False
+        self.left_over = False      # Whether unschedulable items were reported
+        self.cond = threading.Condition()
+
+    def put(self, dl_name, dl_url, delay=0):
+        with self.cond:
+            if delay > 0:
+                heapq.heappush(self.delayed, (time.time() + delay, dl_name, dl_url))
+            else:
+                self.items.append((dl_name, dl_url))
+            metric_set("dl_gb_queue_depth", len(self.items) + len(self.delayed))
+            self.cond.notify()
+
+    def get(self):
+        with self.cond:
+            while True:
+                if self.stopped:
+                    return None
+
+                # Move delayed items whose time has come into the queue
+                now = time.time()
+                while self.delayed and self.delayed[0][0] <= now:
+                    ready_time, dl_name, dl_url = heapq.heappop(self.delayed)
+                    self.items.append((dl_name, dl_url))
+
+                index, wait_time = None, None
+                if self.scheduler is None:
+                    if len(self.items) > 0:
+                        index = 0
+                elif len(self.items) > 0:
+                    index, wait_time = self.scheduler.pick(self.items)
+                if index is not None:
+                    break
+                if self.delayed:
+                    delay = self.delayed[0][0] - now
+                    wait_time = delay if wait_time is None else min(wait_time, delay)
+                if wait_time is None and self.closed and self.pending == 0:
+                    if len(self.items) > 0 and not self.left_over:
+                        self.left_over = True
+                        print("WARN: {} videos do not fit the disk budget or free space, leaving them for the next run".format(len(self.items)))
+                    return None
+                self.cond.wait(wait_time)
+            self.pending += 1
+            item = self.items[index]
+            del self.items[index]
+            metric_set("dl_gb_queue_depth", len(self.items) + len(self.delayed))
+            return item
+
+    # Marks a taken item finished, as "done", "error", "retry" (put back with
+    # a delay) or "stopped"
+    def task_done(self, dl_name, state):
+        with self.cond:
+            self.pending -= 1
+            self.cond.notify_all()
+
+    def close(self):
+        with self.cond:
+            self.closed = True
+            self.cond.notify_all()
+
+    # Makes get() return None from now on, so workers stop after their
+    # current item. Items not taken are left as they are.
+    def stop(self):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify_all()
+
+    def __len__(self):
+        with self.cond:
+            return len(self.items) + len(self.delayed)
+
+    # Returns (dl_name, dl_url) of every video waiting, in no particular order
+    def backlog(self):
+        with self.cond:
+            return list(self.items) + [(dl_name, dl_url) for ready_time, dl_name, dl_url in self.delayed]
+
+################################################################################
+# Desc
+#   Download queue shared by every process pointed at the same SQLite file,
+#   possibly on several hosts, in place of each process' dl.csv. A worker
+#   leases a video for g_lease_time seconds, and a heartbeat thread renews the
+#   leases of this process while it runs. If a process dies, its leases
+#   expire and another worker takes the videos over. Each take and completion
+#   is one transaction. Same interface as DownloadQueue, except get() also
+#   waits for videos leased by other processes, in case they die.
+#
+#   WAL lets readers and the writer work at the same time, but needs shared
+#   memory, so set g_shared_queue_wal to False for a file on a network volume.
+################################################################################
+class SharedQueue:
+    def __init__(self, queue_file):
+        self.owner = "{}:{}".format(socket.gethostname(), os.getpid())
+        self.pending = 0            # Items taken by a worker of this process but not yet done
+        self.closed = False
+        self.stopped = False
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(queue_file, timeout=60, isolation_level=None, check_same_thread=False)
+        self.db.execute("PRAGMA journal_mode={}".format("WAL" if g_shared_queue_wal else "DELETE"))
+        self.db.execute("""CREATE TABLE IF NOT EXISTS videos (
+                               id INTEGER PRIMARY KEY,
+                               dl_name TEXT NOT NULL UNIQUE,
+                               dl_url TEXT NOT NULL,
+                               state TEXT NOT NULL,
+                               ready_at REAL NOT NULL DEFAULT 0,
+                               owner TEXT,
+                               lease_until REAL)""")
+        self.db.execute("CREATE INDEX IF NOT EXISTS videos_state ON videos (state, id)")
+        if "urls" not in [row[1] for row in self.db.execute("PRAGMA table_info(videos)")]:
+            try:
+                self.write(("ALTER TABLE videos ADD COLUMN urls TEXT", ()))
+            except sqlite3.OperationalError:
+                pass    # Added by another process meanwhile
+        self.heartbeat_stop = threading.Event()
+        self.heartbeat = threading.Thread(target=self.renew_leases, name="lease-heartbeat", daemon=True)
+        self.heartbeat.start()
+
+    # Runs statements in one write transaction, returning the last cursor
+    def write(self, *statements):
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                for sql, params in statements:
+                    cursor = self.db.execute(sql, params)
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        return cursor
+
+    # Queues a new video with its quality urls, or puts one leased by this
+    # process back with a delay
+    def put(self, dl_name, dl_url, delay=0):
+        urls = g_quality_urls.get(dl_name)
+        self.write(("INSERT INTO videos (dl_name, dl_url, state, ready_at, urls) VALUES (?, ?, 'queued', ?, ?) "
+                    "ON CONFLICT (dl_name) DO UPDATE SET state = 'queued', ready_at = excluded.ready_at, owner = NULL "
+                    "WHERE state = 'leased' AND owner = ?",
+                    (dl_name, dl_url, time.time() + delay, json.dumps(urls) if urls else None, self.owner)))
+
+    # Records videos downloaded before, so no process downloads them again
+    def add_done(self, done_items):
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                self.db.executemany("INSERT INTO videos (dl_name, dl_url, state) VALUES (?, ?, 'done') "
+                                    "ON CONFLICT (dl_name) DO UPDATE SET state = 'done', owner = NULL",
+                                    done_items)
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+
+    def get(self):
+        while not self.stopped:
+            item, waiting = self.lease()
+            if item is not None:
+                with self.lock:
+                    self.pending += 1
+                return item
+            with self.lock:
+                if self.closed and self.pending == 0 and not waiting:
+                    return None
+            time.sleep(g_lease_poll)
+        return None
+
+    # Leases the oldest ready video, or one whose lease expired. Returns it, or
+    # None and whether any video is still queued or leased.
+    def lease(self):
+        now = time.time()
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                row = self.db.execute("SELECT dl_name, dl_url, owner, urls FROM videos "
+                                      "WHERE (state = 'queued' AND ready_at <= ?) OR (state = 'leased' AND lease_until < ?) "
+                                      "ORDER BY id LIMIT 1", (now, now)).fetchone()
+                if row is not None:
+                    self.db.execute("UPDATE videos SET state = 'leased', owner = ?, lease_until = ? WHERE dl_name = ?",
+                                    (self.owner, now + g_lease_time, row[0]))
+                    waiting = True
+                else:
+                    waiting = self.db.execute("SELECT 1 FROM videos WHERE state IN ('queued', 'leased') LIMIT 1").fetchone() is not None
+                self.db.execute("COMMIT")
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+        if row is None:
+            return None, waiting
+        if row[2] is not None:
+            print("WARN: Lease of {} by {} expired, taking it over".format(row[0], row[2]))
+        if row[3] is not None:
+            g_quality_urls[row[0]] = json.loads(row[3])
+        return (row[0], row[1]), True
+
+    def task_done(self, dl_name, state):
+        if state == "done":
+            # Done is done, even if the lease was lost meanwhile
+            self.write(("UPDATE videos SET state = 'done', owner = NULL WHERE dl_name = ?", (dl_name,)))
+        elif state in ("error", "stopped"):
+            cursor = self.write(("UPDATE videos SET state = ?, owner = NULL WHERE dl_name = ? AND owner = ?",
+                                 ("error" if state == "error" else "queued", dl_name, self.owner)))
+            if cursor.rowcount == 0:
+                print("WARN: Lease of {} was lost before it finished".format(dl_name))
+        with self.lock:
+            self.pending -= 1
+
+    def renew_leases(self):
+        while not self.heartbeat_stop.wait(g_lease_time/3):
+            try:
+                self.write(("UPDATE videos SET lease_until = ? WHERE state = 'leased' AND owner = ?",
+                            (time.time() + g_lease_time, self.owner)))
+            except sqlite3.Error as e:
+                print(e)
+                print("WARN: Could not renew leases in {}".format(g_shared_queue_file))
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+
+    def stop(self):
+        self.stopped = True
+
+    # Stops the heartbeat and closes the database, once the workers are done
+    def shutdown(self):
+        self.heartbeat_stop.set()
+        self.heartbeat.join()
+        self.db.close()
+
+    def __len__(self):
+        with self.lock:
+            return self.db.execute("SELECT COUNT(*) FROM videos WHERE state = 'queued'").fetchone()[0]
+
+    # Returns (dl_name, dl_url) of every queued video, noting their quality urls
+    def backlog(self):
+        with self.lock:
+            rows = self.db.execute("SELECT dl_name, dl_url, urls FROM videos WHERE state = 'queued' ORDER BY id").fetchall()
+        for dl_name, dl_url, urls in rows:
+            if urls is not None:
+                g_quality_urls[dl_name] = json.loads(urls)
+        return [(dl_name, dl_url) for dl_name, dl_url, urls in rows]
+
+################################################################################
+# Desc
+#   Picks which queued video to download next, so the daily download quota
+#   goes to the most useful videos. Videos are ordered by the given policies
+#   (ties fall through to the next policy, then catalog order):
+#     fifo      catalog order
+#     shortest  smallest file first, so the most videos are completed
+#     newest    latest publish date first
+#     oldest    earliest publish date first
+#     show      videos of shows in g_show_priority first, in that order
+#   A video is only started if its size fits the disk budget and the free
+#   space above g_min_free_space, and, with download windows set, inside a
+#   window and expected to finish before it closes (videos too big to finish
+#   in any window may start at any time inside one).
+#
+#   With a deadline, it also picks the quality of each video as it starts
+#   (see choose_quality), and finds the spare capacity to upgrade videos
+#   taken below their best quality (see queue_upgrades).
+################################################################################
+class Scheduler:
+    all_policies = ["fifo", "shortest", "newest", "oldest", "show"]
+
+    def __init__(self, policies, windows, disk_budget, deadline=None, clock=time.time, free_space=None):
+        self.policies = policies
+        self.windows = windows
+        self.disk_budget = disk_budget
+        self.deadline = deadline        # Days to clear the queue in, or None
+        self.clock = clock              # Returns the current unix time
+        self.free_space = free_space    # Bytes free before the first video, if not to be read from the disk
+        self.used = 0                   # Bytes of the disk budget taken by started videos
+        self.throughput = None          # Recent bytes/second of one download
+
+    def needs_sizes(self):
+        return "shortest" in self.policies or bool(self.windows) or self.disk_budget is not None or self.deadline is not None
+
+    def observe_throughput(self, throughput):
+        with g_size_lock:
+            if self.throughput is None:
+                self.throughput = throughput
+            else:
+                self.throughput = 0.7*self.throughput + 0.3*throughput
+
+    # Returns the index of the item to download next, or None and the seconds
+    # until another item could be picked (None if only new items could be)
+    def pick(self, items):
+        time_left, window_length, wait_time = get_window_state(self.windows, self.clock())
+        if time_left == 0:
+            return None, wait_time
+        free_space = self.get_free_space() - g_min_free_space
+        throughput = self.throughput or g_est_throughput
+
+        best = None
+        too_long = False
+        for index, (dl_name, dl_url) in enumerate(items):
+            size = g_sizes.get(dl_url)
+            if size is None:
+                size = g_sizes.get_estimate()
+            if size > free_space or (self.disk_budget is not None and self.used + size > self.disk_budget):
+                continue
+            if time_left is not None and time_left < size/throughput <= window_length:
+                too_long = True
+                continue
+            key = self.get_key(index, dl_name, size)
+            if best is None or key < best[0]:
+                best = (key, index, size)
+
+        if best is None:
+            # Wait for the next window if a video only missed this one
+            return None, wait_time if too_long else None
+        with g_size_lock:
+            self.used += best[2]
+        return best[1], None
+
+    def get_free_space(self):
+        if self.free_space is None:
+            return shutil.disk_usage(".").free
+        return self.free_space - self.used
+
+    # Bytes that can be downloaded before the deadline at the measured
+    # throughput, with every worker busy inside the download windows, capped
+    # by the free space and what is left of the disk budget
+    def get_byte_budget(self):
+        window_share = 1
+        if self.windows:
+            window_share = min(1, sum((end - start) % (24*60) or 24*60 for start, end in self.windows) / (24*60))
+        throughput = (self.throughput or g_est_throughput) * g_num_workers
+        budget = min(throughput * window_share * self.deadline*24*60*60,
+                     self.get_free_space() - g_min_free_space)
+        if self.disk_budget is not None:
+            budget = min(budget, self.disk_budget - self.used)
+        return max(0, budget)
+
+    # Most videos g_max_dl_rate lets start before the deadline
+    def get_video_budget(self):
+        return int(g_max_dl_rate * self.deadline*24*60*60)
+
+    # Picks the quality to download a video at: the best one at which it and
+    # the rest of the backlog fit the byte budget, or the lowest if none does.
+    # Only the videos that can start before the deadline count. Videos being
+    # upgraded always get their best quality. Returns (quality, url).
+    def choose_quality(self, dl_name, dl_url, backlog):
+        if dl_name in g_upgrades or dl_name not in g_quality_urls:
+            return get_quality_url(dl_name, dl_url, g_qualities[0])
+        backlog = [(dl_name, dl_url)] + backlog[:max(0, self.get_video_budget() - 1)]
+        budget = self.get_byte_budget()
+        for quality in g_qualities:
+            total = 0
+            for name, url in backlog:
+                total += get_quality_size(name, url, quality)
+                if total > budget:
+                    break
+            else:
+                break
+        chosen, url = get_quality_url(dl_name, dl_url, quality)
+
+        # pick() took the best quality's size from the disk budget
+        with g_size_lock:
+            self.used -= get_quality_size(dl_name, dl_url, g_qualities[0]) - get_quality_size(dl_name, dl_url, quality)
+        return chosen, url
+
+    def get_key(self, index, dl_name, size):
+        date = g_dl_name_date_pattern.match(dl_name)
+        date = int(date.group(1).replace("-", "")) if date else 0
+        key = []
+        for policy in self.policies:
+            if policy == "shortest":
+                key.append(size)
+            elif policy == "newest":
+                key.append(-date)
+            elif policy == "oldest":
+                key.append(date)
+            elif policy == "show":
+                key.append(next((k for k, show in enumerate(g_show_priority) if show in dl_name), len(g_show_priority)))
+        key.append(index)
+        return key
+
+################################################################################
+# Desc
+#   Makes a Scheduler if any of its settings are in use
+# Params
+#   clock           function returning the current unix time
+#   free_space      int bytes free before the first video, or None to read
+#                   the disk
+# Returns
+#   Scheduler       or None to download in catalog order
+################################################################################
+def make_scheduler(clock=time.time, free_space=None):
+    if g_schedule_policies == ["fifo"] and not g_dl_windows and g_disk_budget is None and g_quality_deadline is None:
+        return None
+    return Scheduler(g_schedule_policies, g_dl_windows, g_disk_budget, g_quality_deadline, clock, free_space)
+
+################################################################################
+# Desc
+#   Finds the url of a video at a quality, or the nearest one below it that
+#   it has (the lowest it has if none are below)
+# Params
+#   dl_name         str name of the video
+#   dl_url          str url of its best quality
+#   quality         str one of g_qualities
+# Returns
+#   quality         str quality of the url, or None if only dl_url is known
+#   url             str url to download
+################################################################################
+def get_quality_url(dl_name, dl_url, quality):
+    urls = g_quality_urls.get(dl_name)
+    if not urls:
+        return None, dl_url
+    wanted = g_qualities.index(quality)
+    available = [k for k in g_qualities if k in urls]
+    chosen = next((k for k in available if g_qualities.index(k) >= wanted), available[-1])
+    return chosen, urls[chosen]
+
+################################################################################
+# Desc
+#   Finds the size of a video at a quality (see get_quality_url), estimating
+#   it from the size of another of its qualities, or the average video, if
+#   it is not known
+# Params
+#   dl_name         str name of the video
+#   dl_url          str url of its best quality
+#   quality         str one of g_qualities
+# Returns
+#   float           bytes
+################################################################################
+def get_quality_size(dl_name, dl_url, quality):
+    quality, url = get_quality_url(dl_name, dl_url, quality)
+    size = g_sizes.get(url)
+    if size is not None:
+        return size
+    if quality is None:
+        return g_sizes.get_estimate()
+    for other, other_url in g_quality_urls[dl_name].items():
+        other_size = g_sizes.get(other_url)
+        if other_size is not None:
+            return other_size * g_quality_ratios[quality] / g_quality_ratios[other]
+    return g_sizes.get_estimate() * g_quality_ratios[quality]
+
+################################################################################
+# Desc
+#   Parses a download window like "01:00-07:30" (local time, may wrap past
+#   midnight)
+# Params
+#   window          str window
+# Returns
+#   tuple           (start, end) minute of day, or None if invalid
+################################################################################
+def parse_window(window):
+    match = re.match(r"^(\d{1,2}):(\d{2})-(\d{1,2}):(\d{2})$", window)
+    if not match:
+        return None
+    start_hour, start_minute, end_hour, end_minute = (int(x) for x in match.groups())
+    if start_hour > 23 or end_hour > 24 or start_minute > 59 or end_minute > 59:
+        return None
+    return (start_hour*60 + start_minute, end_hour*60 + end_minute)
+
+################################################################################
+# Desc
+#   Finds where a time falls relative to the download windows
+# Params
+#   windows         list of (start, end) minute of day
+#   now             float unix time
+# Returns
+#   time_left       float seconds left in the current window, 0 outside every
+#                   window, or None if there are no windows
+#   window_length   float seconds in the current window, or None
+#   wait_time       float seconds until the next window opens, or None
+################################################################################
+def get_window_state(windows, now):
+    if not windows:
+        return None, None, None
+    local = time.localtime(now)
+    minute = local.tm_hour*60 + local.tm_min + local.tm_sec/60
+    time_left, window_length, wait_time = 0, None, None
+    for start, end in windows:
+        length = (end - start) % (24*60) or 24*60
+        into = (minute - start) % (24*60)
+        if into < length and (length - into)*60 > time_left:
+            time_left, window_length = (length - into)*60, length*60
+        # Time until this window next opens
+        wait = (24*60 - into)*60
+        if wait_time is None or wait < wait_time:
+            wait_time = wait
+    return time_left, window_length, wait_time
+
+################################################################################
+# Desc
+#   Sizes of videos by url, from HEAD requests and download responses, kept in
+#   an append-only CSV so they are only ever requested once
+################################################################################
+class SizeCache:
+    def __init__(self, size_file):
+        self.size_file = size_file
+        self.sizes = {}
+        self.total = 0
+        try:
+            with open(size_file, "r", encoding="utf-8", newline="") as in_file:
+                for row in csv.reader(in_file):
+                    try:
+                        self.store(row[0], int(row[1]))
+                    except (IndexError, ValueError):
+                        pass    # Torn last row from a crash
+        except FileNotFoundError:
+            pass
+
+    def store(self, dl_url, size):
+        self.total += size - self.sizes.get(dl_url, 0)
+        self.sizes[dl_url] = size
+
+    def get(self, dl_url):
+        return self.sizes.get(dl_url)
+
+    def set(self, dl_url, size):
+        with g_size_lock:
+            if self.sizes.get(dl_url) == size:
+                return
+            self.store(dl_url, size)
+            with open(self.size_file, "a", encoding="utf-8", newline="") as out_file:
+                csv.writer(out_file).writerow([dl_url, size])
+
+    # Average known size, or g_size_estimate if none are known
+    def get_estimate(self):
+        return self.total // len(self.sizes) if self.sizes else g_size_estimate
+
+################################################################################
+# Desc
+#   Plan mode. Projects how downloading the queue in g_dl_file would go with
+#   each of g_plan_workers workers (and g_num_workers), by running the download
+#   scheduling and rate limits against a virtual clock (see simulate_plan).
+#   Sizes come from g_size_file, estimated where unknown, so no request is
+#   made, and the queue is left as it is.
+# Params
+#   None
+# Returns
+#   int             exit code
+################################################################################
+def plan_downloads():
+    global g_sizes
+    global g_num_workers
+    if not os.path.exists(g_dl_file):
+        print("ERROR: No {} to plan, query for videos first".format(g_dl_file))
+        return 1
+    dl_dict, done_dict = load_progress()
+    if dl_dict is None:
+        return 1
+    g_journal.close()
+    done_dict.close()
+    g_sizes = SizeCache(g_size_file)
+
+    known = [dl_url for dl_url in dl_dict.values() if g_sizes.get(dl_url) is not None]
+    total = sum(get_quality_size(dl_name, dl_url, g_qualities[0]) for dl_name, dl_url in dl_dict.items())
+    print("Planning {} videos, {:.1f} GiB at their best quality ({} of known size, others {:.0f} MiB)".format(
+        len(dl_dict), total / 1024**3, len(known), g_sizes.get_estimate() / 1024**2))
+    print("Limits: {} requests per {}s, {} videos per {}s, {:.1f} MiB/s per download, link {}".format(
+        round(g_max_rq_rate*g_rq_window), g_rq_window, round(g_max_dl_rate*g_dl_window), g_dl_window,
+        g_est_throughput / 1024**2, "{:.1f} MiB/s".format(g_plan_bandwidth / 1024**2) if g_plan_bandwidth else "unlimited"))
+    print("{:>8} {:>10} {:>14} {:>14} {:>14} {:>12} {:>10} {:>8}".format(
+        "workers", "requests", "limit sleep s", "window wait s", "finish s", "videos/day", "GiB/day", "left"))
+    for workers in sorted(set(g_plan_workers + [g_num_workers])):
+        g_num_workers = workers
+        plan = simulate_plan(dl_dict, workers)
+        per_day = 24*60*60 / plan["finish"] if plan["finish"] > 0 else 0
+        print("{:>8} {:>10} {:>14.0f} {:>14.0f} {:>14.0f} {:>12.0f} {:>10.1f} {:>8}".format(
+            workers, plan["requests"], plan["sleep"], plan["window_wait"], plan["finish"],
+            plan["videos"] * per_day, plan["bytes"] * per_day / 1024**3, plan["left"]))
+    return 0
+
+################################################################################
+# Desc
+#   Simulates the download workers taking every video in dl_dict, with the
+#   time read from a virtual clock that jumps from one event to the next:
+#     - Each worker picks videos with the same Scheduler main would use (or in
+#       catalog order), including its qualities with --deadline, and waits
+#       out the download windows.
+#     - The request and download limits are RateLimiters seeded with the
+#       recent events in their state files, kept in memory.
+#     - Transfers share the link: each runs at g_est_throughput, or an equal
+#       share of g_plan_bandwidth if that is less.
+#   Failures and retries are not simulated.
+# Params
+#   dl_dict         dict of videos to download
+#   workers         int number of download workers
+# Returns
+#   dict            "requests", "sleep" (worker-seconds waiting on the
+#                   limits), "window_wait" (worker-seconds waiting for a
+#                   window or room), "finish" (seconds until the last video is
+#                   done), "videos", "bytes" and "left" (videos not started)
+################################################################################
+def simulate_plan(dl_dict, workers):
+    start = time.time()
+    clock = [start]
+    now = lambda: clock[0]
+    rq_limiter = RateLimiter(g_rq_limiter.name, g_rq_limiter.max_count, g_rq_window, g_rq_limiter.state_file, now)
+    dl_limiter = RateLimiter(g_dl_limiter.name, g_dl_limiter.max_count, g_dl_window, g_dl_limiter.state_file, now)
+    rq_limiter.keep_in_memory()
+    dl_limiter.keep_in_memory()
+    scheduler = make_scheduler(now, shutil.disk_usage(".").free)
+    items = deque(dl_dict.items())
+    plan = {"requests": 0, "sleep": 0, "window_wait": 0, "finish": 0, "videos": 0, "bytes": 0, "left": 0}
+
+    # Steps of each worker: "pick" a video, take a "request" slot, take a
+    # "download" slot, then transfer it. Heap of (time, worker, step, video).
+    events = [(start, worker, "pick", None) for worker in range(workers)]
+    transfers = {}          # Remaining bytes, size and start time of each transfer, by worker
+    while events or transfers:
+        # Run the transfers until the next one finishes or the next step is due
+        rate = g_est_throughput
+        if transfers and g_plan_bandwidth:
+            rate = min(rate, g_plan_bandwidth / len(transfers))
+        next_time = events[0][0] if events else None
+        if transfers:
+            done_time = clock[0] + min(transfer[0] for transfer in transfers.values()) / rate
+            if next_time is None or done_time <= next_time:
+                next_time = done_time
+        for transfer in transfers.values():
+            transfer[0] -= rate * (next_time - clock[0])
+        clock[0] = next_time
+
+        for worker, transfer in list(transfers.items()):
+            if transfer[0] <= 1e-6 * transfer[1]:
+                del transfers[worker]
+                plan["videos"] += 1
+                plan["bytes"] += transfer[1]
+                plan["finish"] = clock[0] - start
+                if scheduler is not None and clock[0] > transfer[2]:
+                    scheduler.observe_throughput(transfer[1] / (clock[0] - transfer[2]))
+                heapq.heappush(events, (clock[0], worker, "pick", None))
+
+        while events and events[0][0] <= clock[0]:
+            event_time, worker, step, video = heapq.heappop(events)
+            if step == "pick":
+                if not items:
+                    continue
+                index, wait_time = 0, None
+                if scheduler is not None:
+                    index, wait_time = scheduler.pick(items)
+                if index is None:
+                    if wait_time is not None:
+                        plan["window_wait"] += wait_time
+                        heapq.heappush(events, (clock[0] + wait_time, worker, "pick", None))
+                    continue
+                dl_name, dl_url = items[index]
+                del items[index]
+                quality = g_qualities[0]
+                if scheduler is not None and scheduler.deadline is not None:
+                    quality = scheduler.choose_quality(dl_name, dl_url, list(items))[0] or quality
+                heapq.heappush(events, (clock[0], worker, "request", get_quality_size(dl_name, dl_url, quality)))
+            else:
+                limiter = rq_limiter if step == "request" else dl_limiter
+                wait_time = limiter.try_acquire()
+                if wait_time > 0:
+                    plan["sleep"] += wait_time
+                    heapq.heappush(events, (clock[0] + wait_time, worker, step, video))
+                elif step == "request":
+                    plan["requests"] += 1
+                    heapq.heappush(events, (clock[0], worker, "download", video))
+                else:
+                    transfers[worker] = [video, video, clock[0]]
+
+    plan["left"] = len(items)
+    return plan
 
 ################################################################################
 # Desc
 #   Prints a sleep bar (in seconds)
 # Params
-#   sleep_time      int time to sleep in seconds
+#   sleep_time      float time to sleep in seconds
 # Returns
 #   None
 ################################################################################
@@ -603,11 +4402,15 @@ def sleep_bar(sleep_time):
         print(" ", end="")
     print("100%|\n|", end="")
     
-    sleep_cnt = 0
+    # Sleep in steps of at most a second, ending exactly at sleep_time
+    end_time = time.time() + sleep_time
     print_cnt = 0
-    while sleep_cnt < sleep_time:
-        time.sleep(1)
-        sleep_cnt += 1
+    while True:
+        remaining = end_time - time.time()
+        if remaining <= 0:
+            break
+        time.sleep(min(1, remaining))
+        sleep_cnt = min(sleep_time, sleep_time - (end_time - time.time()))
         print_amount = int(maxval*(sleep_cnt/sleep_time)) - print_cnt
         for k in range(print_amount):
             print(".", end="", flush=True)
@@ -629,6 +4432,45 @@ def print_usage():
     print("      Query mode only: query for videos and log them in dl.csv   ")
     print("  -d, --download                                                 ")
     print("      Download mode only: download all videos in dl.csv          ")
+    print("  -f, --full                                                     ")
+    print("      Query the whole catalog, not just videos newer than last run")
+    print("  --metrics                                                      ")
+    print("      Write metrics to metrics.prom and stats.json during the run")
+    print("  --profile=FILE                                                 ")
+    print("      Profile the run with cProfile and write the stats to FILE  ")
+    print("  --no-cache                                                     ")
+    print("      Always fetch API responses instead of using the cache      ")
+    print("  --json                                                         ")
+    print("      Request JSON instead of XML from the API                   ")
+    print("  -w N, --workers=N                                              ")
+    print("      Download N videos at once (default 1)                      ")
+    print("  -s N, --segments=N                                             ")
+    print("      Fetch each video as N byte ranges at once (default 1)      ")
+    print("  --chunk-size=BYTES                                             ")
+    print("      Bytes read at a time per download (default 4 MiB)          ")
+    print("  --order=POLICIES                                               ")
+    print("      Download order: fifo, shortest, newest, oldest and/or show ")
+    print("  --window=HH:MM-HH:MM                                           ")
+    print("      Only start downloads in this window (repeatable)           ")
+    print("  --disk-budget=GIB                                              ")
+    print("      Download at most this many GiB this run                    ")
+    print("  --deadline=DAYS                                                ")
+    print("      Lower video quality as needed to clear the queue within    ")
+    print("      DAYS days, and upgrade to HD when there is spare capacity  ")
+    print("  --library=DIR                                                  ")
+    print("      File finished videos into DIR/{show}/{year}/{name}         ")
+    print("  --link                                                         ")
+    print("      Hardlink videos into the library instead of moving them    ")
+    print("  --crawl                                                        ")
+    print("      Find new videos by crawling premium pages, not the videos  ")
+    print("      API, stopping at the first page of videos seen before      ")
+    print("  --plan                                                         ")
+    print("      Simulate downloading dl.csv under the rate limits, and     ")
+    print("      project requests, sleep and finish time per worker count   ")
+    print("  --daemon                                                       ")
+    print("      Keep running, polling for new videos every 15 minutes      ")
+    print("  --shared-queue=FILE                                            ")
+    print("      Share the download queue with other processes in FILE      ")
 
 # Strip off script name in arg list
 if __name__ == "__main__":
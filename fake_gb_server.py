@@ -0,0 +1,426 @@
+#!/usr/bin/python3
+
+import re, sys
+import getopt
+import time
+import json
+import gzip
+import random
+import hashlib
+import threading
+
+import http.server
+import urllib.parse
+from xml.sax.saxutils import escape
+
+# Local stand-in for the parts of Giantbomb that dl_gb.py talks to, for testing
+# and benchmarking without spending real request budget. Used by bench_dl_gb.py,
+# or run on its own and point g_gb_url in dl_gb.py at it.
+
+# Serves...
+#   /api/videos/            XML or JSON video list, paged with offset/limit
+#   /api/video/{guid}/      XML or JSON details of one video
+#   /videos/premium/?page=N premium page HTML linking to videos
+#   /videos/{id}_{q}.mp4    generated video bodies, with HEAD and Range support
+# with configurable latency, bandwidth cap and injected failures.
+
+################################################################################
+# Globals
+################################################################################
+g_shows = ["Quick Look", "Giant Bombcast", "Unprofessional Fridays", "Endurance Run", "The Giant Beastcast"]
+g_qualities = ["hd", "high", "low"]
+g_page_size = 24            # Videos per premium page
+g_base_block = bytes(range(256)) * 256  # Every video body is this 64 KiB block, rotated per video
+
+################################################################################
+# Desc
+#   Fake catalog and server settings shared by every request handler
+################################################################################
+class FakeGiantbomb:
+    def __init__(self, num_videos=100, video_size=1024*1024, latency=0.0, bandwidth=0,
+                 fail_rate=0.0, drop_rate=0.0, ranges=True, seed=0):
+        self.num_videos = num_videos
+        self.video_size = video_size    # Bytes per hd video (high is 1/2, low 1/4)
+        self.latency = latency          # Seconds added before every response
+        self.bandwidth = bandwidth      # Max bytes/second per response, 0 for no cap
+        self.fail_rate = fail_rate      # Chance of answering any request with a 503
+        self.drop_rate = drop_rate      # Chance of cutting a video body off halfway
+        self.ranges = ranges            # Whether video bodies support Range requests
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.base_url = ""              # Set once the server is bound
+        self.counts = {}                # Requests served, by kind
+        self.bytes_sent = 0             # Video body bytes sent
+
+    def count(self, kind):
+        with self.lock:
+            self.counts[kind] = self.counts.get(kind, 0) + 1
+
+    def should_fail(self):
+        with self.lock:
+            return self.fail_rate > 0 and self.random.random() < self.fail_rate
+
+    def should_drop(self):
+        with self.lock:
+            return self.drop_rate > 0 and self.random.random() < self.drop_rate
+
+    def add_bytes_sent(self, count):
+        with self.lock:
+            self.bytes_sent += count
+
+    def reset_stats(self):
+        with self.lock:
+            self.counts = {}
+            self.bytes_sent = 0
+
+    def video(self, video_id):
+        show = g_shows[video_id % len(g_shows)]
+        day = video_id % 28 + 1
+        month = video_id // 28 % 12 + 1
+        year = 2008 + video_id // (28*12)
+        return {
+            "id": video_id,
+            "guid": "2300-{}".format(video_id),
+            "name": "{} Episode {}".format(show, video_id),
+            "publish_date": "{:04d}-{:02d}-{:02d} 12:00:00".format(year, month, day),
+            "video_show": {"id": g_shows.index(show) + 1, "title": show},
+            "hd_url": "{}/videos/{}_hd.mp4".format(self.base_url, video_id),
+            "high_url": "{}/videos/{}_high.mp4".format(self.base_url, video_id),
+            "low_url": "{}/videos/{}_low.mp4".format(self.base_url, video_id),
+            "premium": "true",
+        }
+
+    def video_body_size(self, quality):
+        return self.video_size // (2 ** g_qualities.index(quality))
+
+    # Returns bytes [start, end) of a video body
+    def video_bytes(self, video_id, start, end):
+        shift = video_id * 7919 % len(g_base_block)
+        out = bytearray()
+        pos = start
+        while pos < end:
+            offset = (pos + shift) % len(g_base_block)
+            take = min(len(g_base_block) - offset, end - pos)
+            out += g_base_block[offset:offset + take]
+            pos += take
+        return bytes(out)
+
+################################################################################
+# Desc
+#   Request handler for FakeGiantbomb. The server's fake attribute holds the
+#   shared FakeGiantbomb.
+################################################################################
+class FakeHandler(http.server.BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    # Headers and body are written separately, so without this every
+    # keep-alive response waits out the client's delayed ACK (~40ms)
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_HEAD(self):
+        self.handle_request(False)
+
+    def do_GET(self):
+        self.handle_request(True)
+
+    def handle_request(self, send_body):
+        fake = self.server.fake
+        url = urllib.parse.urlsplit(self.path)
+        query = urllib.parse.parse_qs(url.query)
+
+        if fake.latency > 0:
+            time.sleep(fake.latency)
+        if fake.should_fail():
+            fake.count("failed")
+            return self.send_body(503, "text/plain", b"Injected failure", send_body)
+
+        if url.path == "/api/videos/":
+            fake.count("api_videos")
+            return self.send_videos(query, send_body)
+        match = re.match(r"^/api/video/([\d\-]+)/$", url.path)
+        if match:
+            fake.count("api_video")
+            return self.send_video(match.group(1), query, send_body)
+        if url.path == "/videos/premium/":
+            fake.count("premium_page")
+            return self.send_premium_page(query, send_body)
+        match = re.match(r"^/videos/(\d+)_(hd|high|low)\.mp4$", url.path)
+        if match:
+            fake.count("video")
+            return self.send_mp4(int(match.group(1)), match.group(2), send_body)
+
+        fake.count("not_found")
+        self.send_body(404, "text/plain", b"Not found", send_body)
+
+    # Applies the filter, sort and field_list API parameters to the catalog
+    def select_videos(self, query):
+        fake = self.server.fake
+        ids = list(range(1, fake.num_videos + 1))
+        for rule in query.get("filter", [""])[0].split(","):
+            if ":" not in rule:
+                continue
+            field, value = rule.split(":", 1)
+            if field == "id":
+                wanted = set(int(v) for v in value.split("|") if v)
+                ids = [i for i in ids if i in wanted]
+            elif field == "video_show":
+                wanted = set(int(v) for v in value.split("|") if v)
+                ids = [i for i in ids if fake.video(i)["video_show"]["id"] in wanted]
+            elif field == "publish_date":
+                start, _, end = value.partition("|")
+                ids = [i for i in ids if start <= fake.video(i)["publish_date"] <= (end or "9999")]
+        if query.get("sort", ["id:asc"])[0] == "id:desc":
+            ids.reverse()
+        return ids
+
+    def send_videos(self, query, send_body):
+        fake = self.server.fake
+        ids = self.select_videos(query)
+        offset = int(query.get("offset", ["0"])[0])
+        limit = min(100, int(query.get("limit", ["100"])[0]))
+        page = [fake.video(i) for i in ids[offset:offset + limit]]
+        self.send_results(query, page, len(ids), offset, True, send_body)
+
+    def send_video(self, guid, query, send_body):
+        fake = self.server.fake
+        video_id = int(guid.split("-")[-1])
+        if video_id < 1 or video_id > fake.num_videos:
+            return self.send_body(404, "text/plain", b"No such video", send_body)
+        self.send_results(query, fake.video(video_id), 1, 0, False, send_body)
+
+    def send_results(self, query, results, total, offset, is_list, send_body):
+        fields = [f for f in query.get("field_list", [""])[0].split(",") if f]
+
+        def trim(video):
+            return {k: v for k, v in video.items() if not fields or k in fields}
+
+        if is_list:
+            results = [trim(video) for video in results]
+            page_results = len(results)
+        else:
+            results = trim(results)
+            page_results = 1
+
+        if query.get("format", ["xml"])[0] == "json":
+            body = json.dumps({"error": "OK", "limit": 100, "offset": offset,
+                               "number_of_page_results": page_results,
+                               "number_of_total_results": total, "status_code": 1,
+                               "results": results}).encode("utf-8")
+            content_type = "application/json"
+        else:
+            body = results_to_xml(results, total, offset, page_results, is_list).encode("utf-8")
+            content_type = "application/xml"
+
+        # Let clients revalidate cached pages
+        etag = "\"{}\"".format(hashlib.sha1(body).hexdigest())
+        if self.headers.get("If-None-Match") == etag:
+            self.server.fake.count("not_modified")
+            self.send_response(304)
+            self.send_header("ETag", etag)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+            return
+        self.send_body(200, content_type, body, send_body, compress=True, etag=etag)
+
+    def send_premium_page(self, query, send_body):
+        fake = self.server.fake
+        page_no = int(query.get("page", ["1"])[0])
+        start = fake.num_videos - (page_no - 1) * g_page_size
+        lines = ["<html><body>", "<ul class=\"editorial river\">"]
+        for video_id in range(start, max(0, start - g_page_size), -1):
+            lines.append("    <a href=\"/videos/episode-{0}/2300-{0}/\">Episode {0}</a>".format(video_id))
+        lines += ["</ul>", "</body></html>"]
+        self.send_body(200, "text/html", "\n".join(lines).encode("utf-8"), send_body, compress=True)
+
+    def send_mp4(self, video_id, quality, send_body):
+        fake = self.server.fake
+        if video_id < 1 or video_id > fake.num_videos:
+            return self.send_body(404, "text/plain", b"No such video", send_body)
+        size = fake.video_body_size(quality)
+        start, end = 0, size
+        status = 200
+
+        range_header = self.headers.get("Range")
+        if_range = self.headers.get("If-Range")
+        etag = "\"{}-{}-{}\"".format(video_id, quality, size)
+        if range_header and fake.ranges and (if_range is None or if_range == etag):
+            match = re.match(r"bytes=(\d+)-(\d*)$", range_header.strip())
+            if not match or int(match.group(1)) >= size:
+                self.send_response(416)
+                self.send_header("Content-Range", "bytes */{}".format(size))
+                self.send_header("Content-Length", "0")
+                self.end_headers()
+                return
+            start = int(match.group(1))
+            end = min(size, int(match.group(2)) + 1) if match.group(2) else size
+            status = 206
+
+        self.send_response(status)
+        self.send_header("Content-Type", "video/mp4")
+        self.send_header("Content-Length", str(end - start))
+        self.send_header("ETag", etag)
+        self.send_header("Last-Modified", "Mon, 01 Jan 2018 00:00:00 GMT")
+        if fake.ranges:
+            self.send_header("Accept-Ranges", "bytes")
+        if status == 206:
+            self.send_header("Content-Range", "bytes {}-{}/{}".format(start, end - 1, size))
+        self.end_headers()
+        if not send_body:
+            return
+
+        # Stream in chunks, throttled to the bandwidth cap
+        chunk_size = 256*1024
+        stop = end
+        if fake.should_drop():
+            fake.count("dropped")
+            stop = start + (end - start) // 2
+        began = time.time()
+        sent = 0
+        try:
+            for pos in range(start, stop, chunk_size):
+                chunk = fake.video_bytes(video_id, pos, min(stop, pos + chunk_size))
+                self.wfile.write(chunk)
+                sent += len(chunk)
+                fake.add_bytes_sent(len(chunk))
+                if fake.bandwidth > 0:
+                    ahead = sent / fake.bandwidth - (time.time() - began)
+                    if ahead > 0:
+                        time.sleep(ahead)
+        except (BrokenPipeError, ConnectionResetError):
+            pass
+        if stop < end:
+            self.close_connection = True
+
+    def send_body(self, status, content_type, body, send_body, compress=False, etag=None):
+        if compress and "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body)
+            encoding = "gzip"
+        else:
+            encoding = None
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(body)))
+        if encoding:
+            self.send_header("Content-Encoding", encoding)
+        if etag:
+            self.send_header("ETag", etag)
+        self.end_headers()
+        if send_body:
+            self.wfile.write(body)
+
+################################################################################
+# Desc
+#   Formats API results the way the Giantbomb XML API does
+# Params
+#   results         dict video, or list of them
+#   total           int number_of_total_results
+#   offset          int offset of the page
+#   page_results    int number_of_page_results
+#   is_list         bool whether results is a list of videos
+# Returns
+#   str             XML response
+################################################################################
+def results_to_xml(results, total, offset, page_results, is_list):
+    def fields_to_xml(video):
+        parts = []
+        for key, value in video.items():
+            if isinstance(value, dict):
+                inner = "".join("<{0}>{1}</{0}>".format(k, escape(str(v))) for k, v in value.items())
+                parts.append("<{0}>{1}</{0}>".format(key, inner))
+            else:
+                parts.append("<{0}>{1}</{0}>".format(key, escape(str(value))))
+        return "".join(parts)
+
+    if is_list:
+        body = "".join("<video>{}</video>".format(fields_to_xml(video)) for video in results)
+    else:
+        body = fields_to_xml(results)
+    return ("<?xml version=\"1.0\" encoding=\"utf-8\"?><response><error>OK</error><limit>100</limit>"
+            "<offset>{}</offset><number_of_page_results>{}</number_of_page_results>"
+            "<number_of_total_results>{}</number_of_total_results><status_code>1</status_code>"
+            "<results>{}</results><version>1.0</version></response>").format(offset, page_results, total, body)
+
+################################################################################
+# Desc
+#   Starts a FakeGiantbomb server on a background thread
+# Params
+#   fake            FakeGiantbomb catalog and settings
+#   port            int port to listen on, 0 to pick a free one
+# Returns
+#   server          ThreadingHTTPServer, stop it with server.shutdown()
+################################################################################
+def start_server(fake, port=0):
+    server = http.server.ThreadingHTTPServer(("127.0.0.1", port), FakeHandler)
+    server.daemon_threads = True
+    server.fake = fake
+    fake.base_url = "http://127.0.0.1:{}".format(server.server_address[1])
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    return server
+
+################################################################################
+# Main
+################################################################################
+def main(argv):
+    port = 8080
+    fake = FakeGiantbomb()
+    try:
+        opts, args = getopt.getopt(argv, "hp:n:", ["port=", "videos=", "video-size=", "latency=",
+                                                   "bandwidth=", "fail-rate=", "drop-rate=", "no-ranges"])
+    except getopt.GetoptError:
+        print_usage()
+        sys.exit(2)
+
+    for opt, arg in opts:
+        if opt == '-h':
+            print_usage()
+            sys.exit(0)
+        elif opt in ('-p', '--port'):
+            port = int(arg)
+        elif opt in ('-n', '--videos'):
+            fake.num_videos = int(arg)
+        elif opt == '--video-size':
+            fake.video_size = int(arg)
+        elif opt == '--latency':
+            fake.latency = float(arg)
+        elif opt == '--bandwidth':
+            fake.bandwidth = int(arg)
+        elif opt == '--fail-rate':
+            fake.fail_rate = float(arg)
+        elif opt == '--drop-rate':
+            fake.drop_rate = float(arg)
+        elif opt == '--no-ranges':
+            fake.ranges = False
+
+    server = start_server(fake, port)
+    print("Serving {} fake videos at {}".format(fake.num_videos, fake.base_url))
+    print("Point dl_gb.py at it with g_gb_url = \"{}\"".format(fake.base_url))
+    try:
+        while True:
+            time.sleep(1)
+    except KeyboardInterrupt:
+        server.shutdown()
+
+################################################################################
+# Desc
+#   Prints usage
+# Params
+#   None
+# Returns
+#   None
+################################################################################
+def print_usage():
+    print("Usage: fake_gb_server.py [OPTION]...                             ")
+    print("  -p N, --port=N         Port to listen on (default 8080)        ")
+    print("  -n N, --videos=N       Number of videos in the catalog         ")
+    print("  --video-size=BYTES     Size of each hd video (default 1 MiB)   ")
+    print("  --latency=SECONDS      Delay added before every response       ")
+    print("  --bandwidth=BYTES      Max bytes/second per video response     ")
+    print("  --fail-rate=P          Chance of answering with a 503          ")
+    print("  --drop-rate=P          Chance of cutting a video body off      ")
+    print("  --no-ranges            Do not support Range requests           ")
+
+if __name__ == "__main__":
+    main(sys.argv[1:])